@@ -1,6 +1,7 @@
 import streamlit as st
 import json
 import pandas as pd
+import numpy as np
 import io
 import os
 import subprocess
@@ -10,7 +11,7 @@ import zipfile
 import tempfile
 import xlsxwriter
 import openpyxl
-from datetime import datetime
+from datetime import datetime, date
 import streamlit.components.v1 as components
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -18,6 +19,19 @@ from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from email import encoders
 import traceback
+import xml.etree.ElementTree as ET
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import posixpath
+import itertools
+import string
+import unicodedata
+try:
+    import fcntl  # reflink (FICLONE) chỉ có trên Linux
+except ImportError:
+    fcntl = None
 from streamlit_quill import st_quill
 
 # ==========================================
@@ -104,7 +118,7 @@ def get_email_mapping_from_upload(file_obj):
     try:
         file_obj.seek(0)
         # Read header=1 to get column names like 'Funtional', 'Functional admin'
-        df = pd.read_excel(file_obj, sheet_name='Aprrove', header=1)
+        df = read_upload(file_obj, 'excel', sheet_name='Aprrove', header=1)
         df.columns = [str(col).strip() for col in df.columns]
         
         # Identify Key Column (Function Name)
@@ -147,9 +161,10 @@ def get_email_mapping_from_upload(file_obj):
         st.error(f"Lỗi đọc file Approval (Sheet 'Aprrove'): {e}")
         return {}
 
-def create_eml_draft(output_root_dir):
+def create_eml_draft(output_root_dir, placer=None):
     """
     Quét thư mục Output, tìm file Excel và thông tin Email để tạo file .eml
+    placer: FilePlacer đã dùng khi phân phối (chế độ virtual -> PDF lấy từ file nguồn)
     """
     logs = []
     count_success = 0
@@ -234,20 +249,23 @@ def create_eml_draft(output_root_dir):
                     try: os.remove(zip_path)
                     except: pass
 
+                # (file nguồn, đường dẫn tương đối trong Zip - e.g. HoaDon CK/file.pdf)
                 pdf_files_to_zip = []
                 for root, dirs, files_in_dir in os.walk(group_path):
                      for file in files_in_dir:
                         if file.lower().endswith('.pdf'):
-                            pdf_files_to_zip.append(os.path.join(root, file))
+                            pdf_p = os.path.join(root, file)
+                            pdf_files_to_zip.append((pdf_p, os.path.relpath(pdf_p, group_path)))
+                if placer is not None:
+                    for dst, src in placer.virtual_files_under(group_path):
+                        pdf_files_to_zip.append((src, os.path.relpath(dst, group_path)))
                 
                 pdf_count = len(pdf_files_to_zip)
                 
                 if pdf_count > 0:
-                    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                        for pdf_p in pdf_files_to_zip:
-                             # Calculate relative path (e.g. HoaDon CK/file.pdf)
-                             rel_path = os.path.relpath(pdf_p, group_path)
-                             zipf.write(pdf_p, arcname=rel_path)
+                    with zipfile.ZipFile(zip_path, 'w') as zipf:
+                        for pdf_p, rel_path in pdf_files_to_zip:
+                             zip_write_file(zipf, pdf_p, rel_path)
                     
                     # Đính kèm Zip
                     if os.path.exists(zip_path):
@@ -338,6 +356,39 @@ SKIPROWS_EXPRESS = get_conf('general', 'SKIPROWS_EXPRESS', 7)
 SKIPROWS_TRANSPORT = get_conf('general', 'SKIPROWS_TRANSPORT', 7)
 SKIPROWS_GROUP_FUNCTION_APPROVAL = get_conf('general', 'SKIPROWS_GROUP_FUNCTION_APPROVAL', 1)
 
+# --- Xuất file song song (<= 1: tuần tự) ---
+EXPORT_WORKERS = get_conf('general', 'EXPORT_WORKERS', 1)
+
+# --- Ghi Excel theo từng dòng ở chế độ constant_memory (xlsxwriter xả dòng ra file tạm, RAM không tăng theo số dòng) ---
+EXCEL_CONSTANT_MEMORY = get_conf('general', 'EXCEL_CONSTANT_MEMORY', True)
+EXPORT_CHUNK_ROWS = get_conf('general', 'EXPORT_CHUNK_ROWS', 10000)
+
+# --- Nén Zip: PDF/Zip/Eml đã nén sẵn -> lưu nguyên (ZIP_STORED), còn lại Deflate ---
+ZIP_COMPRESSION_LEVEL = get_conf('general', 'ZIP_COMPRESSION_LEVEL', 6)
+ZIP_STORED_EXTENSIONS = ('.pdf', '.zip', '.eml')
+
+# --- Engine đọc Excel: stream (openpyxl read-only, chỉ lấy cột cần), openpyxl (pd.read_excel), calamine, auto ---
+EXCEL_READER_ENGINE = get_conf('general', 'EXCEL_READER_ENGINE', 'openpyxl')
+
+# --- Engine đọc CSV Express/Transport: c (mặc định của pandas) hoặc pyarrow ---
+CSV_READER_ENGINE = get_conf('general', 'CSV_READER_ENGINE', 'c')
+
+# --- Cache đọc file upload (số kết quả parse giữ lại, LRU) ---
+PARSE_CACHE_MAX_ENTRIES = get_conf('general', 'PARSE_CACHE_MAX_ENTRIES', 32)
+
+# --- Snapshot Parquet theo lần chạy (mở lại không cần 5 file gốc) ---
+SNAPSHOT_DIR = get_conf('general', 'SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_MAX_RUNS = get_conf('general', 'SNAPSHOT_MAX_RUNS', 12)
+
+# --- Đặt file PDF khi phân phối: auto (hardlink -> reflink -> copy), hardlink, reflink, copy, virtual ---
+PDF_PLACEMENT_MODE = get_conf('general', 'PDF_PLACEMENT_MODE', 'auto')
+
+# --- Bảng Xem Trước & Chỉnh Sửa: số dòng mỗi trang; chỉ cho xem "Tất cả" khi dữ liệu <= PREVIEW_FULL_MAX_ROWS ---
+PREVIEW_PAGE_SIZE = get_conf('general', 'PREVIEW_PAGE_SIZE', 1000)
+PREVIEW_FULL_MAX_ROWS = get_conf('general', 'PREVIEW_FULL_MAX_ROWS', 20000)
+# --- Dashboard: số nhân viên hiển thị riêng trên biểu đồ scatter, còn lại gộp vào nhóm "Khác" ---
+DASHBOARD_TOP_EMPLOYEES = get_conf('general', 'DASHBOARD_TOP_EMPLOYEES', 50)
+
 # --- Input Columns (Mapped to Globals for compatibility) ---
 IN_COLS = CONFIG.get('input_columns', {})
 IN_COL_BK_BOOKING_ID = IN_COLS.get('IN_COL_BK_BOOKING_ID', 'booking_code_for_business_grab_com')
@@ -430,53 +481,163 @@ DEFAULT_OUTPUT_ORDER_KEYS = [
 ]
 OUTPUT_ORDER_KEYS = CONFIG.get('output_order', DEFAULT_OUTPUT_ORDER_KEYS)
 
+# --- Cột text lặp nhiều giá trị: lưu dạng category trong df_processed ---
+CATEGORICAL_COLS = [COL_GROUP, COL_GROUP_FUNCTION, COL_SERVICE, COL_CITY, COL_PAYMENT_METHOD_INVOICE, COL_COMPANY_NAME]
+
+# --- Làm giàu Bảng Kê từ Express/Transport: cột nguồn -> cột đích (key cấu hình hoặc tên cột thực tế) ---
+DEFAULT_TRIP_ENRICHMENT = {
+    'IN_COL_ET_EMP_ID': 'COL_EMPLOYEE_ID',
+    'IN_COL_ET_EMP_GROUP': 'IN_COL_BK_GROUP_NAME',
+    'IN_COL_ET_EMP_NAME': 'COL_EMPLOYEE_NAME',
+    'IN_COL_ET_TRIP_DESC': 'COL_TRIP_PURPOSE',
+    'IN_COL_ET_PICKUP': 'COL_PICKUP',
+    'IN_COL_ET_DROPOFF': 'COL_DROPOFF',
+    'IN_COL_ET_TIME': 'COL_TIME',
+    'IN_COL_ET_CITY': 'COL_CITY',
+}
+TRIP_ENRICHMENT = CONFIG.get('trip_enrichment', DEFAULT_TRIP_ENRICHMENT)
+
+# --- Suy ra thành phố từ địa chỉ đón (từ khóa -> thành phố, từ khóa đứng trước được ưu tiên) ---
+# Bảng gốc nằm ở đây; config.json chỉ cần 'city_keywords' khi muốn thay cả bảng
+DEFAULT_CITY_KEYWORDS = {
+    'hồ chí minh': 'Ho Chi Minh', 'ho chi minh': 'Ho Chi Minh', 'hcm': 'Ho Chi Minh',
+    'hà nội': 'Hanoi', 'ha noi': 'Hanoi', 'hanoi': 'Hanoi',
+    'đà nẵng': 'Da Nang', 'da nang': 'Da Nang',
+    'cần thơ': 'Can Tho', 'can tho': 'Can Tho',
+    'hải phòng': 'Hai Phong', 'hai phong': 'Hai Phong',
+    'bình dương': 'Binh Duong', 'binh duong': 'Binh Duong',
+    'đồng nai': 'Dong Nai', 'dong nai': 'Dong Nai', 'biên hòa': 'Dong Nai',
+    'khánh hòa': 'Khanh Hoa', 'khanh hoa': 'Khanh Hoa', 'nha trang': 'Khanh Hoa',
+    'bà rịa': 'Ba Ria - Vung Tau', 'vũng tàu': 'Ba Ria - Vung Tau', 'vung tau': 'Ba Ria - Vung Tau',
+    'lâm đồng': 'Lam Dong', 'lam dong': 'Lam Dong', 'đà lạt': 'Lam Dong', 'da lat': 'Lam Dong',
+    'quảng ninh': 'Quang Ninh', 'quang ninh': 'Quang Ninh', 'hạ long': 'Quang Ninh',
+    'long an': 'Long An',
+    'tiền giang': 'Tien Giang', 'tien giang': 'Tien Giang',
+    'bắc ninh': 'Bac Ninh', 'bac ninh': 'Bac Ninh',
+    'thanh hóa': 'Thanh Hoa', 'thanh hoa': 'Thanh Hoa',
+    'nghệ an': 'Nghe An', 'nghe an': 'Nghe An', 'vinh': 'Nghe An',
+    'thừa thiên huế': 'Hue', 'thua thien hue': 'Hue', 'huế': 'Hue',
+    'quảng nam': 'Quang Nam', 'quang nam': 'Quang Nam', 'hội an': 'Quang Nam',
+    'bình định': 'Binh Dinh', 'binh dinh': 'Binh Dinh', 'quy nhơn': 'Binh Dinh',
+}
+CITY_KEYWORDS = CONFIG.get('city_keywords', DEFAULT_CITY_KEYWORDS)
+
 # ==========================================
 # 2. HÀM HỖ TRỢ EXCEL
 # ==========================================
 
+# Format dùng chung theo từng workbook: {workbook: {khóa thuộc tính: Format}}
+_WORKBOOK_FORMATS = weakref.WeakKeyDictionary()
+
+def get_workbook_format(workbook, props):
+    """
+    Trả về Format cho bộ thuộc tính `props`, mỗi bộ thuộc tính chỉ tạo 1 lần
+    cho mỗi workbook (dùng lại giữa các sheet thay vì add_format mỗi lần ghi).
+    """
+    formats = _WORKBOOK_FORMATS.setdefault(workbook, {})
+    key = tuple(sorted(props.items()))
+    fmt = formats.get(key)
+    if fmt is None:
+        fmt = workbook.add_format(props)
+        formats[key] = fmt
+    return fmt
+
+def compute_column_widths(df, max_width=50):
+    """Độ rộng cột = max(độ dài giá trị, độ dài tiêu đề) + 2, tối đa max_width."""
+    widths = []
+    for col_num, col in enumerate(df.columns):
+        values = df.iloc[:, col_num]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Đo trên categories rồi tra theo code (code -1 = NaN -> 'nan')
+            lengths = np.append(values.cat.categories.astype(str).str.len().to_numpy(), len('nan'))
+            max_len = lengths[values.cat.codes.to_numpy()].max() if len(values) else np.nan
+        else:
+            max_len = values.astype(str).str.len().max()
+        if pd.isna(max_len): max_len = 0
+        widths.append(min(max(int(max_len), len(str(col))) + 2, max_width))
+    return widths
+
+def open_excel_writer(path, constant_memory=None):
+    """
+    pd.ExcelWriter (xlsxwriter). constant_memory (mặc định EXCEL_CONSTANT_MEMORY): xlsxwriter
+    xả từng dòng ra file tạm khi chuyển sang dòng sau, nên mọi sheet phải ghi theo thứ tự dòng.
+    """
+    # Như to_excel: datetime -> YYYY-MM-DD HH:MM:SS; NaN/inf ghi ngoài iter_frame_rows -> ô lỗi thay vì exception
+    options = {'default_date_format': 'YYYY-MM-DD HH:MM:SS', 'nan_inf_to_errors': True}
+    if EXCEL_CONSTANT_MEMORY if constant_memory is None else constant_memory:
+        options['constant_memory'] = True
+    return pd.ExcelWriter(path, engine='xlsxwriter', engine_kwargs={'options': options})
+
+def iter_frame_rows(df, chunk_rows=None):
+    """
+    Các dòng của df theo thứ tự, dạng tuple giá trị Python (NaN/NaT -> None; ±inf -> chuỗi
+    'inf' / '-inf' như to_excel).
+    Chuyển kiểu theo từng khối chunk_rows dòng (mặc định EXPORT_CHUNK_ROWS), không tạo bản sao cả bảng.
+    """
+    chunk_rows = chunk_rows or EXPORT_CHUNK_ROWS
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        columns = []
+        for col in range(chunk.shape[1]):
+            series = chunk.iloc[:, col]
+            values = series.to_numpy(dtype=object, copy=True)
+            values[pd.isna(values)] = None
+            if series.dtype == object or pd.api.types.is_float_dtype(series.dtype):
+                values[values == np.inf], values[values == -np.inf] = 'inf', '-inf'
+            columns.append(values)
+        yield from zip(*columns)
+
+def add_frame_worksheet(workbook, sheet_name):
+    """add_worksheet cho dữ liệu từ iter_frame_rows: ô date (không kèm giờ) ghi dạng YYYY-MM-DD như to_excel."""
+    worksheet = workbook.add_worksheet(sheet_name)
+    date_fmt = get_workbook_format(workbook, {'num_format': 'YYYY-MM-DD'})
+    worksheet.add_write_handler(date, lambda ws, row, col, value, fmt=None: ws.write_datetime(row, col, value, fmt or date_fmt))
+    return worksheet
+
+def write_frame_xlsx(df, target, sheet_name, constant_memory=None):
+    """Ghi df ra 1 sheet (header giống to_excel), từng dòng theo thứ tự. target: đường dẫn hoặc file-like."""
+    with open_excel_writer(target, constant_memory) as writer:
+        workbook = writer.book
+        worksheet = add_frame_worksheet(workbook, sheet_name)
+        header_fmt = get_workbook_format(workbook, {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        worksheet.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+        for row_num, row in enumerate(iter_frame_rows(df), start=1):
+            worksheet.write_row(row_num, 0, row)
+
 def write_and_format_sheet_common(df, sheet_name, title_prefix, writer_obj, month, year, number_of_days, gr_func_name="ALL"):
     if df.empty: return
     df = df.dropna(axis=1, how='all')
     df = df.assign(Note=pd.Series(dtype='str'))
-    df.to_excel(writer_obj, index=False, sheet_name=sheet_name, startrow=4, header=False)
 
-    worksheet = writer_obj.sheets[sheet_name]
     workbook = writer_obj.book
+    worksheet = add_frame_worksheet(workbook, sheet_name)
+    writer_obj.sheets[sheet_name] = worksheet
+    # Các ô được ghi theo thứ tự dòng (tiêu đề -> tổng -> header -> dữ liệu -> chữ ký) để chạy được ở chế độ constant_memory
 
     # Header Report
     title = f"{title_prefix} - NHÓM CHỨC NĂNG: {gr_func_name.upper()} - THÁNG {month} NĂM {year}"
-    title_fmt = workbook.add_format({'font_size': 16, 'color': '#333333', 'bold': True})
+    title_fmt = get_workbook_format(workbook, {'font_size': 16, 'color': '#333333', 'bold': True})
     worksheet.write('B1', title, title_fmt)
     worksheet.write('B2', f"Từ ngày 01/{month:02d}/{year} đến ngày {number_of_days}/{month:02d}/{year}")
 
-    # Header Table
-    header_fmt = workbook.add_format({
-        'align': 'center', 'valign': 'vcenter', 'text_wrap': True,
-        'bold': True, 'bg_color': '#145f82', 'font_color': 'white', 'border': 1
-    })
-    for col_num, value in enumerate(df.columns.values):
-        worksheet.write(3, col_num, value, header_fmt)
-
     # Column Widths & Hidden Columns
     cols_to_hide = [COL_BOOKING_CODE_ORIG, COL_COMPANY_NAME, COL_PAYMENT_TYPE]
-    for idx, col in enumerate(df.columns):
-        series = df[col].astype(str)
-        max_len = max(series.map(len).max(), len(str(col))) + 2
-        worksheet.set_column(idx, idx, min(max_len, 50))
+    for idx, (col, width) in enumerate(zip(df.columns, compute_column_widths(df))):
+        worksheet.set_column(idx, idx, width)
         if col in cols_to_hide:
             worksheet.set_column(idx, idx, None, None, {'hidden': True})
 
     # Money Format
-    money_fmt = workbook.add_format({'align': 'right', 'font_color': 'blue', 'num_format': '#,##0'})
+    money_fmt = get_workbook_format(workbook, {'align': 'right', 'font_color': 'blue', 'num_format': '#,##0'})
     for col in MONEY_COLS_BANG_KE:
         if col in df.columns:
             worksheet.set_column(df.columns.get_loc(col), df.columns.get_loc(col), None, money_fmt)
 
     # Subtotals
     last_row_excel = 5 + len(df)
-    bold_fmt = workbook.add_format({'bold': True, 'num_format': '#,##0'})
-    bold_red_fmt = workbook.add_format({'bold': True, 'font_color': 'red', 'num_format': '#,##0'})
-    red_fmt = workbook.add_format({'font_color': 'red'})
+    bold_fmt = get_workbook_format(workbook, {'bold': True, 'num_format': '#,##0'})
+    bold_red_fmt = get_workbook_format(workbook, {'bold': True, 'font_color': 'red', 'num_format': '#,##0'})
+    red_fmt = get_workbook_format(workbook, {'font_color': 'red'})
 
     if COL_SERVICE in df.columns:
         worksheet.write(2, df.columns.get_loc(COL_SERVICE), "TỔNG", bold_fmt)
@@ -495,6 +656,17 @@ def write_and_format_sheet_common(df, sheet_name, title_prefix, writer_obj, mont
         worksheet.write(2, col_idx - 1, "SỐ LƯỢNG HÓA ĐƠN", red_fmt)
         worksheet.write_formula(2, col_idx, f"=SUBTOTAL(3, {col_char}5:{col_char}{last_row_excel})", red_fmt)
 
+    # Header Table
+    header_fmt = get_workbook_format(workbook, {
+        'align': 'center', 'valign': 'vcenter', 'text_wrap': True,
+        'bold': True, 'bg_color': '#145f82', 'font_color': 'white', 'border': 1
+    })
+    worksheet.write_row(3, 0, df.columns.values, header_fmt)
+
+    # Data
+    for row_num, row in enumerate(iter_frame_rows(df), start=4):
+        worksheet.write_row(row_num, 0, row)
+
     # Signatures
     sig_row = last_row_excel + 2
     if COL_COST_TRANSPORT_PRE_TAX in df.columns:
@@ -504,32 +676,34 @@ def write_and_format_sheet_common(df, sheet_name, title_prefix, writer_obj, mont
 
 def write_report_sheet(df, sheet_name, title_prefix, writer_obj):
     if df.empty: return
-    df.to_excel(writer_obj, sheet_name=sheet_name, index=False, startrow=0)
-    worksheet = writer_obj.sheets[sheet_name]
     workbook = writer_obj.book
+    worksheet = add_frame_worksheet(workbook, sheet_name)
+    writer_obj.sheets[sheet_name] = worksheet
+
+    header_wrap = get_workbook_format(workbook, {'bold': True, 'border': 1, 'text_wrap': True, 'valign': 'vcenter', 'bg_color': '#D9E1F2'})
+    header_no_wrap = get_workbook_format(workbook, {'bold': True, 'border': 1, 'text_wrap': False, 'valign': 'vcenter', 'bg_color': '#D9E1F2'})
+    data_fmt = get_workbook_format(workbook, {'border': 1, 'valign': 'vcenter'})
+    money_fmt = get_workbook_format(workbook, {'border': 1, 'num_format': '#,##0', 'valign': 'vcenter'})
+    total_fmt = get_workbook_format(workbook, {'bold': True, 'border': 1, 'bg_color': '#FFF2CC'})
+    total_money_fmt = get_workbook_format(workbook, {'bold': True, 'border': 1, 'bg_color': '#FFF2CC', 'num_format': '#,##0'})
 
-    header_wrap = workbook.add_format({'bold': True, 'border': 1, 'text_wrap': True, 'valign': 'vcenter', 'bg_color': '#D9E1F2'})
-    header_no_wrap = workbook.add_format({'bold': True, 'border': 1, 'text_wrap': False, 'valign': 'vcenter', 'bg_color': '#D9E1F2'})
-    data_fmt = workbook.add_format({'border': 1, 'valign': 'vcenter'})
-    money_fmt = workbook.add_format({'border': 1, 'num_format': '#,##0', 'valign': 'vcenter'})
-    total_fmt = workbook.add_format({'bold': True, 'border': 1, 'bg_color': '#FFF2CC'})
-    total_money_fmt = workbook.add_format({'bold': True, 'border': 1, 'bg_color': '#FFF2CC', 'num_format': '#,##0'})
+    try:
+        col_widths = compute_column_widths(df)
+    except:
+        col_widths = [15] * len(df.columns)
 
+    # Định dạng dữ liệu gắn theo cột (set_column): ô không có format riêng dùng format của cột
+    col_fmts = [money_fmt if col in MONEY_COL_REPORT else data_fmt for col in df.columns]
     for col_num, value in enumerate(df.columns.values):
         fmt = header_no_wrap if value == COL_GROUP_FUNCTION else header_wrap
         worksheet.write(0, col_num, value, fmt)
-        try:
-            col_len = max(df.iloc[:, col_num].astype(str).map(len).max(), len(str(value))) + 2
-            worksheet.set_column(col_num, col_num, min(col_len, 50))
-        except:
-            worksheet.set_column(col_num, col_num, 15)
+        worksheet.set_column(col_num, col_num, col_widths[col_num], col_fmts[col_num])
+    # xlsxwriter bỏ qua ô trống không có format -> ghi blank kèm format cột để vẫn có viền
+    worksheet.add_write_handler(type(None), lambda ws, row, col, value, fmt=None: ws.write_blank(row, col, None, fmt or col_fmts[col]))
 
-    for row in range(len(df)):
-        for col in range(len(df.columns)):
-            val = df.iloc[row, col]
-            fmt = money_fmt if df.columns[col] in MONEY_COL_REPORT else data_fmt
-            if pd.isna(val): worksheet.write(row + 1, col, "", fmt)
-            else: worksheet.write(row + 1, col, val, fmt)
+    # Data: write_row từ các mảng cột đã chuẩn hóa (NaN -> None = ô trống, ±inf -> 'inf'), theo thứ tự dòng (constant_memory)
+    for row_num, row in enumerate(iter_frame_rows(df), start=1):
+        worksheet.write_row(row_num, 0, row)
 
     last_row = len(df) + 1
     worksheet.write(last_row, 0, "TỔNG CỘNG", total_fmt)
@@ -540,132 +714,1779 @@ def write_report_sheet(df, sheet_name, title_prefix, writer_obj):
         elif col_num > 0:
             worksheet.write(last_row, col_num, "", total_fmt)
 
-def copy_intro_sheet(source_file_path, target_file_path):
+_OPENPYXL_BORDER_STYLES = {
+    'thin': 1, 'medium': 2, 'dashed': 3, 'dotted': 4, 'thick': 5, 'double': 6, 'hair': 7,
+    'mediumDashed': 8, 'dashDot': 9, 'mediumDashDot': 10, 'dashDotDot': 11,
+    'mediumDashDotDot': 12, 'slantDashDot': 13,
+}
+_OPENPYXL_UNDERLINE = {'single': 1, 'double': 2, 'singleAccounting': 33, 'doubleAccounting': 34}
+_OPENPYXL_VALIGN = {'top': 'top', 'center': 'vcenter', 'bottom': 'bottom', 'justify': 'vjustify', 'distributed': 'vdistributed'}
+
+def _openpyxl_color(color):
+    """Màu openpyxl (ARGB/indexed) -> '#RRGGBB' cho xlsxwriter. Màu theme được bỏ qua."""
+    if color is None: return None
     try:
-        wb_source = openpyxl.load_workbook(source_file_path)
-        if SHEET_INTRO not in wb_source.sheetnames: return False
-        ws_source = wb_source[SHEET_INTRO]
-        wb_target = openpyxl.load_workbook(target_file_path)
-        if SHEET_INTRO in wb_target.sheetnames: del wb_target[SHEET_INTRO]
-        ws_target = wb_target.create_sheet(SHEET_INTRO, index=0)
-
-        for row in ws_source.rows:
-            for cell in row:
-                new_cell = ws_target[cell.coordinate]
-                new_cell.value = cell.value
-                if cell.has_style:
-                    new_cell.font = cell.font.copy()
-                    new_cell.border = cell.border.copy()
-                    new_cell.fill = cell.fill.copy()
-                    new_cell.number_format = cell.number_format
-                    new_cell.alignment = cell.alignment.copy()
-        
-        for col_dim in ws_source.column_dimensions.values():
-            if col_dim.width: ws_target.column_dimensions[col_dim.index].width = col_dim.width
+        if color.type == 'rgb' and isinstance(color.rgb, str):
+            return '#' + color.rgb[-6:]
+        if color.type == 'indexed':
+            return '#' + openpyxl.styles.colors.COLOR_INDEX[color.indexed][-6:]
+    except Exception:
+        pass
+    return None
+
+def _openpyxl_style_to_props(cell):
+    """Chuyển style của 1 ô openpyxl thành dict thuộc tính Format của xlsxwriter."""
+    props = {}
+    font = cell.font
+    if font is not None:
+        if font.name: props['font_name'] = font.name
+        if font.sz: props['font_size'] = float(font.sz)
+        if font.b: props['bold'] = True
+        if font.i: props['italic'] = True
+        if font.strike: props['font_strikeout'] = True
+        if font.u in _OPENPYXL_UNDERLINE: props['underline'] = _OPENPYXL_UNDERLINE[font.u]
+        font_color = _openpyxl_color(font.color)
+        if font_color: props['font_color'] = font_color
+
+    fill = cell.fill
+    if fill is not None and getattr(fill, 'fill_type', None) == 'solid':
+        bg_color = _openpyxl_color(fill.fgColor)
+        if bg_color:
+            props['pattern'] = 1
+            props['bg_color'] = bg_color
+
+    border = cell.border
+    if border is not None:
+        for side in ('left', 'right', 'top', 'bottom'):
+            b = getattr(border, side)
+            if b is not None and b.style in _OPENPYXL_BORDER_STYLES:
+                props[side] = _OPENPYXL_BORDER_STYLES[b.style]
+                side_color = _openpyxl_color(b.color)
+                if side_color: props[f'{side}_color'] = side_color
+
+    align = cell.alignment
+    if align is not None:
+        if align.horizontal and align.horizontal != 'general':
+            props['align'] = 'center_across' if align.horizontal == 'centerContinuous' else align.horizontal
+        if align.vertical in _OPENPYXL_VALIGN: props['valign'] = _OPENPYXL_VALIGN[align.vertical]
+        if align.wrap_text: props['text_wrap'] = True
+        if align.indent: props['indent'] = int(align.indent)
+
+    if cell.number_format and cell.number_format != 'General':
+        props['num_format'] = cell.number_format
+    return props
+
+_OOXML_NS_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_OOXML_NS_DOC_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_OOXML_NS_PKG_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+_OOXML_OFFICE_DOCUMENT = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+def _ooxml_part_path(base_part, target):
+    """Đường dẫn part trong gói xlsx từ Target của relationship (tương đối theo part nguồn, hoặc tuyệt đối '/...')."""
+    if target.startswith('/'): return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_part), target))
+
+def _read_sheet_layout(source, sheet_name):
+    """
+    Đọc vùng merge và độ rộng cột của 1 sheet thẳng từ gói xlsx (chế độ read_only của openpyxl
+    không có sẵn): _rels/.rels -> workbook.xml -> rels của workbook -> XML của sheet.
+    Raise nếu file không theo cấu trúc OOXML này.
+    """
+    source.seek(0)
+    with zipfile.ZipFile(source) as zf:
+        pkg_rels = ET.fromstring(zf.read('_rels/.rels'))
+        wb_part = _ooxml_part_path('', next(r.get('Target') for r in pkg_rels.iter(f'{_OOXML_NS_PKG_REL}Relationship')
+                                             if r.get('Type') == _OOXML_OFFICE_DOCUMENT))
+        wb_root = ET.fromstring(zf.read(wb_part))
+        rel_id = next(sh.get(f'{_OOXML_NS_DOC_REL}id') for sh in wb_root.iter(f'{_OOXML_NS_MAIN}sheet') if sh.get('name') == sheet_name)
+        wb_rels_part = posixpath.join(posixpath.dirname(wb_part), '_rels', posixpath.basename(wb_part) + '.rels')
+        wb_rels = ET.fromstring(zf.read(wb_rels_part))
+        sheet_part = _ooxml_part_path(wb_part, next(r.get('Target') for r in wb_rels.iter(f'{_OOXML_NS_PKG_REL}Relationship')
+                                                    if r.get('Id') == rel_id))
+        root = ET.fromstring(zf.read(sheet_part))
+
+    merges, widths = [], {}
+    ns = _OOXML_NS_MAIN
+    for col in root.iter(f'{ns}col'):
+        if col.get('width'):
+            for c in range(int(col.get('min')), int(col.get('max')) + 1):
+                widths[c - 1] = float(col.get('width'))
+    for merge in root.iter(f'{ns}mergeCell'):
+        min_col, min_row, max_col, max_row = openpyxl.utils.cell.range_boundaries(merge.get('ref'))
+        merges.append((min_row - 1, min_col - 1, max_row - 1, max_col - 1))
+    return merges, widths
+
+def load_intro_template(file_bang_ke_original):
+    """
+    Đọc sheet "tổng quan" của Bảng Kê gốc 1 lần cho mỗi lượt xuất file,
+    thành dạng gọn trong bộ nhớ: giá trị + style từng ô, vùng merge, độ rộng cột.
+    Chỉ sheet này được parse (read_only), không load toàn bộ workbook.
+    Trả về (template, cảnh báo): template None nếu không có sheet (cảnh báo None) hoặc đọc lỗi
+    (cảnh báo "⚠️ ..." để hiện trong log xuất file, Master sẽ thiếu sheet này).
+    """
+    try:
+        file_bang_ke_original.seek(0)
+        wb_source = openpyxl.load_workbook(file_bang_ke_original, read_only=True)
+        try:
+            if SHEET_INTRO not in wb_source.sheetnames: return None, None
+            ws_source = wb_source[SHEET_INTRO]
+            cells = []
+            for row in ws_source.iter_rows():
+                for cell in row:
+                    if getattr(cell, 'row', None) is None: continue  # EmptyCell
+                    props = _openpyxl_style_to_props(cell) if cell.has_style else {}
+                    if cell.value is None and not props: continue
+                    cells.append((cell.row - 1, cell.column - 1, cell.value, props))
+        finally:
+            wb_source.close()
+        merges, widths = _read_sheet_layout(file_bang_ke_original, SHEET_INTRO)
+        return {'cells': cells, 'merges': merges, 'widths': widths}, None
+    except Exception as e:
+        return None, f"⚠️ Không đọc được sheet '{SHEET_INTRO}' từ Bảng Kê gốc, Master sẽ không có sheet này: {e}"
+
+def write_intro_sheet(workbook, intro):
+    """Ghi sheet "tổng quan" từ template đã đọc sẵn trực tiếp bằng xlsxwriter."""
+    worksheet = workbook.add_worksheet(SHEET_INTRO)
+    # Widths in the XML include xlsxwriter's 5px padding (~5/7 char): remove it to keep the same size
+    for col, width in intro['widths'].items():
+        worksheet.set_column(col, col, max(width - 5 / 7, 0))
+    for col in range(3):  # A, B, C
+        worksheet.set_column(col, col, 60 - 5 / 7)
+
+    cells = {(r, c): (value, props) for r, c, value, props in intro['cells']}
+    covered = set()
+    for r1, c1, r2, c2 in intro['merges']:
+        if (r1, c1) == (r2, c2): continue
+        value, props = cells.get((r1, c1), (None, {}))
+        fmt = get_workbook_format(workbook, props) if props else None
+        worksheet.merge_range(r1, c1, r2, c2, "" if value is None else value, fmt)
+        covered.update((r, c) for r in range(r1, r2 + 1) for c in range(c1, c2 + 1))
+
+    for (r, c), (value, props) in cells.items():
+        if (r, c) in covered: continue
+        fmt = get_workbook_format(workbook, props) if props else None
+        if value is None: worksheet.write_blank(r, c, None, fmt)
+        else: worksheet.write(r, c, value, fmt)
+    return worksheet
+
+def _take_rows(df, positions):
+    if positions is None: return df.iloc[0:0]
+    return df.take(positions)
+
+def partition_for_export(bangKe, report_df):
+    """
+    Chia dữ liệu 1 lần cho toàn bộ lượt xuất file (thay cho việc lọc lại
+    bangKe/report_df cho từng Group Function).
 
-        for col in ['A', 'B', 'C']:
-            ws_target.column_dimensions[col].width = 60
-            
-        for merged in ws_source.merged_cells.ranges:
-            ws_target.merge_cells(merged.coord)
-            
-        wb_target.save(target_file_path)
-        return True
+    - Bảng kê: 1 groupby theo (Group Function, CK/TM-CK).
+    - Report: 1 merge số hóa đơn -> (Group Function, CK/TM-CK).
+
+    Trả về (partitions, master):
+      partitions[func] = {'all', 'ck', 'tm', 'report_ck', 'report_tm', 'report_func'}
+      master           = {'ck', 'tm', 'report_ck', 'report_tm'}
+    Thứ tự dòng trong mỗi phần giữ nguyên như dữ liệu gốc.
+    """
+    is_ck = (bangKe[COL_PAYMENT_METHOD_INVOICE] == VAL_PAYMENT_METHOD_TRANSFER).to_numpy()
+    keys = pd.DataFrame({
+        '__func': bangKe[COL_GROUP_FUNCTION].to_numpy(dtype=object),
+        '__ck': is_ck,
+        '__inv': bangKe[COL_INVOICE_NUM].astype(object).to_numpy() if COL_INVOICE_NUM in bangKe.columns else None,
+    })
+    row_groups = keys.groupby(['__func', '__ck'], sort=False).indices
+
+    # Report rows per (function, payment) and for master (payment only)
+    report_groups, report_master = {}, {}
+    has_report = report_df is not None and not report_df.empty and COL_ADJUSTED_INVOICE_REPORT in report_df.columns
+    if has_report:
+        rep = pd.DataFrame({
+            '__inv': report_df[COL_ADJUSTED_INVOICE_REPORT].astype(object).to_numpy(),
+            '__row': np.arange(len(report_df)),
+        })
+        inv_keys = keys.drop_duplicates()
+        merged = rep.merge(inv_keys.dropna(subset=['__func']), on='__inv', how='inner')
+        rows = merged['__row'].to_numpy()
+        for key, pos in merged.groupby(['__func', '__ck'], sort=False).indices.items():
+            report_groups[key] = np.unique(rows[pos])
+
+        merged_master = rep.merge(inv_keys[['__inv', '__ck']].drop_duplicates(), on='__inv', how='inner')
+        rows = merged_master['__row'].to_numpy()
+        for key, pos in merged_master.groupby('__ck', sort=False).indices.items():
+            report_master[bool(key)] = np.unique(rows[pos])
+
+    report_func_groups = {}
+    if has_report and COL_GROUP_FUNCTION in report_df.columns:
+        report_func_groups = report_df.groupby(COL_GROUP_FUNCTION, sort=False).indices
+
+    empty_report = report_df.iloc[0:0] if report_df is not None else pd.DataFrame()
+    take_report = lambda pos: report_df.take(pos) if pos is not None else empty_report
+
+    partitions = {}
+    for func in sorted({k[0] for k in row_groups}):
+        ck_pos, tm_pos = row_groups.get((func, True)), row_groups.get((func, False))
+        all_pos = np.sort(np.concatenate([p for p in (ck_pos, tm_pos) if p is not None]))
+        partitions[func] = {
+            'all': bangKe.take(all_pos),
+            'ck': _take_rows(bangKe, ck_pos),
+            'tm': _take_rows(bangKe, tm_pos),
+            'report_ck': take_report(report_groups.get((func, True))),
+            'report_tm': take_report(report_groups.get((func, False))),
+            'report_func': take_report(report_func_groups.get(func)),
+        }
+
+    master = {
+        'ck': bangKe[is_ck],
+        'tm': bangKe[~is_ck],
+        'report_ck': take_report(report_master.get(True)),
+        'report_tm': take_report(report_master.get(False)),
+    }
+    return partitions, master
+
+def write_function_workbook(filepath, func, part, month, year, number_of_days):
+    """Ghi file Excel Bảng Kê của 1 Group Function từ phần dữ liệu đã chia sẵn."""
+    writer = open_excel_writer(filepath)
+    write_and_format_sheet_common(part['ck'], f'1. BK {month}.{year} {func}'[:31], 'BẢNG KÊ CÁC CHUYẾN ĐI TRONG THÁNG (CHUYỂN KHOẢN)', writer, month, year, number_of_days, func)
+    write_and_format_sheet_common(part['tm'], '2.TM-CK', 'BẢNG KÊ CÁC CHUYẾN ĐI TRONG THÁNG (TM-CK)', writer, month, year, number_of_days, func)
+    
+    write_report_sheet(part['report_ck'], 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN (CK)', writer)
+    write_report_sheet(part['report_tm'], 'DS Hoa don TM-CK', 'BÁO CÁO HÓA ĐƠN (TM-CK)', writer)
+    writer.close()
+
+def write_master_workbook(master_path, master, month, year, number_of_days, intro=None):
+    """
+    Ghi file Master (toàn bộ Group Function), sheet "tổng quan" đứng đầu nếu có template.
+    Trả về cảnh báo (chuỗi "⚠️ ...") nếu không ghi được sheet "tổng quan", ngược lại None.
+    """
+    warning = None
+    # Sheet "tổng quan" ghi ô theo template (không theo thứ tự dòng) -> không dùng constant_memory
+    writer_master = open_excel_writer(master_path, constant_memory=False if intro else None)
+    if intro:
+        try:
+            write_intro_sheet(writer_master.book, intro)
+        except Exception as e:
+            warning = f"⚠️ Không ghi được sheet '{SHEET_INTRO}' vào Master: {e}"
+    
+    write_and_format_sheet_common(master['ck'], '1. BK', 'BẢNG KÊ TỔNG HỢP', writer_master, month, year, number_of_days, "TẤT CẢ")
+    write_and_format_sheet_common(master['tm'], '2.TM-CK', 'BẢNG KÊ TỔNG HỢP (TM-CK)', writer_master, month, year, number_of_days, "TẤT CẢ")
+    
+    write_report_sheet(master['report_ck'], 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN TỔNG HỢP (CK)', writer_master)
+    write_report_sheet(master['report_tm'], 'DS Hoa don TM-CK', 'BÁO CÁO HÓA ĐƠN TỔNG HỢP (TM-CK)', writer_master)
+    writer_master.close()
+    return warning
+
+def _write_function_workbook_job(job):
+    """Chạy trong process con: ghi 1 file, trả về lỗi (nếu có) thay vì raise."""
+    filepath, func, part, month, year, number_of_days = job
+    try:
+        write_function_workbook(filepath, func, part, month, year, number_of_days)
+        return None
     except Exception as e:
-        print(f"Error copying intro sheet: {e}")
+        return str(e)
+
+def write_function_workbooks(jobs, month, year, number_of_days, workers=None, logs=None):
+    """
+    Ghi các file Excel theo Group Function.
+    jobs: list (filepath, func, part). Trả về list lỗi (None nếu thành công) theo đúng thứ tự jobs.
+
+    Nếu EXPORT_WORKERS > 1, mỗi file được ghi trong 1 process riêng (ProcessPoolExecutor).
+    Process con được tạo bằng 'spawn' (không fork server Streamlit đang chạy nhiều thread);
+    nếu pool lỗi thì ghi tuần tự và thêm cảnh báo vào logs (nếu có).
+    """
+    workers = EXPORT_WORKERS if workers is None else workers
+    payload = [(filepath, func, part, month, year, number_of_days) for filepath, func, part in jobs]
+    try:
+        workers = int(workers or 1)
+    except (TypeError, ValueError):
+        workers = 1
+
+    if workers > 1 and len(payload) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(payload)), mp_context=multiprocessing.get_context('spawn')) as executor:
+                return list(executor.map(_write_function_workbook_job, payload))
+        except Exception as e:
+            # Pool itself failed (e.g. broken worker): fall back to sequential writing
+            if logs is not None: logs.append(f"⚠️ Ghi song song lỗi ({e}), đã chuyển sang ghi tuần tự")
+
+    return [_write_function_workbook_job(job) for job in payload]
+
+# ==========================================
+# 2.1. CHỈ MỤC TÊN FILE PDF
+# ==========================================
+
+def clean_float_str(s):
+    """Chuẩn hóa số hóa đơn/mẫu số đọc từ Excel (bỏ đuôi '.0', 'nan')."""
+    if not s or str(s).lower() == 'nan': return ""
+    s = str(s).strip()
+    if s.endswith('.0'): return s[:-2]
+    return s
+
+class PdfFilenameIndex:
+    """
+    Chỉ mục tên file PDF, xây dựng 1 lần cho mỗi lượt phân phối.
+    Tên file được đưa vào chỉ mục theo các cụm 3 ký tự liên tiếp: với 1 mẫu cần tìm, chỉ các
+    file chứa cụm hiếm nhất của mẫu mới được kiểm tra lại bằng phép 'mẫu in tên file' như logic
+    cũ -> kết quả giống hệt quét cả danh sách, không phải duyệt mọi file cho từng hóa đơn.
+
+    Thứ tự ưu tiên giữ nguyên như logic cũ (mẫu nằm ở đâu trong tên file cũng được):
+      1. strict   : '{mau_so}_{ky_hieu}_{inv}'
+      2. segment  : '_{inv}_'
+      3. prefix   : '{inv}_'
+      4. relaxed  : số hóa đơn dài (> 4 ký tự) nằm trong tên file,
+                    hoặc số ngắn đứng cuối tên file ('_{inv}.pdf')
+    """
+
+    LEVELS = ('strict', 'segment', 'prefix', 'relaxed')
+    MIN_RELAXED_LEN = 5
+    GRAM = 3
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self._order = {f: i for i, f in enumerate(self.filenames)}
+        self._removed = set()
+        self._grams = {}
+        for f in self.filenames:
+            for gram in {f[i:i + self.GRAM] for i in range(len(f) - self.GRAM + 1)}:
+                self._grams.setdefault(gram, []).append(f)
+
+    def __len__(self):
+        return len(self.filenames) - len(self._removed)
+
+    def discard(self, filename):
+        """Loại file khỏi chỉ mục (vd: đã dùng cho hóa đơn Discount)."""
+        if filename in self._order: self._removed.add(filename)
+
+    def _alive(self, candidates):
+        return [f for f in dict.fromkeys(candidates) if f not in self._removed]
+
+    def _containing(self, pattern):
+        """Các file có pattern trong tên (pattern in f), theo thứ tự thư mục."""
+        if len(pattern) < self.GRAM:
+            pool = self.filenames
+        else:
+            pool = min((self._grams.get(pattern[i:i + self.GRAM], ()) for i in range(len(pattern) - self.GRAM + 1)), key=len)
+        return [f for f in pool if pattern in f]
+
+    def _candidates(self, level, inv_num, mau_so, ky_hieu, short_relaxed):
+        if level == 'strict':
+            if not (mau_so and ky_hieu): return []
+            return self._containing(f"{mau_so}_{ky_hieu}_{inv_num}")
+        if level == 'segment':
+            return self._containing(f"_{inv_num}_")
+        if level == 'prefix':
+            return self._containing(f"{inv_num}_")
+        if len(inv_num) >= self.MIN_RELAXED_LEN:
+            return self._containing(inv_num)
+        if short_relaxed:
+            # '_{inv}_' / '{inv}_' đã không khớp ở các mức trên -> chỉ còn dạng '..._{inv}.pdf'
+            return [f for f in self._containing(f"_{inv_num}.pdf") if f.endswith(f"_{inv_num}.pdf")]
+        return []
+
+    def lookup(self, inv_num, mau_so="", ky_hieu="", relaxed=True, short_relaxed=True):
+        """
+        Tìm file PDF cho 1 hóa đơn.
+        Trả về (tên file | None, mức khớp, danh sách ứng viên). Nếu có nhiều
+        hơn 1 ứng viên ở cùng mức thì hóa đơn bị xem là khớp mơ hồ; file đầu
+        tiên (theo thứ tự thư mục) vẫn được chọn để giữ hành vi cũ.
+        """
+        inv_num = clean_float_str(inv_num)
+        if not inv_num: return None, None, []
+        mau_so = clean_float_str(mau_so)
+        ky_hieu = clean_float_str(ky_hieu)
+
+        for level in self.LEVELS:
+            if level == 'relaxed' and not relaxed: break
+            found = self._alive(self._candidates(level, inv_num, mau_so, ky_hieu, short_relaxed))
+            if found:
+                found.sort(key=self._order.get)
+                return found[0], level, found
+        return None, None, []
+
+def format_ambiguous_log(ambiguous, limit=5):
+    """Tạo log cảnh báo cho các hóa đơn khớp nhiều file PDF."""
+    if not ambiguous: return None
+    details = [f"{inv} -> {', '.join(files[:3])}{' ...' if len(files) > 3 else ''}" for inv, files in ambiguous[:limit]]
+    return f"⚠️ {len(ambiguous)} hóa đơn khớp nhiều file PDF (đã chọn file đầu tiên). VD: {'; '.join(details)}"
+
+# ==========================================
+# 2.2. ĐỐI CHIẾU HÓA ĐƠN - PDF
+# ==========================================
+
+def dataframe_fingerprint(df, columns=None):
+    """Dấu vân tay (hash) của Dataframe, dùng làm khóa cache giữa các lần rerun."""
+    if df is None: return ""
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    row_hash = pd.util.hash_pandas_object(df, index=True).values
+    h = hashlib.sha256(row_hash.tobytes())
+    h.update(repr(list(df.columns)).encode('utf-8'))
+    return h.hexdigest()
+
+def get_dir_mtime(path):
+    """mtime của thư mục (thay đổi khi thêm/xóa file), 0 nếu không tồn tại."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def clean_invoice_series(s):
+    """Bản vector hóa của clean_float_str cho cả cột."""
+    s = s.dropna().astype(str).str.strip()
+    s = s.str.replace(r'\.0$', '', regex=True)
+    return s[(s != '') & (s.str.lower() != 'nan')]
+
+def report_invoice_series(df_report):
+    """{số hóa đơn: (mẫu số, ký hiệu)} theo báo cáo, làm sạch như distribute_all_files_logic (dòng đầu tiên thắng)."""
+    if df_report is None or COL_ADJUSTED_INVOICE_REPORT not in df_report.columns: return {}
+    blank = pd.Series("", index=df_report.index)
+    series = {}
+    for inv, mau_so, ky_hieu in zip(df_report[COL_ADJUSTED_INVOICE_REPORT], df_report.get('Mẫu số', blank), df_report.get('Ký hiệu', blank)):
+        inv = clean_float_str(inv)
+        ky_hieu = str(ky_hieu).strip()
+        if inv: series.setdefault(inv, (clean_float_str(mau_so), "" if ky_hieu.lower() == 'nan' else ky_hieu))
+    return series
+
+def reconcile_invoices_with_pdfs(df_proc, pdf_files, df_report=None):
+    """
+    Đối chiếu hóa đơn trong dữ liệu với các file PDF.
+    "Tìm thấy" = PdfFilenameIndex.lookup khớp, cùng quy tắc (và mẫu số / ký hiệu lấy từ df_report)
+    như distribute_all_files_logic, nên bảng đối chiếu và lượt phân phối luôn khớp nhau.
+    Trả về (bảng tổng hợp theo Group Function, danh sách hóa đơn thiếu PDF).
+    """
+    funcs = df_proc[COL_GROUP_FUNCTION]
+    all_funcs = sorted(funcs.dropna().unique())
+
+    # Số HĐ (Excel): booking code duy nhất theo function
+    if COL_BOOKING_CODE in df_proc.columns:
+        bk = df_proc[COL_BOOKING_CODE].dropna().astype(str).str.strip()
+        bk = pd.DataFrame({COL_GROUP_FUNCTION: funcs.loc[bk.index], 'item': bk})
+        count_excel = bk[bk['item'] != ''].groupby(COL_GROUP_FUNCTION, observed=True)['item'].nunique()
+    else:
+        count_excel = pd.Series(dtype='int64')
+
+    # Các mã cần kiểm tra PDF (ưu tiên số hóa đơn)
+    match_col = COL_INVOICE_NUM if COL_INVOICE_NUM in df_proc.columns else COL_BOOKING_CODE
+    if pdf_files and match_col in df_proc.columns:
+        items = clean_invoice_series(df_proc[match_col])
+        items = pd.DataFrame({COL_GROUP_FUNCTION: funcs.loc[items.index], 'item': items})
+        items = items.dropna(subset=[COL_GROUP_FUNCTION]).drop_duplicates()
+
+        pdf_index = PdfFilenameIndex(pdf_files)
+        series = report_invoice_series(df_report)
+        found = {inv: pdf_index.lookup(inv, *series.get(inv, ("", "")))[0] is not None for inv in items['item'].unique()}
+        items['found'] = items['item'].map(found).astype(bool)
+
+        count_pdf = items[items['found']].groupby(COL_GROUP_FUNCTION, observed=True)['item'].nunique()
+        df_missing = items.loc[~items['found'], [COL_GROUP_FUNCTION, 'item']].rename(columns={'item': 'Hóa đơn thiếu PDF'})
+    else:
+        count_pdf = pd.Series(dtype='int64')
+        df_missing = pd.DataFrame(columns=[COL_GROUP_FUNCTION, 'Hóa đơn thiếu PDF'])
+
+    df_summary = pd.DataFrame({COL_GROUP_FUNCTION: all_funcs})
+    df_summary['Số HĐ (Excel)'] = df_summary[COL_GROUP_FUNCTION].map(count_excel).fillna(0).astype(int)
+    df_summary['PDF Tìm Thấy'] = df_summary[COL_GROUP_FUNCTION].map(count_pdf).fillna(0).astype(int)
+
+    if not pdf_files:
+        df_summary['Trạng Thái'] = "⚪ Chưa có PDF"
+    else:
+        full = (df_summary['PDF Tìm Thấy'] >= df_summary['Số HĐ (Excel)']) & (df_summary['Số HĐ (Excel)'] > 0)
+        partial = df_summary['PDF Tìm Thấy'] > 0
+        df_summary['Trạng Thái'] = "❌ Không tìm thấy"
+        df_summary.loc[partial, 'Trạng Thái'] = "⚠️ Thiếu"
+        df_summary.loc[full, 'Trạng Thái'] = "✅ Đủ"
+
+    return df_summary, df_missing.reset_index(drop=True)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_reconcile_invoices(data_fingerprint, pdf_dir, pdf_dir_mtime, _df_proc, _df_report=None):
+    """Cache kết quả đối chiếu theo (fingerprint dữ liệu + báo cáo, mtime thư mục PDF)."""
+    pdf_files = []
+    if os.path.exists(pdf_dir):
+        try:
+            pdf_files = [f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf')]
+        except: pass
+    df_summary, df_missing = reconcile_invoices_with_pdfs(_df_proc, pdf_files, _df_report)
+    return df_summary, df_missing, len(pdf_files)
+
+# ==========================================
+# 2.3. FILE TẠM THEO PHIÊN & ĐÓNG GÓI ZIP
+# ==========================================
+
+def get_session_temp_dir():
+    """
+    Thư mục tạm riêng cho phiên làm việc hiện tại (lưu file Zip kết quả trên đĩa
+    thay vì giữ bytes trong session_state). TemporaryDirectory tự xóa thư mục khi
+    phiên kết thúc (session_state bị thu hồi) hoặc khi tắt ứng dụng.
+    """
+    holder = st.session_state.get('_session_temp_dir')
+    if holder is None or not os.path.isdir(holder.name):
+        holder = tempfile.TemporaryDirectory(prefix="grab_admin_")
+        st.session_state['_session_temp_dir'] = holder
+    return holder.name
+
+def session_file_path(filename):
+    """Đường dẫn file trong thư mục tạm của phiên (ghi đè lần xuất trước cùng tên)."""
+    return os.path.join(get_session_temp_dir(), filename)
+
+def read_file_bytes(path):
+    """
+    Nội dung file cho st.download_button(data=lambda: ...): chỉ đọc khi người dùng bấm tải.
+    Truyền file handle trực tiếp thì Streamlit đọc toàn bộ file vào bộ nhớ ở mỗi lần rerun.
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def zip_compress_type(filename):
+    """Chọn kiểu nén theo phần mở rộng: file đã nén sẵn thì chỉ lưu, còn lại Deflate."""
+    return zipfile.ZIP_STORED if filename.lower().endswith(ZIP_STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+
+def zip_write_file(zip_file, abs_path, arcname):
+    """Ghi 1 file vào archive theo chính sách nén (mức nén Deflate lấy từ cấu hình)."""
+    compress_type = zip_compress_type(arcname)
+    compresslevel = ZIP_COMPRESSION_LEVEL if compress_type == zipfile.ZIP_DEFLATED else None
+    zip_file.write(abs_path, arcname=arcname, compress_type=compress_type, compresslevel=compresslevel)
+
+def zip_directory(source_dir, zip_target, flat=False, placer=None):
+    """
+    Nén toàn bộ file trong source_dir vào zip_target (đường dẫn hoặc file-like).
+    Các file được ghi trực tiếp từ đĩa vào archive theo từng khối, không đọc toàn bộ vào RAM.
+    flat=True: chỉ giữ tên file (bỏ thư mục con).
+    placer: FilePlacer ở chế độ virtual -> các file "ảo" dưới source_dir được đọc thẳng từ file nguồn.
+    """
+    written = set()
+    with zipfile.ZipFile(zip_target, 'w') as zip_file:
+        for root, dirs, files in os.walk(source_dir):
+            for file in files:
+                abs_path = os.path.join(root, file)
+                arcname = file if flat else os.path.relpath(abs_path, source_dir)
+                zip_write_file(zip_file, abs_path, arcname)
+                written.add(arcname)
+        if placer is not None:
+            for dst, src in placer.virtual_files_under(source_dir):
+                arcname = os.path.basename(dst) if flat else os.path.relpath(dst, source_dir)
+                if arcname in written: continue
+                zip_write_file(zip_file, src, arcname)
+                written.add(arcname)
+    return zip_target
+
+# ==========================================
+# 2.4. ĐẶT FILE PDF VÀO THƯ MỤC PHÂN PHỐI
+# ==========================================
+
+FICLONE = 0x40049409  # ioctl clone toàn bộ file (Btrfs, XFS, bcachefs...)
+
+def reflink_file(src, dst):
+    """Clone file bằng ioctl FICLONE (copy-on-write). Trả về False nếu hệ thống file không hỗ trợ."""
+    if fcntl is None: return False
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        shutil.copystat(src, dst)
+        return True
+    except OSError:
+        try: os.remove(dst)
+        except OSError: pass
         return False
 
+class FilePlacer:
+    """
+    Đặt file nguồn (PDF) vào thư mục đích, thay cho shutil.copy2.
+    - auto: hardlink -> reflink -> copy2 (lấy cách đầu tiên thành công)
+    - hardlink / reflink: thử đúng cách đó, không được thì copy2
+    - copy: luôn copy2 (hành vi cũ)
+    - virtual: không ghi gì ra đĩa, chỉ ghi nhận (đích -> nguồn);
+      zip_directory / create_eml_draft đọc thẳng từ file nguồn khi đóng gói.
+    """
+    MODES = ('auto', 'hardlink', 'reflink', 'copy', 'virtual')
+
+    def __init__(self, mode='auto'):
+        self.mode = mode if mode in self.MODES else 'auto'
+        self.virtual_files = {}
+        self.stats = {}
+
+    def place(self, src, dst):
+        """Đặt src tại dst (ghi đè nếu đã có). Trả về cách đã dùng."""
+        if self.mode == 'virtual':
+            self.virtual_files[os.path.abspath(dst)] = os.path.abspath(src)
+            method = 'virtual'
+        else:
+            if os.path.lexists(dst): os.remove(dst)
+            method = None
+            if self.mode in ('auto', 'hardlink'):
+                try:
+                    os.link(src, dst)
+                    method = 'hardlink'
+                except OSError: pass
+            if method is None and self.mode in ('auto', 'reflink') and reflink_file(src, dst):
+                method = 'reflink'
+            if method is None:
+                shutil.copy2(src, dst)
+                method = 'copy'
+        self.stats[method] = self.stats.get(method, 0) + 1
+        return method
+
+    def virtual_files_under(self, root):
+        """Danh sách (đích, nguồn) của các file ảo nằm dưới thư mục root."""
+        prefix = os.path.abspath(root) + os.sep
+        return [(dst, src) for dst, src in sorted(self.virtual_files.items()) if dst.startswith(prefix)]
+
+    def summary(self):
+        """Dòng log thống kê số file theo từng cách đặt."""
+        if not self.stats: return ""
+        return "📎 Đặt file PDF: " + ", ".join(f"{k}: {v}" for k, v in sorted(self.stats.items()))
+
+# ==========================================
+# 2.5. ĐỌC FILE UPLOAD (ENGINE EXCEL & CACHE THEO NỘI DUNG)
+# ==========================================
+
+EXCEL_READER_ENGINES = ('stream', 'openpyxl', 'calamine', 'auto')
+
+def normalize_header(name):
+    """Chuẩn hóa tên cột như process_input_data (gộp khoảng trắng/xuống dòng)."""
+    return re.sub(r'\s+', ' ', str(name)).strip()
+
+def bang_ke_read_columns():
+    """Các cột Bảng Kê thực sự dùng: IN_COL_BK_* (đổi tên) + cột output giữ nguyên tên."""
+    needed = [IN_COL_BK_BOOKING_ID, IN_COL_BK_GROUP_NAME, IN_COL_BK_VERTICAL, IN_COL_BK_COMPANY_NAME,
+              IN_COL_BK_COST_TRANS, IN_COL_BK_VAT_TRANS, IN_COL_BK_COST_SERV, IN_COL_BK_VAT_SERV, IN_COL_BK_TOTAL]
+    needed += list(OUT_COLS.values())
+    return tuple(sorted({normalize_header(c) for c in needed if c}))
+
+def calamine_available():
+    try:
+        import python_calamine  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def resolve_excel_engine(engine):
+    """auto -> calamine nếu đã cài, ngược lại openpyxl. calamine chưa cài -> openpyxl."""
+    if engine not in EXCEL_READER_ENGINES: engine = 'openpyxl'
+    if engine in ('auto', 'calamine'):
+        return 'calamine' if calamine_available() else 'openpyxl'
+    return engine
+
+def _excel_cell_value(value):
+    """Giống pandas (openpyxl): ô trống -> "", số nguyên dạng float -> int."""
+    if value is None: return ""
+    if isinstance(value, float) and value.is_integer(): return int(value)
+    return value
+
+def _dedup_header(names):
+    """Đánh số tên cột trùng theo quy tắc của pandas: A, A.1, A.2..."""
+    counts, out = {}, []
+    for name in names:
+        if name == "":
+            out.append(name)
+            continue
+        cur = counts.get(name, 0)
+        while cur > 0:
+            counts[name] = cur + 1
+            name = f"{name}.{cur}"
+            cur = counts.get(name, 0)
+        counts[name] = cur + 1
+        out.append(name)
+    return out
+
+_XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_XLSX_ROW, _XLSX_VALUE, _XLSX_INLINE = _XLSX_NS + 'row', _XLSX_NS + 'v', _XLSX_NS + 'is'
+
+def _xlsx_column_index(ref):
+    """'AB12' -> 27 (chỉ số cột tính từ 0)."""
+    idx = 0
+    for ch in ref:
+        if ch <= '9': break
+        idx = idx * 26 + ord(ch) - 64
+    return idx - 1
+
+class _SheetCellReader:
+    """
+    Đọc thẳng XML của 1 sheet (workbook mở bằng openpyxl read-only để lấy shared strings,
+    style ngày tháng, epoch). Khác iter_rows của openpyxl: chỉ giải mã các ô được hỏi tới,
+    các cột không dùng chỉ đi qua bộ parse XML.
+    Giá trị trả về giống openpyxl (data_only=True, values_only=True).
+    """
+
+    def __init__(self, wb, ws):
+        self.source = ws._get_source()
+        self.shared_strings = ws._shared_strings
+        self.date_styles = wb._date_formats
+        self.timedelta_styles = wb._timedelta_formats
+        self.epoch = wb.epoch
+
+    def rows(self):
+        """Yield danh sách phần tử <c> của từng dòng; dòng không có trong file -> []."""
+        expected = 1
+        try:
+            for _, elem in ET.iterparse(self.source):
+                if elem.tag != _XLSX_ROW: continue
+                r = elem.get('r')
+                r = int(float(r)) if r else expected
+                while expected < r:
+                    yield []
+                    expected += 1
+                yield list(elem)
+                expected = r + 1
+                elem.clear()
+        finally:
+            self.source.close()
+
+    def value(self, c):
+        """Giá trị 1 ô <c> (None nếu ô trống)."""
+        t = c.get('t', 'n')
+        if t == 'inlineStr':
+            child = c.find(_XLSX_INLINE)
+            return ''.join(child.itertext()) if child is not None else None
+        v = c.findtext(_XLSX_VALUE) or None
+        if v is None: return None
+        if t == 'n':
+            num = float(v) if ('.' in v or 'E' in v or 'e' in v) else int(v)
+            style = int(c.get('s', 0))
+            if style in self.date_styles:
+                try:
+                    return openpyxl.utils.datetime.from_excel(num, self.epoch, timedelta=style in self.timedelta_styles)
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return num
+        if t == 's': return self.shared_strings[int(v)]
+        if t == 'b': return bool(int(v))
+        if t == 'd': return openpyxl.utils.datetime.from_ISO8601(v)
+        return v
+
+    @staticmethod
+    def columns(cells):
+        """{chỉ số cột: <c>} của 1 dòng (ô thiếu thuộc tính r -> nối tiếp ô trước)."""
+        by_col, col = {}, -1
+        for c in cells:
+            ref = c.get('r')
+            col = _xlsx_column_index(ref) if ref else col + 1
+            by_col[col] = c
+        return by_col
+
+    def row_values(self, cells):
+        """Toàn bộ dòng như pandas: ô trống -> "", cắt các ô trống ở cuối."""
+        by_col = self.columns(cells)
+        values = [""] * (max(by_col) + 1 if by_col else 0)
+        for col, c in by_col.items():
+            values[col] = _excel_cell_value(self.value(c))
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def values_at(self, cells, positions):
+        """Giá trị tại các cột positions. Thường các ô liền nhau từ cột A nên vị trí = chỉ số cột."""
+        n, out, by_col = len(cells), [], None
+        for i in positions:
+            c = cells[i] if i < n else None
+            if c is None or c.get('r') is None or _xlsx_column_index(c.get('r')) != i:
+                if by_col is None: by_col = self.columns(cells)
+                c = by_col.get(i)
+            out.append(_excel_cell_value(self.value(c)) if c is not None else "")
+        return out
+
+def _read_excel_stream(file_obj, sheet_name=0, skiprows=None, nrows=None, header=0, columns=None):
+    """
+    Đọc sheet theo từng dòng từ XML (xem _SheetCellReader), chỉ giải mã các cột có tên
+    (đã chuẩn hóa) thuộc columns (None = tất cả). Kết quả đưa qua TextParser của pandas
+    nên kiểu dữ liệu, NA và tên cột trùng được xử lý giống pd.read_excel.
+    """
+    from pandas.io.parsers import TextParser
+    wb = openpyxl.load_workbook(file_obj, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[sheet_name] if isinstance(sheet_name, int) else wb[sheet_name]
+        reader = _SheetCellReader(wb, ws)
+        rows = reader.rows()
+        header_cells = next(itertools.islice(rows, (skiprows or 0) + (header or 0), None), None)
+        if header_cells is None: return pd.DataFrame()
+        header_row = reader.row_values(header_cells)
+        keep = None
+        if columns is not None:
+            # Tên trùng được đánh số như pandas (A, A.1, ...) trước khi so khớp
+            names = _dedup_header(header_row)
+            wanted = set(columns)
+            keep = [i for i, name in enumerate(names) if name != "" and normalize_header(name) in wanted]
+            if not keep: return pd.DataFrame()
+            header_row = [names[i] for i in keep]
+
+        data, last_with_data = [], -1
+        for cells in rows:
+            if nrows is not None and len(data) >= nrows: break
+            if keep is None:
+                values = reader.row_values(cells)
+                if values: last_with_data = len(data)
+            else:
+                values = reader.values_at(cells, keep)
+                # Dòng trống ở cuối sheet bị bỏ (xét cả các cột không lấy, giống pandas)
+                if any(v != "" for v in values) or any(_excel_cell_value(reader.value(c)) != "" for c in cells):
+                    last_with_data = len(data)
+            data.append(values)
+        rows.close()
+    finally:
+        wb.close()
+
+    data = [header_row] + data[:last_with_data + 1]
+    width = max(len(row) for row in data)
+    data = [row + [""] * (width - len(row)) if len(row) < width else row for row in data]
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+def read_excel_upload(file_obj, engine='openpyxl', sheet_name=0, skiprows=None, nrows=None, header=0, columns=None):
+    """
+    Đọc 1 sheet Excel theo engine cấu hình (EXCEL_READER_ENGINE):
+    - openpyxl (mặc định): pd.read_excel như cũ (parse mọi ô)
+    - stream: parse XML của sheet theo dòng, chỉ giải mã các cột trong columns (None = tất cả).
+      Dựa vào thuộc tính nội bộ của openpyxl; lỗi AttributeError/KeyError/TypeError (openpyxl
+      đổi phiên bản) -> cảnh báo (st.warning) và đọc lại bằng pd.read_excel.
+    - calamine / auto: pd.read_excel(engine='calamine') nếu đã cài python-calamine
+    columns: tên cột đã chuẩn hóa (normalize_header) cần lấy.
+    """
+    engine = resolve_excel_engine(engine)
+    file_obj.seek(0)
+    if engine == 'stream':
+        try:
+            return _read_excel_stream(file_obj, sheet_name, skiprows, nrows, header, columns)
+        except (AttributeError, KeyError, TypeError) as e:
+            st.warning(f"⚠️ Bộ đọc Excel 'stream' lỗi ({e!r}), đã đọc lại bằng openpyxl.")
+            file_obj.seek(0)
+            engine = 'openpyxl'
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        usecols = lambda name: normalize_header(name) in wanted
+    return pd.read_excel(file_obj, sheet_name=sheet_name, skiprows=skiprows, nrows=nrows, header=header,
+                         usecols=usecols, engine='calamine' if engine == 'calamine' else 'openpyxl')
+
+def normalize_columns_standard(df):
+    """Chuẩn hóa header Express/Transport: strip, 'Employee id' / 'Date & Time (GMT+72)' -> tên cấu hình."""
+    # Strip whitespace first
+    df.columns = [str(c).strip() for c in df.columns]
+    
+    rename_map = {}
+    for col in df.columns:
+        c_lower = col.lower()
+        if c_lower == 'employee id':
+            rename_map[col] = IN_COL_ET_EMP_ID # Standardize to Config Value (default 'Employee ID')
+        elif 'date & time' in c_lower and '(gmt' in c_lower:
+            # Capture inconsistent Date Time columns
+            rename_map[col] = IN_COL_ET_TIME # Standardize to Config Value
+    
+    if rename_map:
+        df = df.rename(columns=rename_map)
+    return df
+
+def resolve_column_key(key):
+    """Key cấu hình (IN_COL_* / COL_*) -> tên cột thực tế; chuỗi khác được coi là tên cột."""
+    if key in IN_COLS: return IN_COLS[key]
+    if key in OUT_COLS: return OUT_COLS[key]
+    if re.fullmatch(r'(IN_)?COL_[A-Z0-9_]+', key): return globals().get(key, key)
+    return key
+
+def trip_enrichment_spec():
+    """[(cột nguồn Express/Transport, cột đích Bảng Kê)] theo TRIP_ENRICHMENT (config 'trip_enrichment')."""
+    return [(resolve_column_key(src), resolve_column_key(dst)) for src, dst in TRIP_ENRICHMENT.items()]
+
+def trip_export_read_spec():
+    """
+    Các cột cần đọc từ Express/Transport (Booking ID + cột nguồn của trip_enrichment_spec) + dtype khai báo sẵn:
+    Employee Group / Employee Name / City -> category, Booking ID và các cột text -> string (Arrow),
+    Employee ID để pandas tự nhận (giữ kiểu số nếu có), Date & Time parse sau khi gộp (parse_trip_times).
+    """
+    columns = tuple(dict.fromkeys([IN_COL_ET_BOOKING_ID] + [src for src, _ in trip_enrichment_spec()]))
+    dtypes = ((IN_COL_ET_BOOKING_ID, 'string[pyarrow]'), (IN_COL_ET_EMP_GROUP, 'category'), (IN_COL_ET_EMP_NAME, 'category'),
+              (IN_COL_ET_TRIP_DESC, 'string[pyarrow]'), (IN_COL_ET_PICKUP, 'string[pyarrow]'),
+              (IN_COL_ET_DROPOFF, 'string[pyarrow]'), (IN_COL_ET_CITY, 'category'))
+    return columns, dtypes
+
+def _skip_lines(data, n):
+    """Bỏ n dòng đầu của nội dung file (bytes)."""
+    pos = 0
+    for _ in range(n):
+        nl = data.find(b'\n', pos)
+        if nl < 0: return b''
+        pos = nl + 1
+    return data[pos:]
+
+def read_trip_export_csv(file_obj, skiprows=0, columns=(), dtypes=(), engine='c'):
+    """
+    Đọc CSV Express/Transport chỉ với các cột cấu hình (usecols) và dtype khai báo sẵn.
+    Header được chuẩn hóa như normalize_columns_standard trước khi chọn cột nên chấp nhận
+    các biến thể 'Employee id', 'Date & Time (GMT+72)'...
+    Cột Date & Time luôn trả về dạng chuỗi (parse sau khi gộp Express + Transport, xem parse_trip_times).
+    engine='pyarrow': dùng parser CSV của pyarrow (các dòng skiprows được cắt trước khi parse).
+    """
+    file_obj.seek(0)
+    header = pd.read_csv(file_obj, skiprows=skiprows, nrows=0).columns
+    standard = normalize_columns_standard(pd.DataFrame(columns=header)).columns
+    wanted = set(columns)
+    usecols = [raw for raw, std in zip(header, standard) if std in wanted]
+    dtype_map = dict(dtypes)
+    dtype = {raw: dtype_map[std] for raw, std in zip(header, standard) if std in dtype_map and raw in usecols}
+
+    file_obj.seek(0)
+    if engine == 'pyarrow':
+        data = _skip_lines(file_obj.read(), skiprows)
+        df = pd.read_csv(io.BytesIO(data), usecols=usecols, dtype=dtype, engine='pyarrow')
+    else:
+        df = pd.read_csv(file_obj, skiprows=skiprows, usecols=usecols, dtype=dtype)
+    df = normalize_columns_standard(df)
+
+    if IN_COL_ET_TIME in df.columns and pd.api.types.is_datetime64_any_dtype(df[IN_COL_ET_TIME]):
+        # pyarrow tự nhận chuỗi ISO là timestamp (có offset -> UTC): đưa về chuỗi như engine c
+        times = df[IN_COL_ET_TIME]
+        if isinstance(times.dtype, pd.DatetimeTZDtype): times = times.dt.tz_convert(None)
+        df[IN_COL_ET_TIME] = times.dt.strftime('%Y-%m-%d %H:%M:%S')
+    return df
+
+def parse_trip_times(values):
+    """
+    Date & Time Express/Transport (đã gộp) -> datetime64[ns] nếu toàn bộ giá trị đúng chuẩn ISO
+    (VD: 2024-03-01 08:15:00), ngược lại giữ nguyên chuỗi. Giá trị có offset (…T08:15:00+07:00)
+    được quy về UTC rồi bỏ múi giờ, giống engine pyarrow.
+    """
+    if values.dtype != object: return values
+    try:
+        return pd.to_datetime(values, format='ISO8601', utc=True).dt.tz_convert(None).astype('datetime64[ns]')
+    except (ValueError, TypeError, OverflowError):
+        return values
+
+def file_content_hash(file_obj):
+    """
+    SHA-256 nội dung file upload (UploadedFile hoặc file-like bất kỳ).
+    UploadedFile: nhớ digest trong session theo (file_id, size) để mỗi lần rerun không băm lại cả file.
+    """
+    file_id = getattr(file_obj, 'file_id', None)
+    if file_id is None: return _hash_file_content(file_obj)
+    memo = st.session_state.setdefault('_upload_hash_memo', {})
+    key = (file_id, getattr(file_obj, 'size', None))
+    digest = memo.pop(key, None) or _hash_file_content(file_obj)
+    memo[key] = digest  # dict giữ thứ tự chèn: key vừa dùng đứng cuối
+    while len(memo) > PARSE_CACHE_MAX_ENTRIES:
+        memo.pop(next(iter(memo)))
+    return digest
+
+def _hash_file_content(file_obj):
+    if hasattr(file_obj, 'getvalue'):
+        data = file_obj.getvalue()
+    else:
+        file_obj.seek(0)
+        data = file_obj.read()
+    file_obj.seek(0)
+    return hashlib.sha256(data).hexdigest()
+
+def get_parse_cache_stats():
+    """Số lần đọc qua cache của phiên hiện tại: {'calls', 'miss'} (hit = calls - miss)."""
+    return st.session_state.setdefault('_parse_cache_stats', {'calls': 0, 'miss': 0})
+
+@st.cache_data(show_spinner=False, max_entries=PARSE_CACHE_MAX_ENTRIES)
+def _cached_parse(content_hash, reader, options, _file_obj):
+    """Parse thật sự (chỉ chạy khi cache miss). Khóa cache: hash nội dung + reader + tham số đọc."""
+    get_parse_cache_stats()['miss'] += 1
+    _file_obj.seek(0)
+    if reader == 'excel':
+        return read_excel_upload(_file_obj, **dict(options))
+    if reader == 'trip_csv':
+        return read_trip_export_csv(_file_obj, **dict(options))
+    return pd.read_csv(_file_obj, **dict(options))
+
+def read_upload(file_obj, reader='excel', **options):
+    """
+    Đọc file upload qua cache: cùng nội dung + cùng sheet/skiprows/... -> trả lại DataFrame đã parse.
+    reader: 'excel' (read_excel_upload, engine theo cấu hình), 'trip_csv' (read_trip_export_csv)
+    hoặc 'csv' (pd.read_csv).
+    """
+    get_parse_cache_stats()['calls'] += 1
+    if reader == 'excel':
+        options.setdefault('engine', resolve_excel_engine(EXCEL_READER_ENGINE))
+    elif reader == 'trip_csv':
+        columns, dtypes = trip_export_read_spec()
+        options.setdefault('columns', columns)
+        options.setdefault('dtypes', dtypes)
+        options.setdefault('engine', 'pyarrow' if CSV_READER_ENGINE == 'pyarrow' else 'c')
+    df = _cached_parse(file_content_hash(file_obj), reader, tuple(sorted(options.items())), file_obj)
+    file_obj.seek(0)
+    return df
+
+# ==========================================
+# 2.6. SNAPSHOT PARQUET THEO LẦN CHẠY
+# ==========================================
+
+# Cột lặp giá trị nhiều -> lưu dạng categorical (dictionary-encoded trong Parquet)
+
+def get_snapshot_root():
+    """Thư mục snapshot của user đang đăng nhập (mỗi user có cấu hình cột riêng)."""
+    user = str(st.session_state.get('current_user') or 'default')
+    return os.path.join(SNAPSHOT_DIR, re.sub(r'[^\w.-]', '_', user))
+
+def _arrow_safe_frame(df, categorical_cols=()):
+    """
+    Chuẩn bị Dataframe để ghi Parquet: cột object lẫn kiểu (VD: số + chữ sau khi sửa tay)
+    được chuyển giá trị khác rỗng sang str; các cột categorical_cols chuyển sang category.
+    """
+    import pyarrow as pa
+    out = df.copy()
+    out.columns = [str(c) for c in out.columns]
+    for col in out.columns:
+        if out[col].dtype != object: continue
+        try:
+            pa.array(out[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            out[col] = out[col].map(lambda v: v if pd.isna(v) else str(v))
+    for col in categorical_cols:
+        if col in out.columns: out[col] = out[col].astype('category')
+    return out
+
+def save_run_snapshot(df_processed, df_report, run_id=None, source_files=None):
+    """
+    Lưu df_processed + df_report_mapped dạng Parquet vào <SNAPSHOT_DIR>/<user>/<run_id>/.
+    run_id=None -> tạo mới (thời gian + fingerprint dữ liệu); truyền run_id cũ để ghi đè (VD: sau khi chỉnh sửa).
+    Giữ tối đa SNAPSHOT_MAX_RUNS lần chạy gần nhất. Trả về run_id.
+    """
+    if run_id is None:
+        run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{dataframe_fingerprint(df_processed)[:8]}"
+    run_dir = os.path.join(get_snapshot_root(), run_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    _arrow_safe_frame(df_processed, CATEGORICAL_COLS).to_parquet(os.path.join(run_dir, 'df_processed.parquet'), engine='pyarrow')
+    _arrow_safe_frame(df_report).to_parquet(os.path.join(run_dir, 'df_report_mapped.parquet'), engine='pyarrow')
+
+    meta_path = os.path.join(run_dir, 'meta.json')
+    if source_files is None and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                source_files = json.load(f).get('source_files')
+        except (OSError, ValueError):
+            pass
+    try:
+        month_label = pd.to_datetime(df_processed[COL_TIME], errors='coerce').max().strftime('%m/%Y')
+    except Exception:
+        month_label = ""
+    meta = {
+        'run_id': run_id,
+        'saved_at': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+        'month': month_label,
+        'rows': int(len(df_processed)),
+        'report_rows': int(len(df_report)),
+        'source_files': list(source_files or []),
+    }
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=4, ensure_ascii=False)
+
+    for old in list_run_snapshots()[SNAPSHOT_MAX_RUNS:]:
+        shutil.rmtree(os.path.join(get_snapshot_root(), old['run_id']), ignore_errors=True)
+    return run_id
+
+def list_run_snapshots():
+    """Danh sách meta các lần chạy đã lưu, mới nhất trước."""
+    root = get_snapshot_root()
+    if not os.path.isdir(root): return []
+    runs = []
+    for run_id in os.listdir(root):
+        try:
+            with open(os.path.join(root, run_id, 'meta.json'), 'r', encoding='utf-8') as f:
+                runs.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(runs, key=lambda m: m.get('run_id', ''), reverse=True)
+
+def load_run_snapshot(run_id):
+    """Đọc lại (df_processed, df_report_mapped) của 1 lần chạy."""
+    run_dir = os.path.join(get_snapshot_root(), run_id)
+    df_processed = pd.read_parquet(os.path.join(run_dir, 'df_processed.parquet'), engine='pyarrow')
+    df_report = pd.read_parquet(os.path.join(run_dir, 'df_report_mapped.parquet'), engine='pyarrow')
+    # Snapshot cũ có thể thiếu category ở 1 số cột
+    return categorize_columns(df_processed), df_report
+
+# ==========================================
+# 2.7. CHUẨN HÓA ĐỊA CHỈ & SUY RA THÀNH PHỐ
+# ==========================================
+
+ADDRESS_COLS = (COL_PICKUP, COL_DROPOFF)
+ADDRESS_FOLD_MEMO_MAX = 200_000  # số địa chỉ tối đa giữ trong memo của phiên
+FOLD_DELIMITER = '|'  # dấu câu ngăn cách (',', '.', '(' ...) -> từ khóa không khớp vắt qua
+_COMBINING_MARKS_RE = re.compile(r'[\u0300-\u036f]')
+_JOINER_PUNCT = "-_/'"  # nối chữ trong 1 tên ('Ha-Noi') -> khoảng trắng
+_NON_WORD_RE = re.compile(r'[^\w\s' + re.escape(_JOINER_PUNCT) + r']+')
+_JOINER_RE = re.compile(r'[\s' + re.escape(_JOINER_PUNCT) + r']+')
+_DELIMITER_RUN_RE = re.compile(r' ?\|[ |]*')
+_NON_ASCII_BASE_RE = re.compile(r'[^\x00-\x7f\u0300-\u036f]')
+_ASCII_PUNCT_FOLD = bytes.maketrans(
+    string.punctuation.encode(),
+    bytes(ord(' ') if c in _JOINER_PUNCT else ord(FOLD_DELIMITER) for c in string.punctuation))
+
+def _collapse_fold(text):
+    text = ' '.join(text.split())
+    if FOLD_DELIMITER in text: text = _DELIMITER_RUN_RE.sub(FOLD_DELIMITER, text).strip(FOLD_DELIMITER + ' ')
+    return text
+
+def fold_text(text):
+    """
+    Chữ thường, bỏ dấu tiếng Việt (đ -> d), gộp khoảng trắng: 'TP. Hà  Nội' -> 'tp|ha noi'.
+    '-', '_', '/', "'" -> khoảng trắng; dấu câu khác -> FOLD_DELIMITER, nên 'Vĩnh Long, An Giang'
+    -> 'vinh long|an giang' không chứa 'long an'.
+    """
+    text = unicodedata.normalize('NFD', str(text).lower().replace('đ', 'd'))
+    if not _NON_ASCII_BASE_RE.search(text):
+        # Nhanh: sau NFD chỉ còn ASCII + dấu kết hợp (chữ tiếng Việt) -> encode ascii là bỏ dấu
+        return _collapse_fold(text.encode('ascii', 'ignore').translate(_ASCII_PUNCT_FOLD).decode())
+    text = _NON_WORD_RE.sub(FOLD_DELIMITER, _COMBINING_MARKS_RE.sub('', text))
+    return _collapse_fold(_JOINER_RE.sub(' ', text))
+
+def address_fold_memo():
+    """Memo {địa chỉ gốc: địa chỉ đã chuẩn hóa} dùng chung trong phiên, tối đa ADDRESS_FOLD_MEMO_MAX địa chỉ."""
+    return st.session_state.setdefault('_address_fold_memo', {})
+
+def normalize_address_column(values, memo=None):
+    """
+    Bản chuẩn hóa (fold_text) của 1 cột địa chỉ, dạng category. Mỗi địa chỉ khác nhau chỉ chuẩn hóa 1 lần.
+    memo: dict dùng lại giữa các lần gọi (mặc định: memo của phiên; địa chỉ cũ nhất bị bỏ khi vượt giới hạn).
+    """
+    bounded = memo is None
+    memo = address_fold_memo() if memo is None else memo
+    codes, uniques = pd.factorize(values)
+    folded = []
+    for u in uniques:
+        if u not in memo: memo[u] = fold_text(u)
+        folded.append(memo[u])
+    if bounded and len(memo) > ADDRESS_FOLD_MEMO_MAX:
+        for key in list(itertools.islice(memo, len(memo) - ADDRESS_FOLD_MEMO_MAX)): del memo[key]
+    cat_codes, categories = pd.factorize(pd.Index(folded, dtype=object))
+    cat_codes = np.append(cat_codes, -1)  # code -1 (NaN) -> phần tử cuối
+    return pd.Series(pd.Categorical.from_codes(cat_codes[codes], categories), index=values.index, name=values.name)
+
+def normalize_address_frame(df, memo=None):
+    """Các cột địa chỉ (ADDRESS_COLS) có trong df, đã chuẩn hóa."""
+    return pd.DataFrame({col: normalize_address_column(df[col], memo) for col in ADDRESS_COLS if col in df.columns}, index=df.index)
+
+def remember_folded_frame(df, folded):
+    """Lưu bản địa chỉ đã chuẩn hóa kèm df (df_processed) trong phiên."""
+    st.session_state['_folded_frame'] = (df, folded)
+    return folded
+
+def get_folded_frame(df):
+    """
+    Các cột đã chuẩn hóa (category) lưu kèm df: cột địa chỉ tính 1 lần lúc nạp dữ liệu
+    (kết quả của process_input_data / set_preview_frame), Tab Lọc và bộ lọc xem trước đọc lại từ đây.
+    df được thay bằng bản mới (sửa tay, snapshot) -> tính lại qua memo của phiên.
+    """
+    memo = st.session_state.get('_folded_frame')
+    if memo is not None and memo[0] is df: return memo[1]
+    return remember_folded_frame(df, normalize_address_frame(df))
+
+def folded_column(df, col):
+    """Bản chuẩn hóa của 1 cột df từ get_folded_frame; cột không phải địa chỉ tính lần đầu rồi giữ lại."""
+    folded = get_folded_frame(df)
+    if col not in folded.columns: folded[col] = normalize_address_column(df[col], memo={})
+    return folded[col]
+
+def folded_contains(normalized, query):
+    """Mask: cột địa chỉ đã chuẩn hóa chứa query (chuẩn hóa cùng cách) — 'ha noi' khớp 'Hà Nội'. Chỉ quét các giá trị khác nhau."""
+    query = fold_text(query)
+    hits = np.append(normalized.cat.categories.str.contains(query, regex=False), False)
+    return pd.Series(hits[normalized.cat.codes.to_numpy()], index=normalized.index)
+
+def exact_address_text(text):
+    """Địa chỉ chữ thường, giữ dấu (NFC) — so khớp từ khóa 1 chữ của CityExtractor."""
+    return unicodedata.normalize('NFC', str(text).lower())
+
+class _KeywordSet:
+    """
+    1 nhóm từ khóa của CityExtractor (kèm hạng trong bảng), biên dịch thành 1 regex alternation.
+    ranks() chạy trên danh sách văn bản khác nhau bằng automaton RE2 của pyarrow (tìm từ khóa
+    trái nhất); chỉ văn bản còn chứa từ khóa ưu tiên hơn từ khóa trái nhất mới xét lại bằng Python.
+    """
+
+    def __init__(self, keys, ranks):
+        self.keys = list(keys)
+        self._rank = dict(zip(self.keys, ranks))
+        # Cùng vị trí bắt đầu: alternation thử theo thứ tự bảng -> từ khóa ưu tiên nhất
+        self._alternation = '|'.join(re.escape(key) for key in self.keys)
+        self._pattern = re.compile(f"(?=({self._alternation}))") if self.keys else None
+
+    def best_rank(self, text):
+        """Hạng nhỏ nhất trong các từ khóa có trong text, None nếu không có."""
+        # Lookahead -> duyệt mọi vị trí (kể cả từ khóa chồng lấn nhau)
+        best = None
+        for m in self._pattern.finditer(text) if self._pattern else ():
+            rank = self._rank[m.group(1)]
+            if best is None or rank < best:
+                best = rank
+                if best == 0: break
+        return best
+
+    def ranks(self, texts, no_match):
+        """Hạng theo từng văn bản (None -> no_match), thêm 1 phần tử no_match ở cuối cho mã -1 (NaN)."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        result = np.full(len(texts) + 1, no_match)
+        if not self.keys or not texts: return result
+        arr = pa.array(texts, type=pa.string())
+        leftmost = pc.extract_regex(arr, f"(?P<key>{self._alternation})").field('key')
+        first = pd.Series(leftmost.to_numpy(zero_copy_only=False), dtype=object).map(self._rank)
+        result[:len(texts)] = first.fillna(no_match).to_numpy(dtype=np.int64)
+        # Từ khóa trái nhất có hạng r: kiểm tra nhanh xem có từ khóa hạng < r không
+        for rank in np.unique(result[:len(texts)]):
+            higher = [key for key in self.keys if self._rank[key] < rank]
+            if not higher or rank == no_match: continue
+            idx = np.flatnonzero(result[:len(texts)] == rank)
+            hit = pc.match_substring_regex(arr.take(pa.array(idx)), '|'.join(map(re.escape, higher))).to_numpy(zero_copy_only=False)
+            for i in idx[hit]:
+                result[i] = self.best_rank(texts[i])
+        return result
+
+class CityExtractor:
+    """
+    Bảng từ khóa thành phố -> thành phố. Ngữ nghĩa giữ nguyên như logic cũ: từ khóa nào
+    đứng trước trong bảng và có trong địa chỉ thì thắng, không phụ thuộc vị trí trong địa chỉ.
+
+    - Từ khóa nhiều chữ so khớp trên địa chỉ đã chuẩn hóa (fold_text) nên 'hà nội' / 'ha noi'
+      là 1 từ khóa và khớp cả 'HÀ  NỘI', 'Ha-Noi'.
+    - Từ khóa 1 chữ ('huế', 'vinh', 'hcm') dễ trùng sau khi bỏ dấu (huế / huệ, vinh / vĩnh)
+      nên so khớp có dấu trên địa chỉ chữ thường (exact_address_text) như logic cũ.
+
+    extract_series chạy trên cả cột: mỗi địa chỉ khác nhau chỉ xét 1 lần (xem _KeywordSet).
+    """
+
+    def __init__(self, keywords):
+        self.keywords = {}  # (1 chữ?, từ khóa đã chuẩn hóa) -> thành phố, theo thứ tự bảng
+        for key, city in keywords.items():
+            folded = fold_text(key)
+            if not folded: continue
+            exact = ' ' not in folded
+            entry = (exact, exact_address_text(key).strip() if exact else folded)
+            if entry not in self.keywords: self.keywords[entry] = city
+        self._cities = list(self.keywords.values())
+        entries = list(self.keywords)
+        self._folded = _KeywordSet([k for e, k in entries if not e], [r for r, (e, _) in enumerate(entries) if not e])
+        self._exact = _KeywordSet([k for e, k in entries if e], [r for r, (e, _) in enumerate(entries) if e])
+
+    def extract(self, address):
+        """Thành phố cho 1 địa chỉ, None nếu không khớp từ khóa nào."""
+        if not isinstance(address, str): return None
+        ranks = [r for r in (self._folded.best_rank(fold_text(address)), self._exact.best_rank(exact_address_text(address))) if r is not None]
+        return self._cities[min(ranks)] if ranks else None
+
+    def extract_series(self, addresses, folded=None):
+        """
+        Áp dụng cho cả cột địa chỉ gốc, trả về Series object (None nếu không khớp).
+        folded: bản normalize_address_column của cùng cột (vd: get_folded_frame) — không chuẩn hóa lại.
+        """
+        if folded is None: folded = normalize_address_column(addresses)
+        no_match = len(self._cities)
+        folded_ranks = self._folded.ranks(list(folded.cat.categories), no_match)
+        codes, uniques = pd.factorize(addresses)
+        exact_ranks = self._exact.ranks([exact_address_text(u) for u in uniques] if self._exact.keys else [], no_match)
+        ranks = folded_ranks[folded.cat.codes.to_numpy()]
+        if self._exact.keys: ranks = np.minimum(ranks, exact_ranks[codes])
+        cities = np.array(self._cities + [None], dtype=object)
+        return pd.Series(cities[ranks], index=addresses.index, dtype=object)
+
+# ==========================================
+# 2.8. XEM TRƯỚC THEO TRANG & XUẤT TĂNG DẦN
+# ==========================================
+
+PREVIEW_EDITOR_KEY = 'preview_editor'
+PREVIEW_ALL_ROWS = "Tất cả"
+
+def ensure_row_ids(df):
+    """Row ID ổn định của bảng xem trước = index (số nguyên, không trùng); reset nếu không thỏa."""
+    if not (pd.api.types.is_integer_dtype(df.index.dtype) and df.index.is_unique):
+        df = df.reset_index(drop=True)
+    return df
+
+def set_preview_frame(df):
+    """Đặt bản dữ liệu đang sửa (df_preview = df_processed) và tăng phiên bản -> view/editor được tạo lại."""
+    df = ensure_row_ids(df)
+    st.session_state['df_preview'] = df
+    st.session_state['df_processed'] = df
+    get_folded_frame(df)
+    st.session_state['preview_version'] = st.session_state.get('preview_version', 0) + 1
+
+def preview_view_ids(df, sort_col=None, ascending=True, filter_col=None, query=""):
+    """
+    Row ID theo thứ tự hiển thị (lọc + sắp xếp phía server, chỉ gửi 1 trang ra trình duyệt).
+    Lọc: giá trị cột chứa query, không phân biệt hoa thường / dấu (so trên các giá trị khác nhau).
+    """
+    view = df
+    if filter_col in df.columns and query:
+        view = view[folded_contains(folded_column(df, filter_col), query)]
+    if sort_col in df.columns:
+        try:
+            view = view.sort_values(sort_col, ascending=ascending, kind='stable', na_position='last')
+        except TypeError:  # cột object lẫn kiểu (số + chữ sau khi sửa tay)
+            view = view.sort_values(sort_col, ascending=ascending, kind='stable', na_position='last', key=lambda c: c.astype(str))
+    return view.index.to_numpy()
+
+def merge_page_edits(df, page_ids, edited_page, delta):
+    """
+    Gộp kết quả st.data_editor của 1 trang vào Dataframe gốc theo row ID.
+    page_ids: ID các dòng của trang theo thứ tự hiển thị; edited_page: Dataframe editor trả về
+    (dòng bị xóa đã bỏ, dòng thêm mới nằm cuối); delta: trạng thái editor (edited/added/deleted rows).
+    Dòng thêm mới nhận ID mới (lớn hơn mọi ID hiện có). Trả về Dataframe mới.
+    """
+    edited = delta.get('edited_rows') or {}
+    deleted = [page_ids[int(p)] for p in delta.get('deleted_rows') or [] if int(p) < len(page_ids)]
+    n_added = len(delta.get('added_rows') or [])
+    if not (edited or deleted or n_added): return df
+
+    df = df.copy()
+    ids = [page_ids[int(p)] for p in edited if int(p) < len(page_ids) and page_ids[int(p)] in edited_page.index]
+    cols = [c for c in df.columns if any(c in changes for changes in edited.values())]
+    if ids and cols:
+        for col in cols:
+            # category -> object để nhận giá trị mới (categorize_columns ép lại ở cuối)
+            if isinstance(df[col].dtype, pd.CategoricalDtype): df[col] = df[col].astype(object)
+        df.loc[ids, cols] = edited_page.loc[ids, cols]
+    if deleted:
+        df = df.drop(index=deleted)
+    if n_added:
+        added = edited_page.iloc[len(edited_page) - n_added:]
+        start = int(df.index.max()) + 1 if len(df) else 0
+        added = added.set_axis(pd.RangeIndex(start, start + n_added))
+        df = pd.concat([editable_frame(df), added.reindex(columns=df.columns)])
+    return categorize_columns(df)
+
+def get_workbook_cache():
+    """
+    Cache file Excel theo Group Function của phiên: {'dir', 'files': {func: (chữ ký, đường dẫn)}}.
+    Chữ ký = (tên file, tháng, năm, số ngày); đổi tháng / thứ tự function -> ghi lại.
+    """
+    cache = st.session_state.get('_workbook_cache')
+    if cache is None or not os.path.isdir(cache['dir']):
+        cache = {'dir': tempfile.mkdtemp(prefix="workbooks_", dir=get_session_temp_dir()), 'files': {}}
+        st.session_state['_workbook_cache'] = cache
+    return cache
+
+def invalidate_workbook_cache(funcs=None):
+    """Bỏ cache của các function (None = toàn bộ, vd: vừa xử lý dữ liệu mới / mở lại snapshot)."""
+    cache = get_workbook_cache()
+    for func in list(cache['files']) if funcs is None else funcs:
+        entry = cache['files'].pop(func, None)
+        if entry and os.path.exists(entry[1]): os.remove(entry[1])
+
+def functions_touched_by_edits(before, delta):
+    """
+    Các Group Function bị ảnh hưởng bởi delta của st.data_editor
+    ({'edited_rows': {vị trí: {cột: giá trị}}, 'added_rows': [...], 'deleted_rows': [...]}),
+    vị trí tính theo Dataframe `before` đưa vào editor. Dòng đổi function -> cả function cũ và mới.
+    """
+    funcs = set()
+    edited = delta.get('edited_rows') or {}
+    if COL_GROUP_FUNCTION in before.columns:
+        positions = [int(p) for p in edited] + [int(p) for p in delta.get('deleted_rows') or []]
+        funcs.update(before[COL_GROUP_FUNCTION].iloc[[p for p in positions if 0 <= p < len(before)]].tolist())
+    funcs.update(changes.get(COL_GROUP_FUNCTION) for changes in edited.values())
+    funcs.update(row.get(COL_GROUP_FUNCTION) for row in delta.get('added_rows') or [])
+    return {f for f in funcs if f is not None and not pd.isna(f)}
+
+def write_function_workbooks_cached(jobs, month, year, number_of_days, cache=None, logs=None):
+    """
+    Như write_function_workbooks, nhưng function nào còn file trong cache với cùng chữ ký
+    thì đặt lại file cũ (hardlink/copy) thay vì ghi mới. File mới ghi được lưu vào cache.
+    Trả về (danh sách lỗi theo jobs, số file dùng lại).
+    """
+    if cache is None: return write_function_workbooks(jobs, month, year, number_of_days, logs=logs), 0
+    placer = FilePlacer()
+    errors, todo = [None] * len(jobs), []
+    for i, (filepath, func, _) in enumerate(jobs):
+        entry = cache['files'].get(func)
+        if entry and entry[0] == (os.path.basename(filepath), month, year, number_of_days) and os.path.exists(entry[1]):
+            try:
+                placer.place(entry[1], filepath)
+                continue
+            except OSError: pass
+        todo.append(i)
+
+    for i, err in zip(todo, write_function_workbooks([jobs[i] for i in todo], month, year, number_of_days, logs=logs)):
+        errors[i] = err
+        filepath, func, _ = jobs[i]
+        if err is not None: continue
+        # Ghi vào cache bằng file mới (os.replace) để không sửa inode đang hardlink ở nơi khác
+        cached = os.path.join(cache['dir'], hashlib.sha1(str(func).encode('utf-8')).hexdigest() + ".xlsx")
+        placer.place(filepath, cached + ".tmp")
+        os.replace(cached + ".tmp", cached)
+        cache['files'][func] = ((os.path.basename(filepath), month, year, number_of_days), cached)
+    return errors, len(jobs) - len(todo)
+
+# ==========================================
+# 2.9. DASHBOARD: CUBE TỔNG HỢP CHI PHÍ
+# ==========================================
+
+# Chiều của cube (ngoài ngày/giờ); cột nào không có trong dữ liệu thì bỏ qua
+CUBE_DIMS = [COL_GROUP, COL_SERVICE, COL_CITY, COL_PAYMENT_METHOD_INVOICE]
+CUBE_DATE = 'Date_Only'
+CUBE_HOUR = 'Hour'
+CUBE_ABS_AMOUNT = 'Abs_Amount'
+CUBE_ROWS = 'Rows'
+CUBE_MONEY_COLS = [COL_TOTAL_AMOUNT, COL_TOTAL_VAT, COL_TOTAL_PRE_TAX]
+DAYS_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def dashboard_source_columns():
+    """Các cột Dashboard đọc từ df_processed (dùng để tính fingerprint của cube)."""
+    return CUBE_DIMS + [COL_EMPLOYEE_NAME, COL_TIME, COL_BOOKING_CODE] + CUBE_MONEY_COLS
+
+def build_dashboard_cube(df):
+    """
+    Tổng hợp df_processed 1 lần cho Dashboard. Trả về (cube, emp_cube):
+    - cube: nhóm × dịch vụ × thành phố × hình thức TT × ngày × giờ, đo tổng tiền / VAT / trước thuế,
+      tổng trị tuyệt đối, số chuyến (mã chuyến khác rỗng) và số dòng.
+    - emp_cube: nhân viên × nhóm × dịch vụ × ngày (None nếu không có cột nhân viên).
+    Giá trị rỗng của chiều được giữ thành 1 ô riêng (dropna=False) để tổng KPI khớp dữ liệu gốc.
+    """
+    dt = pd.to_datetime(df[COL_TIME], dayfirst=True, errors='coerce') if COL_TIME in df.columns \
+        else pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    base = {col: df[col] for col in CUBE_DIMS + [COL_EMPLOYEE_NAME] if col in df.columns}
+    base[CUBE_DATE] = dt.dt.normalize()
+    base[CUBE_HOUR] = dt.dt.hour
+    for col in CUBE_MONEY_COLS:
+        base[col] = pd.to_numeric(df[col], errors='coerce').fillna(0) if col in df.columns else pd.Series(0.0, index=df.index)
+    base[CUBE_ABS_AMOUNT] = base[COL_TOTAL_AMOUNT].abs()
+    base[COL_BOOKING_CODE] = df[COL_BOOKING_CODE].notna() if COL_BOOKING_CODE in df.columns else pd.Series(True, index=df.index)
+    base[CUBE_ROWS] = pd.Series(1, index=df.index)
+    base = pd.DataFrame(base)
+
+    dims = [c for c in CUBE_DIMS if c in base.columns] + [CUBE_DATE, CUBE_HOUR]
+    measures = CUBE_MONEY_COLS + [CUBE_ABS_AMOUNT, COL_BOOKING_CODE, CUBE_ROWS]
+    cube = base.groupby(dims, observed=True, dropna=False, sort=False)[measures].sum().reset_index()
+
+    emp_cube = None
+    if COL_EMPLOYEE_NAME in base.columns:
+        emp_dims = [c for c in [COL_EMPLOYEE_NAME, COL_GROUP, COL_SERVICE] if c in base.columns] + [CUBE_DATE]
+        emp_cube = base.groupby(emp_dims, observed=True, dropna=False, sort=False)[
+            [COL_TOTAL_AMOUNT, COL_BOOKING_CODE, CUBE_ROWS]].sum().reset_index()
+    return cube, emp_cube
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def cached_dashboard_cube(data_fingerprint, _df):
+    """Cache cube Dashboard theo fingerprint dữ liệu (chuyển tab / rerun không tổng hợp lại)."""
+    return build_dashboard_cube(_df)
+
+def get_dashboard_cube(df):
+    """
+    Cube của df đang hiển thị. df_processed luôn được thay bằng object mới khi dữ liệu đổi
+    (không sửa tại chỗ) nên cùng object -> dùng lại ngay, khỏi hash lại cả bảng mỗi lần rerun.
+    """
+    memo = st.session_state.get('_dashboard_cube')
+    if memo is not None and memo[0] is df: return memo[1]
+    result = cached_dashboard_cube(dataframe_fingerprint(df, dashboard_source_columns()), df)
+    st.session_state['_dashboard_cube'] = (df, result)
+    return result
+
+def treemap_frame(cube):
+    """
+    Dữ liệu treemap đã gộp sẵn: 1 dòng / (nhóm, dịch vụ) với tổng chi và tổng trị tuyệt đối
+    (size không nhận số âm). Ô rỗng -> "Unknown Group" / "Unknown Service" (Plotly lỗi với None).
+    """
+    tree = cube[[COL_GROUP, COL_SERVICE, COL_TOTAL_AMOUNT, CUBE_ABS_AMOUNT]].copy()
+    tree[COL_GROUP] = tree[COL_GROUP].astype(object).fillna("Unknown Group")
+    tree[COL_SERVICE] = tree[COL_SERVICE].astype(object).fillna("Unknown Service")
+    tree = cube_rollup(tree, [COL_GROUP, COL_SERVICE], [COL_TOTAL_AMOUNT, CUBE_ABS_AMOUNT])
+    return tree[tree[CUBE_ABS_AMOUNT] > 0].reset_index(drop=True)
+
+def employee_scatter_frame(emp_cube, top_n=DASHBOARD_TOP_EMPLOYEES):
+    """
+    Điểm scatter (nhân viên × nhóm): top_n nhân viên chi nhiều nhất (theo trị tuyệt đối) giữ riêng,
+    còn lại gộp thành 1 điểm "Khác" = trung bình mỗi nhân viên (không kéo lệch trục).
+    Số điểm gửi ra trình duyệt không tăng theo số nhân viên. Size = |Avg_Cost| (size không nhận số âm).
+    """
+    stats = cube_rollup(emp_cube, [COL_EMPLOYEE_NAME, COL_GROUP], [COL_TOTAL_AMOUNT, COL_BOOKING_CODE])
+    stats[COL_EMPLOYEE_NAME] = stats[COL_EMPLOYEE_NAME].astype(object)
+    stats[COL_GROUP] = stats[COL_GROUP].astype(object)
+    stats['Employees'] = 1
+
+    spend = stats.groupby(COL_EMPLOYEE_NAME)[COL_TOTAL_AMOUNT].sum().abs()
+    top = stats[COL_EMPLOYEE_NAME].isin(spend.nlargest(top_n).index)
+    rest = stats[~top]
+    stats = stats[top]
+    if not rest.empty:
+        n_rest = rest[COL_EMPLOYEE_NAME].nunique()
+        others = pd.DataFrame([{
+            COL_EMPLOYEE_NAME: f"Khác ({n_rest:,} nhân viên, TB/người)",
+            COL_GROUP: "Khác",
+            COL_TOTAL_AMOUNT: rest[COL_TOTAL_AMOUNT].sum() / n_rest,
+            COL_BOOKING_CODE: rest[COL_BOOKING_CODE].sum() / n_rest,
+            'Employees': n_rest,
+        }])
+        stats = pd.concat([stats, others], ignore_index=True)
+
+    trips = stats[COL_BOOKING_CODE].where(stats[COL_BOOKING_CODE] > 0)
+    stats['Avg_Cost'] = (stats[COL_TOTAL_AMOUNT] / trips).fillna(0)
+    stats['Size'] = stats['Avg_Cost'].abs()
+    return stats.reset_index(drop=True)
+
+# ==========================================
+# 2.10. CHỈ MỤC LỌC (TAB TRA CỨU & LỌC)
+# ==========================================
+
+# Cột lọc multiselect; cột trong FILTER_STR_COLS hiển thị / so khớp theo chuỗi (str(giá trị))
+FILTER_INDEX_COLS = [COL_GROUP, COL_GROUP_FUNCTION, COL_SERVICE, COL_PAYMENT_METHOD_INVOICE, COL_PAYMENT_TYPE, COL_CITY, COL_EMPLOYEE_NAME]
+FILTER_STR_COLS = [COL_PAYMENT_METHOD_INVOICE, COL_PAYMENT_TYPE, COL_CITY]
+# Ô tìm kiếm: cột mã ngắn dùng chỉ mục trigram (SubstringIndex); cột văn bản tự do (mục đích chuyến,
+# địa chỉ: nhiều giá trị dài khác nhau, posting trigram rất lớn) quét str.contains trên các giá trị khác nhau
+FILTER_TRIGRAM_COLS = [COL_INVOICE_NUM, COL_BOOKING_CODE, COL_EMPLOYEE_ID]
+FILTER_SCAN_COLS = [COL_TRIP_PURPOSE, COL_PICKUP, COL_DROPOFF]
+
+def column_codes(values):
+    """(mã int32 theo dòng, -1 = rỗng; các giá trị khác nhau theo mã). Cột category dùng sẵn mã của nó."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    return codes.astype(np.int32, copy=False), np.asarray(uniques, dtype=object)
+
+class SubstringIndex:
+    """
+    Chỉ mục trigram trên danh sách chuỗi (các giá trị khác nhau của 1 cột, đã chuẩn hóa).
+    Mỗi chuỗi được nối thêm 2 ký tự \\x00 nên trigram ở cuối chuỗi cũng có mặt:
+    query <= 3 ký tự = 1 khoảng khóa liên tiếp (chính xác); dài hơn = giao các posting
+    rồi kiểm tra lại trên ứng viên (các trigram có thể không liền nhau).
+    Khóa trigram = 3 code point x 21 bit trong 1 số int64, posting sắp theo (khóa, mã chuỗi).
+    """
+
+    def __init__(self, values):
+        self.values = np.asarray(values, dtype=object)
+        lengths = np.fromiter((len(v) + 2 for v in self.values), dtype=np.int64, count=len(self.values))
+        starts = np.cumsum(lengths) - lengths
+        cps = np.frombuffer(''.join(v + '\x00\x00' for v in self.values).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        pos = np.flatnonzero(cps[:-2] != 0) if len(cps) > 2 else np.array([], dtype=np.int64)
+        keys = (cps[pos] << 42) | (cps[pos + 1] << 21) | cps[pos + 2]
+        ids = np.searchsorted(starts, pos, side='right') - 1
+        order = np.argsort(keys, kind='stable')  # ids đã tăng dần theo vị trí -> sắp theo (khóa, mã chuỗi)
+        keys, ids = keys[order], ids[order]
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (ids[1:] != ids[:-1])
+        self._keys, self._ids = keys[keep], ids[keep].astype(np.int32)
+
+    def _postings(self, lo, hi):
+        return self._ids[np.searchsorted(self._keys, lo):np.searchsorted(self._keys, hi)]
+
+    def lookup(self, query):
+        """Mã (vị trí trong values) của các chuỗi chứa query (query chuẩn hóa như values)."""
+        if not query: return np.arange(len(self.values))
+        cps = [ord(c) for c in query]
+        if len(cps) <= 3:
+            shift = 21 * (3 - len(cps))
+            lo = sum(c << (42 - 21 * i) for i, c in enumerate(cps))
+            return np.unique(self._postings(lo, lo + (1 << shift)))
+        grams = [(cps[i] << 42) | (cps[i + 1] << 21) | cps[i + 2] for i in range(len(cps) - 2)]
+        postings = sorted((self._postings(g, g + 1) for g in set(grams)), key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if not len(candidates): break
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        return candidates[[query in v for v in self.values[candidates]]] if len(candidates) else candidates
+
+class FilterIndex:
+    """
+    Chỉ mục lọc của 1 bộ dữ liệu, dựng 1 lần: mỗi cột lọc -> mã int32 theo dòng (-1 = rỗng)
+    và bảng nhãn theo mã. Bộ lọc multiselect = tra bảng "nhãn được chọn" theo mã (mask bool),
+    các mask AND với nhau; không copy / lọc Dataframe cho tới khi lấy kết quả cuối.
+    Ô tìm kiếm: dựng sẵn cùng chỉ mục (không dồn vào lần gõ đầu tiên) — SubstringIndex cho
+    FILTER_TRIGRAM_COLS, các giá trị khác nhau đã chuẩn hóa cho FILTER_SCAN_COLS.
+    Chi phí (200k dòng): mỗi cột trigram có 200k mã khác nhau ~0.6 s dựng, ~30 MB posting giữ lại
+    trong phiên; cột quét ~50 ms / lần tìm với 200k mục đích chuyến khác nhau.
+    Mask theo vị trí dòng của Dataframe lúc dựng chỉ mục.
+    """
+
+    def __init__(self, df, columns=FILTER_INDEX_COLS, str_columns=FILTER_STR_COLS,
+                 trigram_columns=FILTER_TRIGRAM_COLS, scan_columns=FILTER_SCAN_COLS):
+        self.df = df
+        self.n = len(df)
+        self.codes, self.labels = {}, {}
+        self._search = {}
+        for col in list(trigram_columns) + list(scan_columns):
+            if col in df.columns: self._search_column(col, trigram=col in trigram_columns)
+        for col in columns:
+            if col not in df.columns: continue
+            codes, labels = column_codes(df[col])
+            if col in str_columns: labels = np.array([str(v) for v in labels], dtype=object)
+            self.codes[col] = codes
+            self.labels[col] = labels
+        times = pd.to_datetime(df[COL_TIME], dayfirst=True, errors='coerce') if COL_TIME in df.columns \
+            else pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+        self.times = times.to_numpy()
+        valid = self.times[~np.isnat(self.times)]
+        self.date_range = (pd.Timestamp(valid.min()).date(), pd.Timestamp(valid.max()).date()) if len(valid) else None
+
+    def options(self, col, mask=None):
+        """Nhãn có xuất hiện trong các dòng thuộc mask (None = mọi dòng), đã sắp xếp."""
+        if col not in self.codes: return []
+        codes = self.codes[col] if mask is None else self.codes[col][mask]
+        present = np.bincount(codes[codes >= 0], minlength=len(self.labels[col])) > 0
+        return sorted(self.labels[col][present])
+
+    def value_mask(self, col, selected):
+        """Mask các dòng có nhãn thuộc selected."""
+        lut = np.zeros(len(self.labels[col]) + 1, dtype=bool)  # ô cuối (mã -1 = rỗng) luôn False
+        lut[:-1] = pd.Index(self.labels[col]).isin(selected)
+        return lut[self.codes[col]]
+
+    def mask(self, selections):
+        """AND các bộ lọc {cột: [nhãn]}; danh sách rỗng / cột không có trong chỉ mục thì bỏ qua."""
+        result = np.ones(self.n, dtype=bool)
+        for col, selected in selections.items():
+            if selected and col in self.codes: result &= self.value_mask(col, selected)
+        return result
+
+    def date_mask(self, start_d, end_d):
+        """Dòng có thời gian trong [start_d, end_d] (theo ngày); thời gian rỗng -> False."""
+        start = np.datetime64(start_d, 'D')
+        return (self.times >= start) & (self.times < np.datetime64(end_d, 'D') + np.timedelta64(1, 'D'))
+
+    def _search_column(self, col, trigram=False):
+        """(mã theo dòng, các giá trị khác nhau đã chuẩn hóa, SubstringIndex hoặc None = quét str.contains)."""
+        entry = self._search.get(col)
+        if entry is None:
+            if col in ADDRESS_COLS:
+                # Địa chỉ: tìm không dấu trên bản chuẩn hóa lưu kèm df (như folded_contains)
+                normalized = folded_column(self.df, col)
+                codes, values = normalized.cat.codes.to_numpy().astype(np.int32), normalized.cat.categories
+            else:
+                codes, uniques = column_codes(self.df[col])
+                values = pd.Index([str(v).lower() for v in uniques], dtype=object)
+            entry = self._search[col] = (codes, values, SubstringIndex(values) if trigram else None)
+        return entry
+
+    def search_mask(self, columns, query):
+        """
+        Dòng có ít nhất 1 cột chứa query (chuỗi con, không phân biệt hoa thường; cột địa chỉ:
+        không phân biệt dấu). Giá trị rỗng không khớp.
+        """
+        result = np.zeros(self.n, dtype=bool)
+        for col in columns:
+            if col not in self.df.columns: continue
+            codes, values, index = self._search_column(col)
+            needle = fold_text(query) if col in ADDRESS_COLS else query.lower()
+            lut = np.zeros(len(values) + 1, dtype=bool)
+            if index is not None: lut[index.lookup(needle)] = True
+            else: lut[:-1] = values.str.contains(needle, regex=False)
+            result |= lut[codes]
+        return result
+
+# Tải kết quả lọc: nhãn -> (đuôi file, mime). CSV / Parquet cho lấy dữ liệu thô số lượng lớn
+FILTER_EXPORT_FORMATS = {
+    "Excel (.xlsx)": ('xlsx', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV (.csv)": ('csv', "text/csv"),
+    "Parquet (.parquet)": ('parquet', "application/vnd.apache.parquet"),
+}
+
+def export_frame_bytes(df, fmt, sheet_name='Filtered_Data'):
+    """Nội dung file tải về của df theo định dạng 'xlsx' / 'csv' (UTF-8 BOM để Excel đọc đúng tiếng Việt) / 'parquet'."""
+    buffer = io.BytesIO()
+    if fmt == 'csv':
+        df.to_csv(buffer, index=False, encoding='utf-8-sig')
+    elif fmt == 'parquet':
+        _arrow_safe_frame(df).to_parquet(buffer, engine='pyarrow', index=False)
+    else:
+        write_frame_xlsx(df, buffer, sheet_name)
+    return buffer.getvalue()
+
+def get_filter_index(df):
+    """FilterIndex của df, giữ trong phiên và dùng lại tới khi df_processed được thay bằng bản mới."""
+    memo = st.session_state.get('_filter_index')
+    if memo is not None and memo[0] is df: return memo[1]
+    index = FilterIndex(df)
+    st.session_state['_filter_index'] = (df, index)
+    return index
+
+def cube_rollup(cube, dims, measures=None):
+    """
+    Gộp cube theo 1 số chiều (tổng các measure). Như groupby trên dữ liệu gốc:
+    ô có chiều rỗng bị bỏ (dropna mặc định), kết quả sắp theo chiều.
+    """
+    if measures is None: measures = [c for c in cube.columns if c not in CUBE_DIMS + [COL_EMPLOYEE_NAME, CUBE_DATE, CUBE_HOUR]]
+    return cube.groupby(dims, observed=True)[measures].sum().reset_index()
+
 # ==========================================
 # 3. HÀM XỬ LÝ CHÍNH
 # ==========================================
 
+def categorize_columns(df, cols=CATEGORICAL_COLS):
+    """Chuyển các cột text lặp lại (CATEGORICAL_COLS) sang category (bỏ qua cột không có / đã là category)."""
+    for col in cols:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+def editable_frame(df):
+    """Bản cho st.data_editor: category -> object để ô vẫn nhập tự do (không bị giới hạn theo danh sách category)."""
+    cat_cols = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    return df.astype({c: object for c in cat_cols}) if cat_cols else df
+
+def booking_id_key(values):
+    """Khóa join Booking ID: chuỗi qua clean_float_str (123 / 123.0 / '123' như nhau; NaN/NA -> "")."""
+    values = pd.Series(values, dtype=object)
+    return values.where(values.notna(), None).map(clean_float_str)
+
+def enrich_with_trip_data(bangKe, combined, spec=None):
+    """
+    Làm giàu Bảng Kê bằng 1 lần left join theo Booking ID với dữ liệu Express/Transport
+    (combined: đã drop trùng, index = Booking ID), lấy mọi cột theo spec (nguồn -> đích).
+    Cột nguồn không có trong file -> cột đích rỗng. Category/string trả về object + NaN.
+    Trả về (bangKe, df_unmatched): df_unmatched = các dòng có Booking ID nhưng không khớp.
+    """
+    spec = trip_enrichment_spec() if spec is None else spec
+    sources = list(dict.fromkeys(src for src, _ in spec if src in combined.columns))
+    # Cả 2 phía cùng khóa chuỗi (Excel có thể đọc Booking ID thành số, CSV là chuỗi)
+    right = combined[sources].set_axis(pd.Index(booking_id_key(combined.index).to_numpy()))
+    right = right[(right.index != "") & ~right.index.duplicated()]
+    key = booking_id_key(bangKe[IN_COL_BK_BOOKING_ID])
+    joined = key.to_frame('_booking_key').merge(
+        right, how='left', left_on='_booking_key', right_index=True, indicator=True
+    ).set_axis(bangKe.index)
+
+    # Diagnostics (trước khi ghi đè các cột gốc, VD: Group Name)
+    unmatched = (key != "") & (joined['_merge'] == 'left_only')
+    diag_names = {IN_COL_BK_BOOKING_ID: COL_BOOKING_CODE, IN_COL_BK_GROUP_NAME: COL_GROUP, IN_COL_BK_VERTICAL: COL_SERVICE,
+                  COL_INVOICE_NUM: COL_INVOICE_NUM, IN_COL_BK_TOTAL: COL_TOTAL_AMOUNT}
+    diag_cols = [c for c in diag_names if c in bangKe.columns]
+    df_unmatched = bangKe.loc[unmatched, diag_cols].rename(columns=diag_names).reset_index(drop=True)
+
+    for src, dst in spec:
+        if src not in joined.columns:
+            bangKe[dst] = None
+            continue
+        values = joined[src]
+        if isinstance(values.dtype, (pd.CategoricalDtype, pd.StringDtype)):
+            values = pd.Series(values.to_numpy(dtype=object, na_value=np.nan), index=values.index)
+        bangKe[dst] = values
+    return bangKe, df_unmatched
+
 def process_input_data(file_bang_ke, file_express, file_transport, file_func, file_report):
     """
     Đọc và xử lý dữ liệu, trả về Dataframe kết quả để review.
+    Trả về (bangKe, report_df, df_unmatched, address_norm) - df_unmatched: Booking ID không có trong
+    Express/Transport; address_norm: các cột địa chỉ đã chuẩn hóa (normalize_address_frame) theo index của bangKe.
     """
     # --- Đọc dữ liệu ---
-    bangKe = pd.read_excel(file_bang_ke, sheet_name=BANG_KE_SHEET_NAME, skiprows=SKIPROWS_BANG_KE)
+    # Parse qua cache theo nội dung file: chạy lại / đổi cấu hình cột không phải đọc lại Excel
+    bangKe = read_upload(file_bang_ke, 'excel', sheet_name=BANG_KE_SHEET_NAME, skiprows=SKIPROWS_BANG_KE, columns=bang_ke_read_columns())
     bangKe.columns = [re.sub(r'\s+', ' ', col).strip() for col in bangKe.columns]
     
-    express = pd.read_csv(file_express, skiprows=SKIPROWS_EXPRESS)
-    transport = pd.read_csv(file_transport, skiprows=SKIPROWS_TRANSPORT)
-
-    # --- Normalize Columns (Fix mismatches between Express & Transport) ---
-    # Express often has 'Employee id' (lowercase) or 'Date & Time (GMT+72)'
-    def normalize_columns_standard(df):
-        # Strip whitespace first
-        df.columns = [str(c).strip() for c in df.columns]
-        
-        rename_map = {}
-        for col in df.columns:
-            c_lower = col.lower()
-            if c_lower == 'employee id':
-                rename_map[col] = IN_COL_ET_EMP_ID # Standardize to Config Value (default 'Employee ID')
-            elif 'date & time' in c_lower and '(gmt' in c_lower:
-                # Capture inconsistent Date Time columns
-                rename_map[col] = IN_COL_ET_TIME # Standardize to Config Value
-        
-        if rename_map:
-            df = df.rename(columns=rename_map)
-        return df
-
-    express = normalize_columns_standard(express)
-    transport = normalize_columns_standard(transport)
+    # Chỉ các cột IN_COL_ET_* với dtype khai báo (header đã chuẩn hóa: 'Employee id', 'Date & Time (GMT+72)'...)
+    express = read_upload(file_express, 'trip_csv', skiprows=SKIPROWS_EXPRESS)
+    transport = read_upload(file_transport, 'trip_csv', skiprows=SKIPROWS_TRANSPORT)
 
-    func_df = pd.read_excel(file_func, sheet_name=GROUP_FUNCTION_APPROVAL_SHEET, skiprows=SKIPROWS_GROUP_FUNCTION_APPROVAL)
-    report_df = pd.read_excel(file_report)
+    func_df = read_upload(file_func, 'excel', sheet_name=GROUP_FUNCTION_APPROVAL_SHEET, skiprows=SKIPROWS_GROUP_FUNCTION_APPROVAL)
+    report_df = read_upload(file_report, 'excel')
 
     # --- Mapping ---
     combined = pd.concat([express, transport], ignore_index=True)
     combined = combined.drop_duplicates(subset=[IN_COL_ET_BOOKING_ID]).set_index(IN_COL_ET_BOOKING_ID)
+    # concat 2 category khác tập giá trị -> object; ép lại category cho bảng tra cứu
+    for col, dtype in trip_export_read_spec()[1]:
+        if col in combined.columns and combined[col].dtype == object: combined[col] = combined[col].astype(dtype)
+    # Parse thời gian sau khi gộp: 2 file cùng là datetime hoặc cùng giữ chuỗi
+    if IN_COL_ET_TIME in combined.columns: combined[IN_COL_ET_TIME] = parse_trip_times(combined[IN_COL_ET_TIME])
 
-    bangKe[COL_EMPLOYEE_ID] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_EMP_ID])
-    bangKe[IN_COL_BK_GROUP_NAME] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_EMP_GROUP])
-    bangKe[COL_EMPLOYEE_NAME] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_EMP_NAME])
-    bangKe[COL_TRIP_PURPOSE] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_TRIP_DESC])
-    bangKe[COL_PICKUP] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_PICKUP])
-    bangKe[COL_DROPOFF] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_DROPOFF])
-    bangKe[COL_TIME] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_TIME])
-    
-    # Map City if exists
-    if IN_COL_ET_CITY in combined.columns:
-        bangKe[COL_CITY] = bangKe[IN_COL_BK_BOOKING_ID].map(combined[IN_COL_ET_CITY])
-    else:
-        bangKe[COL_CITY] = None
-
-    # --- Regex/Keyword Extraction for City (Fallback) ---
-    def extract_city_from_address(address):
-        if not isinstance(address, str): return "Unknown"
-        addr_lower = address.lower()
-        keywords = {
-            'hồ chí minh': 'Ho Chi Minh', 'ho chi minh': 'Ho Chi Minh', 'hcm': 'Ho Chi Minh',
-            'hà nội': 'Hanoi', 'ha noi': 'Hanoi', 'hanoi': 'Hanoi',
-            'đà nẵng': 'Da Nang', 'da nang': 'Da Nang',
-            'cần thơ': 'Can Tho', 'can tho': 'Can Tho',
-            'hải phòng': 'Hai Phong', 'hai phong': 'Hai Phong',
-            'bình dương': 'Binh Duong', 'binh duong': 'Binh Duong',
-            'đồng nai': 'Dong Nai', 'dong nai': 'Dong Nai', 'biên hòa': 'Dong Nai',
-            'khánh hòa': 'Khanh Hoa', 'khanh hoa': 'Khanh Hoa', 'nha trang': 'Khanh Hoa',
-            'bà rịa': 'Ba Ria - Vung Tau', 'vũng tàu': 'Ba Ria - Vung Tau', 'vung tau': 'Ba Ria - Vung Tau',
-            'lâm đồng': 'Lam Dong', 'lam dong': 'Lam Dong', 'đà lạt': 'Lam Dong', 'da lat': 'Lam Dong',
-            'quảng ninh': 'Quang Ninh', 'quang ninh': 'Quang Ninh', 'hạ long': 'Quang Ninh',
-            'long an': 'Long An',
-            'tiền giang': 'Tien Giang', 'tien giang': 'Tien Giang',
-            'bắc ninh': 'Bac Ninh', 'bac ninh': 'Bac Ninh',
-            'thanh hóa': 'Thanh Hoa', 'thanh hoa': 'Thanh Hoa',
-            'nghệ an': 'Nghe An', 'nghe an': 'Nghe An', 'vinh': 'Nghe An',
-            'thừa thiên huế': 'Hue', 'thua thien hue': 'Hue', 'huế': 'Hue',
-            'quảng nam': 'Quang Nam', 'quang nam': 'Quang Nam', 'hội an': 'Quang Nam',
-            'bình định': 'Binh Dinh', 'binh dinh': 'Binh Dinh', 'quy nhơn': 'Binh Dinh'
-        }
-        for key, val in keywords.items():
-            if key in addr_lower: return val
-        return None
+    # 1 left join cho toàn bộ cột làm giàu (xem TRIP_ENRICHMENT)
+    bangKe, df_unmatched = enrich_with_trip_data(bangKe, combined)
+
+    # Chuẩn hóa địa chỉ 1 lần; trả về kèm kết quả để UI lưu (remember_folded_frame) cho Tab Lọc / xem trước
+    address_norm = normalize_address_frame(bangKe, memo={})
 
     # Fill missing or 'Unknown' cities
     mask_need_city = bangKe[COL_CITY].isnull() | (bangKe[COL_CITY] == '') | (bangKe[COL_CITY] == 'Unknown')
     if mask_need_city.any():
-        extracted_cities = bangKe.loc[mask_need_city, COL_PICKUP].apply(extract_city_from_address)
+        # Fallback: suy ra thành phố từ địa chỉ đón (bảng từ khóa CITY_KEYWORDS)
+        extracted_cities = CityExtractor(CITY_KEYWORDS).extract_series(bangKe.loc[mask_need_city, COL_PICKUP], address_norm.loc[mask_need_city, COL_PICKUP])
         bangKe.loc[mask_need_city, COL_CITY] = extracted_cities.fillna("Unknown")
 
     group_portal_map = func_df.set_index(IN_COL_FUNC_GROUP_PORTAL)[IN_COL_FUNC_INVOICE_GROUP]
@@ -713,20 +2534,21 @@ def process_input_data(file_bang_ke, file_express, file_transport, file_func, fi
             if col in bangKe.columns:
                  bangKe.loc[is_discount, col] = -bangKe.loc[is_discount, col].abs()
 
-    return bangKe, report_df
+    bangKe = categorize_columns(bangKe)
+    return bangKe, report_df, df_unmatched, address_norm
 
 
-def generate_output_from_df(bangKe, report_df, file_bang_ke_original):
+def generate_output_from_df(bangKe, report_df, file_bang_ke_original, zip_path=None, workbook_cache=None):
     """
     Nhận Dataframe đã xử lý (và chỉnh sửa), tạo các file Excel và Zip.
+    Nếu có zip_path, file Zip được ghi thẳng ra đĩa và trả về đường dẫn;
+    nếu không, trả về buffer BytesIO như trước.
+    workbook_cache: xem get_workbook_cache — chỉ ghi lại file của function bị sửa (Master luôn ghi lại).
     """
     temp_dir = tempfile.mkdtemp()
     
-    # Lưu file gốc tạm thời để dùng copy sheet Intro
-    bk_path = os.path.join(temp_dir, "BangKe_Original.xlsx")
-    with open(bk_path, "wb") as f: 
-        file_bang_ke_original.seek(0)
-        f.write(file_bang_ke_original.read())
+    # Đọc sheet Intro từ file gốc 1 lần (ghi thẳng vào Master bằng xlsxwriter)
+    intro, intro_warning = load_intro_template(file_bang_ke_original)
 
     # --- Xuất File ---
     try:
@@ -738,76 +2560,51 @@ def generate_output_from_df(bangKe, report_df, file_bang_ke_original):
 
     output_dir = os.path.join(temp_dir, "output")
     os.makedirs(output_dir, exist_ok=True)
-    all_functions = sorted(bangKe[COL_GROUP_FUNCTION].dropna().unique())
-    file_list_log = []
+    partitions, master = partition_for_export(bangKe, report_df)
+    file_list_log = [intro_warning] if intro_warning else []
 
     # Files Con
-    for idx, func in enumerate(all_functions, start=1):
+    jobs = []
+    for idx, func in enumerate(partitions, start=1):
         safe_func_name = str(func).strip().replace("/", "_").replace("\\", "_")
         prefix = f"{idx:03d}"
         filename = f"{prefix}_BK_GRAB_{safe_func_name}_{month}_{year}.xlsx"
-        filepath = os.path.join(output_dir, filename)
-        file_list_log.append(filename)
-        
-        df_func = bangKe[bangKe[COL_GROUP_FUNCTION] == func]
-        df_ck = df_func[df_func[COL_PAYMENT_METHOD_INVOICE] == VAL_PAYMENT_METHOD_TRANSFER]
-        df_tm = df_func[df_func[COL_PAYMENT_METHOD_INVOICE] != VAL_PAYMENT_METHOD_TRANSFER]
-        
-        writer = pd.ExcelWriter(filepath, engine='xlsxwriter')
-        write_and_format_sheet_common(df_ck, f'1. BK {month}.{year} {func}'[:31], 'BẢNG KÊ CÁC CHUYẾN ĐI TRONG THÁNG (CHUYỂN KHOẢN)', writer, month, year, number_of_days, func)
-        write_and_format_sheet_common(df_tm, '2.TM-CK', 'BẢNG KÊ CÁC CHUYẾN ĐI TRONG THÁNG (TM-CK)', writer, month, year, number_of_days, func)
-        
-        write_report_sheet(report_df[report_df[COL_ADJUSTED_INVOICE_REPORT].isin(df_ck[COL_INVOICE_NUM].unique())], 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN (CK)', writer)
-        write_report_sheet(report_df[report_df[COL_ADJUSTED_INVOICE_REPORT].isin(df_tm[COL_INVOICE_NUM].unique())], 'DS Hoa don TM-CK', 'BÁO CÁO HÓA ĐƠN (TM-CK)', writer)
-        writer.close()
+        jobs.append((os.path.join(output_dir, filename), func, partitions[func]))
+    
+    errors, reused = write_function_workbooks_cached(jobs, month, year, number_of_days, workbook_cache, file_list_log)
+    for (filepath, func, _), err in zip(jobs, errors):
+        filename = os.path.basename(filepath)
+        file_list_log.append(filename if err is None else f"❌ {filename}: {err}")
+    if reused: file_list_log.append(f"♻️ Dùng lại {reused}/{len(jobs)} file không thay đổi")
 
     # Master File
     master_filename = f"000_BK_GRAB_MASTER_{month}_{year}.xlsx"
     master_path = os.path.join(output_dir, master_filename)
     file_list_log.append(f"MASTER/{master_filename}")  
-    writer_master = pd.ExcelWriter(master_path, engine='xlsxwriter')
-    
-    master_ck = bangKe[bangKe[COL_PAYMENT_METHOD_INVOICE] == VAL_PAYMENT_METHOD_TRANSFER]
-    master_tm = bangKe[bangKe[COL_PAYMENT_METHOD_INVOICE] != VAL_PAYMENT_METHOD_TRANSFER]
-
-    write_and_format_sheet_common(master_ck, '1. BK', 'BẢNG KÊ TỔNG HỢP', writer_master, month, year, number_of_days, "TẤT CẢ")
-    write_and_format_sheet_common(master_tm, '2.TM-CK', 'BẢNG KÊ TỔNG HỢP (TM-CK)', writer_master, month, year, number_of_days, "TẤT CẢ")
-    
-    write_report_sheet(report_df[report_df[COL_ADJUSTED_INVOICE_REPORT].isin(master_ck[COL_INVOICE_NUM].unique())], 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN TỔNG HỢP (CK)', writer_master)
-    write_report_sheet(report_df[report_df[COL_ADJUSTED_INVOICE_REPORT].isin(master_tm[COL_INVOICE_NUM].unique())], 'DS Hoa don TM-CK', 'BÁO CÁO HÓA ĐƠN TỔNG HỢP (TM-CK)', writer_master)
-    writer_master.close()
-    
-    copy_intro_sheet(bk_path, master_path)
+    master_warning = write_master_workbook(master_path, master, month, year, number_of_days, intro)
+    if master_warning: file_list_log.append(master_warning)
 
     # Zip
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for root, dirs, files in os.walk(output_dir):
-            for file in files:
-                zip_file.write(os.path.join(root, file), file)
+    zip_result = zip_directory(output_dir, zip_path or io.BytesIO(), flat=True)
     
     shutil.rmtree(temp_dir)
-    zip_buffer.seek(0)
-    return zip_buffer, file_list_log
+    if not zip_path: zip_result.seek(0)
+    return zip_result, file_list_log
 
-def distribute_pdfs_logic(df_invoice_list, source_dir, target_base_dir):
+def distribute_pdfs_logic(df_invoice_list, source_dir, target_base_dir, placer=None):
     logs = []
+    placer = placer or FilePlacer()
     if not os.path.exists(source_dir): return [f"❌ Thư mục nguồn không tồn tại: {source_dir}"]
     if not os.path.exists(target_base_dir): os.makedirs(target_base_dir)
     
-    available_files = os.listdir(source_dir)
+    pdf_index = PdfFilenameIndex(os.listdir(source_dir))
     count_success, count_fail = 0, 0
     progress_bar = st.progress(0)
     total = len(df_invoice_list)
     
     # Debug info for first few failures
     debug_failures = []
-    
-    def clean_float_str(s):
-        if not s or str(s).lower() == 'nan': return ""
-        s = str(s).strip()
-        if s.endswith('.0'): return s[:-2]
-        return s
+    ambiguous = []
 
     for idx, row in df_invoice_list.iterrows():
         try:
@@ -821,76 +2618,48 @@ def distribute_pdfs_logic(df_invoice_list, source_dir, target_base_dir):
             
             if not inv_num: continue
             
-            # Construct patterns to try (Strict to Loose)
-            patterns = []
-            if mau_so and ky_hieu:
-                patterns.append(f"{mau_so}_{ky_hieu}_{inv_num}")
-            
-            # Also try just Invoice Number (most common fallback)
-            patterns.append(f"_{inv_num}_") # Middle of string
-            patterns.append(f"{inv_num}_") # Start or specific part
-            
             safe_grp = str(grp).strip().replace(" ", "_").replace("/", "_")
             target_group_path = os.path.join(target_base_dir, safe_grp)
             
             if not os.path.exists(target_group_path): os.makedirs(target_group_path)
             
-            matched_file = None
-            
-            # 1. Try strict match first
-            for p in patterns:
-                for f in available_files:
-                    if p in f:
-                        matched_file = f
-                        break
-                if matched_file: break
-            
-            # 2. Last resort: Check if file *contains* the invoice number as a standalone segment
-            # e.g. "123.pdf" or "..._123_..."
-            if not matched_file:
-                 for f in available_files:
-                     if inv_num in f:
-                         # Validate it's not a partial match like "1234" matching "123"
-                         # Simple check: surround with common delimiters
-                         # But for now, just matching inv_num is better than nothing. 
-                         # Check if it is a whole word or surrounded by _
-                         if f"_{inv_num}_" in f or f.startswith(f"{inv_num}_"):
-                             matched_file = f
-                             break
+            # Strict -> segment -> prefix (the old fallback only re-checked the same delimiters)
+            matched_file, _, candidates = pdf_index.lookup(inv_num, mau_so, ky_hieu, relaxed=False)
+            if len(candidates) > 1: ambiguous.append((inv_num, candidates))
             
             if matched_file:
-                shutil.copy2(os.path.join(source_dir, matched_file), os.path.join(target_group_path, matched_file))
+                placer.place(os.path.join(source_dir, matched_file), os.path.join(target_group_path, matched_file))
                 count_success += 1
             else: 
                 count_fail += 1
                 if len(debug_failures) < 5:
-                    debug_failures.append(f"Inv: {inv_num} | Pat: {patterns}")
+                    debug_failures.append(f"Inv: {inv_num} | Mẫu số: {mau_so} | Ký hiệu: {ky_hieu}")
         except: count_fail += 1
         if idx % 10 == 0: progress_bar.progress(min((idx + 1) / total, 1.0))
             
     progress_bar.progress(1.0)
     logs.append(f"✅ Hoàn tất! Copy thành công: {count_success}, Không tìm thấy: {count_fail}")
+    if placer.summary(): logs.append(placer.summary())
     if debug_failures:
         logs.append(f"🔍 Debug (5 lỗi đầu): {'; '.join(debug_failures)}")
+    ambiguous_log = format_ambiguous_log(ambiguous)
+    if ambiguous_log: logs.append(ambiguous_log)
     return logs
 
-def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_root_dir, file_bang_ke_original, file_function_mapping):
+def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_root_dir, file_bang_ke_original, file_function_mapping, placer=None, workbook_cache=None):
     """
     Hàm tổng hợp: Phân phối Excel, Email và PDF vào từng folder theo Group Function.
+    placer: cách đặt file PDF (mặc định hardlink -> reflink -> copy, xem FilePlacer).
+    workbook_cache: dùng lại file Excel của function không bị sửa (xem get_workbook_cache).
     """
     logs = []
+    placer = placer or FilePlacer()
     if not os.path.exists(source_pdf_dir): return [f"❌ Thư mục nguồn PDF không tồn tại: {source_pdf_dir}"]
     os.makedirs(target_root_dir, exist_ok=True)
     
-    # 1. Prepare Intro Sheet Source
-    temp_dir = tempfile.mkdtemp()
-    bk_path_temp = os.path.join(temp_dir, "BangKe_Original.xlsx")
-    try:
-        file_bang_ke_original.seek(0)
-        with open(bk_path_temp, "wb") as f: 
-            f.write(file_bang_ke_original.read())
-    except Exception as e:
-        return [f"❌ Lỗi sao chép file Bảng Kê gốc: {e}"]
+    # 1. Prepare Intro Sheet Source (read once, written natively into the Master)
+    intro, intro_warning = load_intro_template(file_bang_ke_original)
+    if intro_warning: logs.append(intro_warning)
 
     # 2. Load Email Template & Mapping
     try:
@@ -906,8 +2675,12 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
     if COL_GROUP_FUNCTION not in df_processed.columns:
         return ["❌ Không tìm thấy cột Group Function trong dữ liệu."]
     
-    all_funcs = sorted(df_processed[COL_GROUP_FUNCTION].dropna().unique())
-    available_pdfs = os.listdir(source_pdf_dir)
+    # Split rows per (function, payment method) once instead of re-filtering per function
+    partitions, master = partition_for_export(df_processed, df_report)
+    all_funcs = list(partitions)
+    # Build the filename index once for the whole run (discount + every group)
+    pdf_index = PdfFilenameIndex(os.listdir(source_pdf_dir))
+    ambiguous_pdfs = []
     
     progress_bar = st.progress(0)
     total_steps = len(all_funcs)
@@ -925,27 +2698,15 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
             logs.append(f"ℹ️ Tìm thấy {len(discount_invoices)} hóa đơn Discount (không có Booking Code). Phân phối ra thư mục gốc.")
             
             for inv_num in discount_invoices:
-                matched = None
-                # Try simple matching first
-                patterns = [f"_{inv_num}_", f"{inv_num}_"]
-                for p in patterns:
-                    for f in available_pdfs:
-                        if p in f:
-                            matched = f; break
-                    if matched: break
-                
-                # Heuristic fallback
-                if not matched:
-                    for f in available_pdfs:
-                        if inv_num in f and len(inv_num) > 4:
-                            matched = f; break
+                # Segment/prefix first, heuristic fallback only for long invoice numbers
+                matched, _, candidates = pdf_index.lookup(inv_num, short_relaxed=False)
+                if len(candidates) > 1: ambiguous_pdfs.append((inv_num, candidates))
                 
                 if matched:
                     try:
-                        shutil.copy2(os.path.join(source_pdf_dir, matched), os.path.join(target_root_dir, matched))
-                        # Remove from available_pdfs to avoid processing it again if it matches a group
-                        if matched in available_pdfs:
-                             available_pdfs.remove(matched)
+                        placer.place(os.path.join(source_pdf_dir, matched), os.path.join(target_root_dir, matched))
+                        # Remove from the index to avoid processing it again if it matches a group
+                        pdf_index.discard(matched)
                         count_pdf += 1
                     except Exception as e:
                         logs.append(f"❌ Lỗi copy PDF Discount {matched}: {e}")
@@ -960,36 +2721,29 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
         month, year, number_of_days = 0, 0, 0
         month_year_str = "MM/YYYY"
 
+    # --- A. GENERATE EXCEL (all functions at once, optionally in parallel) ---
+    excel_jobs = []
     for idx, func in enumerate(all_funcs, start=1):
         safe_func_name = str(func).strip().replace("/", "_").replace("\\", "_")
         prefix = f"{idx:03d}"
         # Create Group Folder (Numbered)
-        group_dir_name = f"{prefix}_{safe_func_name}"
-        group_dir = os.path.join(target_root_dir, group_dir_name)
+        group_dir = os.path.join(target_root_dir, f"{prefix}_{safe_func_name}")
         os.makedirs(group_dir, exist_ok=True)
-        
-        # --- A. GENERATE EXCEL ---
-        try:
-            excel_filename = f"{prefix}_BK_GRAB_{safe_func_name}_{month}_{year}.xlsx"
-            excel_path = os.path.join(group_dir, excel_filename)
-            
-            df_func = df_processed[df_processed[COL_GROUP_FUNCTION] == func]
-            df_ck = df_func[df_func[COL_PAYMENT_METHOD_INVOICE] == VAL_PAYMENT_METHOD_TRANSFER]
-            df_tm = df_func[df_func[COL_PAYMENT_METHOD_INVOICE] != VAL_PAYMENT_METHOD_TRANSFER]
-            
-            writer = pd.ExcelWriter(excel_path, engine='xlsxwriter')
-            write_and_format_sheet_common(df_ck, f'1. BK {month}.{year} {func}'[:31], 'BẢNG KÊ CÁC CHUYẾN ĐI TRONG THÁNG (CHUYỂN KHOẢN)', writer, month, year, number_of_days, func)
-            write_and_format_sheet_common(df_tm, '2.TM-CK', 'BẢNG KÊ CÁC CHUYẾN ĐI TRONG THÁNG (TM-CK)', writer, month, year, number_of_days, func)
-            
-            write_report_sheet(df_report[df_report[COL_ADJUSTED_INVOICE_REPORT].isin(df_ck[COL_INVOICE_NUM].unique())], 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN (CK)', writer)
-            write_report_sheet(df_report[df_report[COL_ADJUSTED_INVOICE_REPORT].isin(df_tm[COL_INVOICE_NUM].unique())], 'DS Hoa don TM-CK', 'BÁO CÁO HÓA ĐƠN (TM-CK)', writer)
-            writer.close()
-            
-            # Copy Intro Sheet (Reload workbook not needed for copy_intro_sheet impl above, it uses openpyxl load)
-            # But copy_intro_sheet takes paths.
-            count_excel += 1
-        except Exception as e:
-            logs.append(f"❌ Lỗi tạo Excel cho {func}: {e}")
+        excel_filename = f"{prefix}_BK_GRAB_{safe_func_name}_{month}_{year}.xlsx"
+        excel_jobs.append((os.path.join(group_dir, excel_filename), func, partitions[func]))
+
+    errors, reused = write_function_workbooks_cached(excel_jobs, month, year, number_of_days, workbook_cache, logs)
+    for (_, func, _), err in zip(excel_jobs, errors):
+        if err is None: count_excel += 1
+        else: logs.append(f"❌ Lỗi tạo Excel cho {func}: {err}")
+    if reused: logs.append(f"♻️ Dùng lại {reused}/{len(excel_jobs)} file Excel không thay đổi")
+
+    for idx, func in enumerate(all_funcs, start=1):
+        safe_func_name = str(func).strip().replace("/", "_").replace("\\", "_")
+        prefix = f"{idx:03d}"
+        group_dir = os.path.join(target_root_dir, f"{prefix}_{safe_func_name}")
+        part = partitions[func]
+        df_func = part['all']
 
         # --- B. GENERATE EMAIL ---
         try:
@@ -1043,13 +2797,6 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
 
         # --- C. COPY PDFS ---
         # Reuse logic from distribute_pdfs_logic but scoped to this group
-        # Helper for cleaning
-        def clean_float_str(s):
-            if not s or str(s).lower() == 'nan': return ""
-            s = str(s).strip()
-            if s.endswith('.0'): return s[:-2]
-            return s
-        
         # Map Invoice -> Payment Method from Data (normalize keys)
         inv_pay_map = {}
         has_ck = False
@@ -1073,7 +2820,7 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
         if has_tm: os.makedirs(dir_tm, exist_ok=True)
 
         # Iterate rows in this function only
-        for _, row in df_report[df_report[COL_GROUP_FUNCTION] == func].iterrows():
+        for _, row in part['report_func'].iterrows():
             try:
                 inv_num = clean_float_str(row.get(COL_ADJUSTED_INVOICE_REPORT, ""))
                 mau_so = clean_float_str(row.get('Mẫu số', ""))
@@ -1082,30 +2829,9 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
                 
                 if not inv_num: continue
                 
-                patterns = []
-                if mau_so and ky_hieu: patterns.append(f"{mau_so}_{ky_hieu}_{inv_num}")
-                patterns.append(f"_{inv_num}_")
-                patterns.append(f"{inv_num}_")
-                
-                matched = None
-                for p in patterns:
-                    for f in available_pdfs:
-                        if p in f:
-                            matched = f; break
-                    if matched: break
-                
-                # 2. Relaxed matching
-                if not matched:
-                    for f in available_pdfs:
-                        # Check if invoice number is in file name
-                        if inv_num in f:
-                            # Heuristic: if invoice number is long enough (>4 chars), assume it's unique enough
-                            if len(inv_num) > 4:
-                                matched = f; break
-                            else:
-                                # Short invoice number, be stricter
-                                if f"_{inv_num}_" in f or f.startswith(f"{inv_num}_") or f.endswith(f"_{inv_num}.pdf"):
-                                    matched = f; break
+                # Strict -> segment -> prefix -> relaxed (see PdfFilenameIndex)
+                matched, _, candidates = pdf_index.lookup(inv_num, mau_so, ky_hieu)
+                if len(candidates) > 1: ambiguous_pdfs.append((inv_num, candidates))
                 
                 if matched:
                     # Determine target subfolder based on Payment Method
@@ -1118,7 +2844,7 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
                         if has_tm: target_sub = dir_tm
                     
                     if target_sub:
-                        shutil.copy2(os.path.join(source_pdf_dir, matched), os.path.join(target_sub, matched))
+                        placer.place(os.path.join(source_pdf_dir, matched), os.path.join(target_sub, matched))
                         count_pdf += 1
             except: pass
 
@@ -1129,27 +2855,17 @@ def distribute_all_files_logic(df_processed, df_report, source_pdf_dir, target_r
         master_filename = f"BK_GRAB_MASTER_{month}_{year}.xlsx"
         master_path = os.path.join(target_root_dir, master_filename)
         
-        # Filter data for Master
-        master_ck = df_processed[df_processed[COL_PAYMENT_METHOD_INVOICE] == VAL_PAYMENT_METHOD_TRANSFER]
-        master_tm = df_processed[df_processed[COL_PAYMENT_METHOD_INVOICE] != VAL_PAYMENT_METHOD_TRANSFER]
-
-        writer_master = pd.ExcelWriter(master_path, engine='xlsxwriter')
-        
-        write_and_format_sheet_common(master_ck, '1. BK', 'BẢNG KÊ TỔNG HỢP', writer_master, month, year, number_of_days, "TẤT CẢ")
-        write_and_format_sheet_common(master_tm, '2.TM-CK', 'BẢNG KÊ TỔNG HỢP (TM-CK)', writer_master, month, year, number_of_days, "TẤT CẢ")
-        
-        write_report_sheet(df_report[df_report[COL_ADJUSTED_INVOICE_REPORT].isin(master_ck[COL_INVOICE_NUM].unique())], 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN TỔNG HỢP (CK)', writer_master)
-        write_report_sheet(df_report[df_report[COL_ADJUSTED_INVOICE_REPORT].isin(master_tm[COL_INVOICE_NUM].unique())], 'DS Hoa don TM-CK', 'BÁO CÁO HÓA ĐƠN TỔNG HỢP (TM-CK)', writer_master)
-        writer_master.close()
-        
-        # Copy Intro Sheet to Master
-        copy_intro_sheet(bk_path_temp, master_path)
+        master_warning = write_master_workbook(master_path, master, month, year, number_of_days, intro)
         logs.append(f"✅ Đã tạo Master File: {master_filename}")
+        if master_warning: logs.append(master_warning)
         
     except Exception as e:
         logs.append(f"❌ Lỗi tạo Master File: {e}")
 
-    shutil.rmtree(temp_dir)
+    ambiguous_log = format_ambiguous_log(ambiguous_pdfs)
+    if ambiguous_log: logs.append(ambiguous_log)
+    if placer.summary(): logs.append(placer.summary())
+
     logs.append(f"✅ HOÀN TẤT TOÀN BỘ!")
     logs.append(f"📊 Thống kê: {count_excel} Excel, {count_email} Email, {count_pdf} PDF đã được phân phối.")
     return logs
@@ -1191,11 +2907,32 @@ with st.sidebar:
         if 'files_ok' not in st.session_state: st.session_state['files_ok'] = False
         files_ok = False
         
+    # --- Reopen a saved run (Parquet snapshot) without the raw uploads ---
+    saved_runs = list_run_snapshots()
+    if saved_runs:
+        st.markdown("### 🗂️ Mở Lại Lần Chạy")
+        run_labels = {m['run_id']: f"{m.get('month') or '?'} · {m.get('rows', 0):,} dòng · {m.get('saved_at', '')}" for m in saved_runs}
+        reopen_id = st.selectbox("Snapshot đã lưu", list(run_labels), format_func=run_labels.get, label_visibility="collapsed")
+        if st.button("📂 Mở lại"):
+            try:
+                df_snap, df_rep_snap = load_run_snapshot(reopen_id)
+                set_preview_frame(df_snap)
+                invalidate_workbook_cache()
+                st.session_state['df_report_mapped'] = df_rep_snap
+                st.session_state['snapshot_run_id'] = reopen_id
+                st.session_state.pop('df_unmatched_bookings', None)
+                st.success(f"✅ Đã mở lại: {run_labels[reopen_id]}")
+            except Exception as e:
+                st.error(f"❌ Lỗi mở snapshot: {e}")
+
+    # Filled in at the end of the script, after this run's parses have been counted
+    parse_cache_slot = st.empty()
     st.caption(f"Phiên bản: 1.1.0 | {datetime.now().strftime('%d/%m/%Y')}")
 
 # --- MAIN ---
-if not files_ok:
-    st.info("👋 Vui lòng tải lên đầy đủ dữ liệu để bắt đầu.")
+# A reopened snapshot is enough for the Dashboard/Filter/Distribution tabs
+if not files_ok and 'df_processed' not in st.session_state:
+    st.info("👋 Vui lòng tải lên đầy đủ dữ liệu (hoặc mở lại 1 lần chạy đã lưu) để bắt đầu.")
 else:
     tab_settings, tab_process, tab_filter, tab_pdf, tab_dashboard, tab_email = st.tabs([
         "⚙️ Cấu Hình",
@@ -1221,6 +2958,17 @@ else:
             new_skip_express = c3.number_input("Dữ Liệu Express (Skiprows)", value=SKIPROWS_EXPRESS, min_value=0)
             new_skip_transport = c4.number_input("Dữ Liệu Transport (Skiprows)", value=SKIPROWS_TRANSPORT, min_value=0)
             
+            st.markdown("**Hiệu năng xuất file:**")
+            c5, c6 = st.columns(2)
+            new_zip_level = c6.number_input("Mức nén Zip (Deflate, 0-9)", value=int(ZIP_COMPRESSION_LEVEL), min_value=0, max_value=9, help="Áp dụng cho Excel/HTML. File PDF, Zip, Eml luôn được lưu nguyên (không nén lại).")
+            new_export_workers = c5.number_input("Số process ghi Excel song song", value=min(max(int(EXPORT_WORKERS or 1), 1), os.cpu_count() or 1), min_value=1, max_value=os.cpu_count() or 1, help="1 = ghi tuần tự. > 1: mỗi file Excel theo Group Function được ghi trong 1 process riêng.")
+            c7, c8 = st.columns(2)
+            placement_modes = list(FilePlacer.MODES)
+            new_pdf_placement = c7.selectbox("Cách đặt file PDF khi phân phối", placement_modes, index=placement_modes.index(PDF_PLACEMENT_MODE) if PDF_PLACEMENT_MODE in placement_modes else 0, help="auto: hardlink -> reflink -> copy. virtual: không ghi PDF ra thư mục, đọc thẳng từ file nguồn khi nén Zip.")
+            new_excel_engine = c8.selectbox("Engine đọc Excel", list(EXCEL_READER_ENGINES), index=EXCEL_READER_ENGINES.index(EXCEL_READER_ENGINE) if EXCEL_READER_ENGINE in EXCEL_READER_ENGINES else 0, help="openpyxl: pd.read_excel như cũ (mặc định). stream: parse XML theo dòng, chỉ đọc cột cần dùng (dựa vào nội bộ openpyxl, lỗi thì tự đọc lại bằng openpyxl). calamine/auto: dùng python-calamine nếu đã cài (không có thì dùng openpyxl).")
+            c9, _ = st.columns(2)
+            new_csv_engine = c9.selectbox("Engine đọc CSV (Express/Transport)", ['c', 'pyarrow'], index=1 if CSV_READER_ENGINE == 'pyarrow' else 0, help="c: parser mặc định của pandas. pyarrow: parser CSV đa luồng của Arrow.")
+            
             # Raw Data Previews
             st.markdown("---")
             st.subheader("👀 Xem Trước Dữ Liệu Thô (Raw Previews)")
@@ -1230,7 +2978,7 @@ else:
             with p1:
                 if up_bang_ke:
                     try:
-                        raw_df = pd.read_excel(up_bang_ke, sheet_name=new_bk_sheet, skiprows=new_skip_bk, nrows=5)
+                        raw_df = read_upload(up_bang_ke, 'excel', sheet_name=new_bk_sheet, skiprows=int(new_skip_bk), nrows=5)
                         st.dataframe(raw_df)
                         st.caption(f"File: {up_bang_ke.name} | Sheet: {new_bk_sheet} | Skiprows: {new_skip_bk}")
                     except Exception as e:
@@ -1241,7 +2989,7 @@ else:
             with p2:
                 if up_express:
                     try:
-                        raw_express = pd.read_csv(up_express, skiprows=new_skip_express, nrows=5)
+                        raw_express = read_upload(up_express, 'csv', skiprows=int(new_skip_express), nrows=5)
                         st.dataframe(raw_express)
                         st.caption(f"File: {up_express.name} | Skiprows: {new_skip_express}")
                     except Exception as e:
@@ -1252,7 +3000,7 @@ else:
             with p3:
                 if up_transport:
                     try:
-                        raw_transport = pd.read_csv(up_transport, skiprows=new_skip_transport, nrows=5)
+                        raw_transport = read_upload(up_transport, 'csv', skiprows=int(new_skip_transport), nrows=5)
                         st.dataframe(raw_transport)
                         st.caption(f"File: {up_transport.name} | Skiprows: {new_skip_transport}")
                     except Exception as e:
@@ -1315,6 +3063,11 @@ else:
             new_config['general']['SKIPROWS_BANG_KE'] = int(new_skip_bk)
             new_config['general']['SKIPROWS_EXPRESS'] = int(new_skip_express)
             new_config['general']['SKIPROWS_TRANSPORT'] = int(new_skip_transport)
+            new_config['general']['EXPORT_WORKERS'] = int(new_export_workers)
+            new_config['general']['ZIP_COMPRESSION_LEVEL'] = int(new_zip_level)
+            new_config['general']['PDF_PLACEMENT_MODE'] = new_pdf_placement
+            new_config['general']['EXCEL_READER_ENGINE'] = new_excel_engine
+            new_config['general']['CSV_READER_ENGINE'] = new_csv_engine
             
             # Update Inputs (Merge all tables back)
             new_in_cols = {}
@@ -1340,50 +3093,113 @@ else:
     # --- TAB 2: PROCESS ---
     with tab_process:
         st.header("Xử Lý Dữ Liệu & Tạo Báo Cáo")
-        if st.button("🚀 1. Xử Lý & Xem Trước Dữ Liệu", type="primary"):
+        if 'snapshot_run_id' in st.session_state:
+            st.caption(f"🗂️ Snapshot: {st.session_state['snapshot_run_id']}")
+        if st.button("🚀 1. Xử Lý & Xem Trước Dữ Liệu", type="primary", disabled=not files_ok):
             with st.spinner("Đang đọc và xử lý dữ liệu..."):
                 try:
                     up_bang_ke.seek(0); up_express.seek(0); up_transport.seek(0); up_function.seek(0); up_report.seek(0)
-                    df_res, df_rep_res = process_input_data(up_bang_ke, up_express, up_transport, up_function, up_report)
-                    st.session_state['df_preview'] = df_res
+                    df_res, df_rep_res, df_unmatched, address_norm = process_input_data(up_bang_ke, up_express, up_transport, up_function, up_report)
+                    df_res = ensure_row_ids(df_res)
+                    remember_folded_frame(df_res, address_norm.set_axis(df_res.index))
+                    set_preview_frame(df_res)
                     st.session_state['df_report_mapped'] = df_rep_res
+                    st.session_state['df_unmatched_bookings'] = df_unmatched
                     st.success("✅ Đã xử lý xong! Vui lòng kiểm tra và chỉnh sửa bên dưới nếu cần.")
-                    st.session_state['df_processed'] = df_res
+                    invalidate_workbook_cache()
+                    try:
+                        st.session_state['snapshot_run_id'] = save_run_snapshot(df_res, df_rep_res, source_files=[f.name for f in files_list])
+                    except Exception as e:
+                        st.warning(f"⚠️ Không lưu được snapshot: {e}")
                 except Exception as e:
                     st.error(f"❌ Lỗi: {str(e)}")
 
+        df_unmatched = st.session_state.get('df_unmatched_bookings')
+        if df_unmatched is not None and not df_unmatched.empty:
+            with st.expander(f"⚠️ {len(df_unmatched):,} dòng có Booking ID không khớp dữ liệu Express/Transport (thiếu Nhân viên / Nhóm / Group Function)", expanded=False):
+                st.dataframe(df_unmatched, use_container_width=True, height=250)
+
         if 'df_preview' in st.session_state:
             st.markdown("### 📝 Xem Trước & Chỉnh Sửa")
-            edited_df = st.data_editor(st.session_state['df_preview'], num_rows="dynamic", use_container_width=True, height=500)
-            st.session_state['df_preview'] = edited_df
-            st.session_state['df_processed'] = edited_df
+            df_master = st.session_state['df_preview']
+            version = st.session_state.get('preview_version', 0)
+
+            # Lọc / sắp xếp / phân trang phía server: trình duyệt chỉ nhận trang đang xem
+            pc1, pc2, pc3, pc4, pc5 = st.columns([2, 1, 2, 2, 1])
+            no_col = "(Không)"
+            sort_col = pc1.selectbox("Sắp xếp theo", [no_col] + list(df_master.columns), key="preview_sort_col")
+            ascending = pc2.radio("Thứ tự", ["Tăng", "Giảm"], key="preview_sort_dir", horizontal=True) == "Tăng"
+            filter_col = pc3.selectbox("Lọc theo cột", [no_col] + list(df_master.columns), key="preview_filter_col")
+            query = pc4.text_input("Giá trị chứa", key="preview_filter_query")
+            size_options = sorted({200, 1000, 5000, PREVIEW_PAGE_SIZE})
+            if len(df_master) <= PREVIEW_FULL_MAX_ROWS: size_options.append(PREVIEW_ALL_ROWS)
+            default_size = PREVIEW_ALL_ROWS if PREVIEW_ALL_ROWS in size_options else PREVIEW_PAGE_SIZE
+            if st.session_state.get("preview_page_size") not in size_options: st.session_state["preview_page_size"] = default_size
+            page_size = pc5.selectbox("Dòng/trang", size_options, key="preview_page_size")
+
+            view_key = (version, sort_col, ascending, filter_col, query)
+            cached_view = st.session_state.get('_preview_view')
+            if cached_view is None or cached_view[0] != view_key:
+                cached_view = (view_key, preview_view_ids(df_master, sort_col, ascending, filter_col, query))
+                st.session_state['_preview_view'] = cached_view
+            view_ids = cached_view[1]
+
+            if page_size == PREVIEW_ALL_ROWS: page_size = max(len(view_ids), 1)
+            n_pages = max(1, -(-len(view_ids) // page_size))
+            if st.session_state.get("preview_page", 1) > n_pages: st.session_state["preview_page"] = n_pages
+            page = st.number_input(f"Trang (1 - {n_pages})", min_value=1, max_value=n_pages, step=1, key="preview_page")
+            page_ids = view_ids[(page - 1) * page_size: page * page_size]
+            page_df = df_master.loc[page_ids]
+            st.caption(f"Hiển thị {len(page_ids):,} / {len(view_ids):,} dòng (tổng {len(df_master):,})")
+
+            # Key theo phiên bản: mỗi delta chỉ được gộp 1 lần rồi editor được tạo lại với dữ liệu mới
+            editor_key = f"{PREVIEW_EDITOR_KEY}_{version}"
+            edited_page = st.data_editor(editable_frame(page_df), num_rows="dynamic", use_container_width=True, height=500, key=editor_key)
+            delta = st.session_state.get(editor_key) or {}
+            if delta.get('edited_rows') or delta.get('added_rows') or delta.get('deleted_rows'):
+                # Bỏ cache file Excel của các function liên quan, gộp sửa đổi vào bản gốc theo row ID
+                dirty_funcs = functions_touched_by_edits(page_df, delta)
+                if dirty_funcs: invalidate_workbook_cache(dirty_funcs)
+                set_preview_frame(merge_page_edits(df_master, page_ids, edited_page, delta))
+                st.rerun()
             st.markdown("---")
             if st.button("💾 2. Xuất Báo Cáo & Tải Về"):
                 with st.spinner("Đang tạo file Excel..."):
                     try:
-                        up_bang_ke.seek(0)
-                        zip_result, file_logs = generate_output_from_df(st.session_state['df_preview'], st.session_state['df_report_mapped'], up_bang_ke)
+                        if up_bang_ke: up_bang_ke.seek(0)
+                        zip_result, file_logs = generate_output_from_df(st.session_state['df_preview'], st.session_state['df_report_mapped'], up_bang_ke, session_file_path("report_output.zip"),
+                                                                        workbook_cache=get_workbook_cache())
                         st.session_state['zip_result'] = zip_result
                         st.session_state['file_logs'] = file_logs
                         st.success("✅ Đã tạo file thành công!")
+                        # Keep the edited data in the run's snapshot
+                        if 'snapshot_run_id' in st.session_state:
+                            try:
+                                save_run_snapshot(st.session_state['df_preview'], st.session_state['df_report_mapped'], st.session_state['snapshot_run_id'])
+                            except Exception as e:
+                                st.warning(f"⚠️ Không cập nhật được snapshot: {e}")
                     except Exception as e:
                         st.error(f"❌ Lỗi khi tạo file: {str(e)}")
 
-        if 'zip_result' in st.session_state:
+        if 'zip_result' in st.session_state and os.path.exists(st.session_state['zip_result']):
             st.markdown("---")
             c1, c2 = st.columns(2)
             with c1:
-                st.download_button(label="Tải xuống trọn bộ (ZIP)", data=st.session_state['zip_result'], file_name=f"Grab_Report_{datetime.now().strftime('%Y%m%d_%H%M')}.zip", mime="application/zip", type="primary")
+                st.download_button(label="Tải xuống trọn bộ (ZIP)", data=lambda path=st.session_state['zip_result']: read_file_bytes(path),
+                                   file_name=f"Grab_Report_{datetime.now().strftime('%Y%m%d_%H%M')}.zip", mime="application/zip", type="primary")
             with c2:
                 with st.container(height=200):
-                    for f in st.session_state['file_logs']: st.code(f"📄 {f}", language="text")
+                    for f in st.session_state['file_logs']:
+                        if f.startswith("⚠️"): st.warning(f)
+                        else: st.code(f"📄 {f}", language="text")
 
     import plotly.express as px
 
     # --- TAB 3: FILTER ---
     with tab_filter:
         if 'df_processed' in st.session_state:
-            df = st.session_state['df_processed'].copy()
+            df = st.session_state['df_processed']
+            f_index = get_filter_index(df)
             st.header("🔎 Tra Cứu & Lọc Nâng Cao")
             
             # --- 1. FILTER SECTION ---
@@ -1404,39 +3220,33 @@ else:
                 c1, c2, c3, c4 = st.columns(4)
                 
                 # Filter by Group (Multiselect)
-                all_groups = sorted(list(df[COL_GROUP].dropna().unique())) if COL_GROUP in df.columns else []
+                all_groups = f_index.options(COL_GROUP)
                 selected_groups = c1.multiselect("Nhóm:", all_groups, key="filter_group")
 
                 # Filter by Group Function (Multiselect)
-                all_group_funcs = sorted(list(df[COL_GROUP_FUNCTION].dropna().unique())) if COL_GROUP_FUNCTION in df.columns else []
+                all_group_funcs = f_index.options(COL_GROUP_FUNCTION)
                 selected_group_funcs = c1.multiselect("Nhóm Chức Năng (Group Function):", all_group_funcs, key="filter_group_func")
                 
                 # Filter by Service (Multiselect)
-                all_services = sorted(list(df[COL_SERVICE].dropna().unique())) if COL_SERVICE in df.columns else []
+                all_services = f_index.options(COL_SERVICE)
                 selected_services = c2.multiselect("Loại Dịch Vụ:", all_services, key="filter_service")
                 
                 # Filter by Payment Type (Multiselect)
                 pay_col = COL_PAYMENT_METHOD_INVOICE if COL_PAYMENT_METHOD_INVOICE in df.columns else COL_PAYMENT_TYPE
-                all_payments = sorted(list(df[pay_col].astype(str).dropna().unique())) if pay_col in df.columns else []
+                all_payments = f_index.options(pay_col)
                 selected_payments = c3.multiselect("Hình Thức Thanh Toán:", all_payments, key="filter_payment")
 
                 # Filter by City (Multiselect)
-                all_cities = sorted(list(df[COL_CITY].astype(str).dropna().unique())) if COL_CITY in df.columns else []
+                all_cities = f_index.options(COL_CITY)
                 selected_cities = c4.multiselect("Tỉnh/Thành phố:", all_cities, key="filter_city")
 
                 # --- Dynamic Employee Filter ---
                 # Calculate available employees based on Group/Service/City/GroupFunction selection
-                temp_df = df.copy()
-                if selected_groups:
-                    temp_df = temp_df[temp_df[COL_GROUP].isin(selected_groups)]
-                if selected_group_funcs:
-                    temp_df = temp_df[temp_df[COL_GROUP_FUNCTION].isin(selected_group_funcs)]
-                if selected_services:
-                    temp_df = temp_df[temp_df[COL_SERVICE].isin(selected_services)]
-                if selected_cities:
-                    temp_df = temp_df[temp_df[COL_CITY].isin(selected_cities)]
-                
-                available_employees = sorted(list(temp_df[COL_EMPLOYEE_NAME].dropna().unique())) if COL_EMPLOYEE_NAME in temp_df.columns else []
+                dependent_mask = f_index.mask({
+                    COL_GROUP: selected_groups, COL_GROUP_FUNCTION: selected_group_funcs,
+                    COL_SERVICE: selected_services, COL_CITY: selected_cities,
+                })
+                available_employees = f_index.options(COL_EMPLOYEE_NAME, dependent_mask)
 
                 # Row 2: Search Fields
                 c5, c6, c7, c8 = st.columns(4)
@@ -1452,13 +3262,8 @@ else:
                 # Row 3: Date Range & General Search
                 c9, c10 = st.columns([1, 3])
                 
-                # Ensure Date Object
-                if 'Date_Obj' not in df.columns:
-                    df['Date_Obj'] = pd.to_datetime(df[COL_TIME], dayfirst=True, errors='coerce')
-                
                 # Logic: Default to full range if no specific selection
-                min_d = df['Date_Obj'].min().date() if not df['Date_Obj'].isnull().all() else datetime.now().date()
-                max_d = df['Date_Obj'].max().date() if not df['Date_Obj'].isnull().all() else datetime.now().date()
+                min_d, max_d = f_index.date_range or (datetime.now().date(), datetime.now().date())
                 
                 # Use session state to persist or reset date
                 date_range = c9.date_input("Khoảng Thời Gian:", value=(min_d, max_d), key="filter_date")
@@ -1466,46 +3271,19 @@ else:
                 search_general = c10.text_input("Tìm kiếm chung (Mã NV, Mô tả...):", key="filter_general")
 
             # --- 2. APPLY FILTERS ---
-            df_filtered = df.copy()
-            
-            # Categorical (List check)
-            if selected_groups:
-                df_filtered = df_filtered[df_filtered[COL_GROUP].isin(selected_groups)]
-            if selected_group_funcs:
-                df_filtered = df_filtered[df_filtered[COL_GROUP_FUNCTION].isin(selected_group_funcs)]
-            if selected_services:
-                df_filtered = df_filtered[df_filtered[COL_SERVICE].isin(selected_services)]
-            if selected_payments:
-                df_filtered = df_filtered[df_filtered[pay_col].isin(selected_payments)]
-            if selected_cities:
-                df_filtered = df_filtered[df_filtered[COL_CITY].isin(selected_cities)]
-            
-            # Employee Name Filter
-            if selected_employees:
-                df_filtered = df_filtered[df_filtered[COL_EMPLOYEE_NAME].isin(selected_employees)]
+            # Categorical + Employee (AND các mask trên chỉ mục, chưa đụng tới Dataframe)
+            row_mask = dependent_mask & f_index.mask({pay_col: selected_payments, COL_EMPLOYEE_NAME: selected_employees})
 
-            # Text Search
+            # Text Search (chỉ mục chuỗi con trên các giá trị khác nhau, dựng 1 lần / bộ dữ liệu)
             if search_invoice and COL_INVOICE_NUM in df.columns:
-                df_filtered = df_filtered[df_filtered[COL_INVOICE_NUM].astype(str).str.contains(search_invoice, case=False, na=False)]
-            
+                row_mask &= f_index.search_mask([COL_INVOICE_NUM], search_invoice)
             if search_booking and COL_BOOKING_CODE in df.columns:
-                df_filtered = df_filtered[df_filtered[COL_BOOKING_CODE].astype(str).str.contains(search_booking, case=False, na=False)]
-            
+                row_mask &= f_index.search_mask([COL_BOOKING_CODE], search_booking)
             if search_location:
-                loc_mask = pd.Series(False, index=df_filtered.index)
-                if COL_PICKUP in df.columns:
-                    loc_mask |= df_filtered[COL_PICKUP].astype(str).str.contains(search_location, case=False, na=False)
-                if COL_DROPOFF in df.columns:
-                    loc_mask |= df_filtered[COL_DROPOFF].astype(str).str.contains(search_location, case=False, na=False)
-                df_filtered = df_filtered[loc_mask]
-
+                # So khớp không dấu trên địa chỉ đã chuẩn hóa ('ha noi' khớp 'Hà Nội')
+                row_mask &= f_index.search_mask(ADDRESS_COLS, search_location)
             if search_general:
-                gen_mask = pd.Series(False, index=df_filtered.index)
-                if COL_EMPLOYEE_ID in df.columns:
-                    gen_mask |= df_filtered[COL_EMPLOYEE_ID].astype(str).str.contains(search_general, case=False, na=False)
-                if COL_TRIP_PURPOSE in df.columns:
-                    gen_mask |= df_filtered[COL_TRIP_PURPOSE].astype(str).str.contains(search_general, case=False, na=False)
-                df_filtered = df_filtered[gen_mask]
+                row_mask &= f_index.search_mask([COL_EMPLOYEE_ID, COL_TRIP_PURPOSE], search_general)
 
             # Date Range (Apply ONLY if range is valid)
             if isinstance(date_range, tuple) and len(date_range) == 2:
@@ -1518,33 +3296,27 @@ else:
                         is_full_range = True
                 
                 if not is_full_range:
-                    # Only filter if NOT full range, OR explicit filter requested
-                    # Filter: Keep rows within range. Rows with NaT are excluded by default in comparison.
-                    # If we want to keep NaT when range is full, we skip this block or handle NaT.
-                    
-                    df_filtered = df_filtered[
-                        (df_filtered['Date_Obj'].dt.date >= start_d) & 
-                        (df_filtered['Date_Obj'].dt.date <= end_d)
-                    ]
-                # Else: If full range selected, we do NOTHING to df_filtered regarding date, 
+                    # Keep rows within range. Rows with NaT are excluded.
+                    row_mask &= f_index.date_mask(start_d, end_d)
+                # Else: If full range selected, we do NOTHING regarding date,
                 # so rows with NaT (invalid dates) are preserved.
 
+            df_filtered = df[row_mask] if not row_mask.all() else df
+
             # --- 3. RESULTS TABLE ---
             st.markdown("---")
             c_res1, c_res2 = st.columns([3, 1])
             c_res1.markdown(f"### 📋 Kết quả tìm kiếm: {len(df_filtered):,} dòng")
             
             if not df_filtered.empty:
-                # Download Button
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df_filtered.to_excel(writer, index=False, sheet_name='Filtered_Data')
-                
+                # Download Button: file chỉ được tạo khi bấm tải (callable), Excel ghi từng dòng ở chế độ constant_memory
+                export_label = c_res2.selectbox("Định dạng:", list(FILTER_EXPORT_FORMATS), key="filter_export_format", label_visibility="collapsed")
+                export_fmt, export_mime = FILTER_EXPORT_FORMATS[export_label]
                 c_res2.download_button(
-                    label="⬇️ Tải Excel",
-                    data=output.getvalue(),
-                    file_name="Grab_Filtered_Data.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    label=f"⬇️ Tải {export_label.split()[0]}",
+                    data=lambda df_export=df_filtered, fmt=export_fmt: export_frame_bytes(df_export, fmt),
+                    file_name=f"Grab_Filtered_Data.{export_fmt}",
+                    mime=export_mime,
                     key="btn_download_filter"
                 )
                 
@@ -1570,14 +3342,14 @@ else:
                 with fc1:
                     # Pie Chart: Service Type
                     if COL_SERVICE in df_filtered.columns:
-                        f_service = df_filtered.groupby(COL_SERVICE)[COL_TOTAL_AMOUNT].sum().reset_index()
+                        f_service = df_filtered.groupby(COL_SERVICE, observed=True)[COL_TOTAL_AMOUNT].sum().reset_index()
                         fig_f_service = px.pie(f_service, values=COL_TOTAL_AMOUNT, names=COL_SERVICE, title="Tỷ Trọng Dịch Vụ (Filtered)", hole=0.4)
                         st.plotly_chart(fig_f_service, use_container_width=True)
                 
                 with fc2:
                     # Bar Chart: Group (if multiple groups selected or All)
                     if COL_GROUP in df_filtered.columns:
-                        f_group = df_filtered.groupby(COL_GROUP)[COL_TOTAL_AMOUNT].sum().reset_index().sort_values(COL_TOTAL_AMOUNT, ascending=True).tail(10)
+                        f_group = df_filtered.groupby(COL_GROUP, observed=True)[COL_TOTAL_AMOUNT].sum().reset_index().sort_values(COL_TOTAL_AMOUNT, ascending=True).tail(10)
                         fig_f_group = px.bar(f_group, x=COL_TOTAL_AMOUNT, y=COL_GROUP, orientation='h', title="Top Nhóm Chi Tiêu (Filtered)", text_auto='.2s')
                         st.plotly_chart(fig_f_group, use_container_width=True)
                 
@@ -1652,36 +3424,33 @@ else:
                             st.info("⚙️ Đang phân phối dữ liệu & Tạo Email Draft...")
                             
                             # Reuse distribute_all_files_logic
+                            # PDFs are linked (or only recorded in virtual mode) instead of copied
+                            placer = FilePlacer(PDF_PLACEMENT_MODE)
                             logs = distribute_all_files_logic(
                                 st.session_state['df_processed'],
                                 st.session_state.get('df_report_mapped', pd.DataFrame()), 
                                 temp_pdf_in,
                                 temp_out,
                                 up_bang_ke,
-                                up_function
+                                up_function,
+                                placer=placer,
+                                workbook_cache=get_workbook_cache()
                             )
                             
                             # 2.5 Run Create Email Draft for ALL Groups
                             # Since distribute_all_files_logic creates folders, we iterate temp_out to create drafts.
                             st.info("✉️ Đang tạo file Email Draft (.eml)...")
-                            draft_logs = create_eml_draft(temp_out)
+                            draft_logs = create_eml_draft(temp_out, placer=placer)
                             logs.extend(draft_logs)
                             
                             # 3. Zip Output
                             st.info("🗜️ Đang nén kết quả...")
                             
-                            final_zip_buffer = io.BytesIO()
-                            with zipfile.ZipFile(final_zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_final:
-                                for root, dirs, files in os.walk(temp_out):
-                                    for file in files:
-                                        abs_path = os.path.join(root, file)
-                                        rel_path = os.path.relpath(abs_path, temp_out)
-                                        zip_final.write(abs_path, arcname=rel_path)
-                            
-                            final_zip_buffer.seek(0)
+                            # Written to the session temp folder: only the path is kept in session state
+                            final_zip_path = zip_directory(temp_out, session_file_path("deployment_output.zip"), placer=placer)
                             
                             # Save to session state
-                            st.session_state['deployment_zip'] = final_zip_buffer.getvalue()
+                            st.session_state['deployment_zip'] = final_zip_path
                             st.session_state['deployment_logs'] = logs
                             
                             st.success("✅ Xử lý hoàn tất! Vui lòng tải xuống bên dưới.")
@@ -1698,7 +3467,7 @@ else:
                         st.exception(e)
         
         # Check if result exists in session state and show download button
-        if 'deployment_zip' in st.session_state:
+        if 'deployment_zip' in st.session_state and os.path.exists(st.session_state['deployment_zip']):
             st.write("---")
             st.success("✅ Kết quả xử lý đã sẵn sàng!")
             
@@ -1713,7 +3482,7 @@ else:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             st.download_button(
                 label="⬇️ Tải Xuống Kết Quả (Zip)",
-                data=st.session_state['deployment_zip'],
+                data=lambda path=st.session_state['deployment_zip']: read_file_bytes(path),
                 file_name=f"KETQUA_PHAN_PHOI_{timestamp}.zip",
                 mime="application/zip",
                 type="primary"
@@ -1731,23 +3500,8 @@ else:
             import plotly.express as px
             import pydeck as pdk
 
-            df = st.session_state['df_processed'].copy()
-            
-            # Ensure numeric columns
-            money_cols = [COL_TOTAL_AMOUNT, COL_TOTAL_VAT, COL_TOTAL_PRE_TAX, COL_COST_TRANSPORT_PRE_TAX, COL_VAT_TRANSPORT, COL_COST_SERVICE_PRE_TAX, COL_VAT_SERVICE, COL_SURCHARGE]
-            for col in money_cols:
-                if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            
-            # Date processing
-            df['Date_Obj'] = pd.to_datetime(df[COL_TIME], dayfirst=True, errors='coerce')
-            df['Date_Only'] = df['Date_Obj'].dt.date
-            df['Month'] = df['Date_Obj'].dt.strftime('%m-%Y')
-            df['Hour'] = df['Date_Obj'].dt.hour
-            df['DayOfWeek'] = df['Date_Obj'].dt.day_name()
-            
-            # Sort DayOfWeek
-            days_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-            df['DayOfWeek'] = pd.Categorical(df['DayOfWeek'], categories=days_order, ordered=True)
+            # Cube tổng hợp 1 lần cho mỗi bộ dữ liệu; mọi biểu đồ bên dưới chỉ gộp tiếp trên cube
+            cube, emp_cube = get_dashboard_cube(st.session_state['df_processed'])
 
             st.header("📊 Dashboard Phân Tích Chi Phí Toàn Diện")
             st.markdown("---")
@@ -1757,10 +3511,10 @@ else:
             
             # --- Row 1: KPI Cards ---
             k1, k2, k3, k4, k5 = st.columns(5)
-            gross_spend = df[COL_TOTAL_AMOUNT].sum()
-            total_vat = df[COL_TOTAL_VAT].sum()
-            total_pre_tax = df[COL_TOTAL_PRE_TAX].sum()
-            total_trips = len(df)
+            gross_spend = cube[COL_TOTAL_AMOUNT].sum()
+            total_vat = cube[COL_TOTAL_VAT].sum()
+            total_pre_tax = cube[COL_TOTAL_PRE_TAX].sum()
+            total_trips = int(cube[CUBE_ROWS].sum())
             avg_trip = gross_spend / total_trips if total_trips > 0 else 0
             
             # Calculate MoM (Month over Month) trend if old data available (Mockup logic or based on date range split)
@@ -1777,20 +3531,14 @@ else:
             
             with v1:
                 # Treemap: Group -> Service -> Amount
-                if COL_GROUP in df.columns and COL_SERVICE in df.columns:
-                     # Handle NaNs for Treemap (Critical to avoid None entries error)
-                     df_treemap = df.copy()
-                     df_treemap[COL_GROUP] = df_treemap[COL_GROUP].fillna("Unknown Group")
-                     df_treemap[COL_SERVICE] = df_treemap[COL_SERVICE].fillna("Unknown Service")
-                     
-                     # Ensure positive values for treemap size (Plotly Treemap doesn't like negative values for size)
-                     # We can use absolute value for size, but color by actual value
-                     df_treemap['Abs_Amount'] = df_treemap[COL_TOTAL_AMOUNT].abs()
-                     
+                if COL_GROUP in cube.columns and COL_SERVICE in cube.columns:
+                     # 1 dòng / (nhóm, dịch vụ): size = tổng trị tuyệt đối, color = tổng thực
+                     df_treemap = treemap_frame(cube)
+
                      fig_tree = px.treemap(
                          df_treemap, 
                          path=[px.Constant("Toàn Bộ"), COL_GROUP, COL_SERVICE], 
-                         values='Abs_Amount', # Use absolute for size
+                         values=CUBE_ABS_AMOUNT, # Use absolute for size
                          color=COL_TOTAL_AMOUNT, # Use actual for color (Red for negative/discount)
                          color_continuous_scale='RdBu_r',
                          title="Bản Đồ Cấu Trúc Chi Phí (Treemap: Nhóm > Dịch Vụ)"
@@ -1801,22 +3549,20 @@ else:
             
             with v2:
                 # Scatter: Spend vs Trips (Employee Level)
-                if COL_EMPLOYEE_NAME in df.columns:
-                    emp_stats = df.groupby([COL_EMPLOYEE_NAME, COL_GROUP]).agg({
-                        COL_TOTAL_AMOUNT: 'sum',
-                        COL_BOOKING_CODE: 'count'
-                    }).reset_index()
-                    emp_stats['Avg_Cost'] = emp_stats[COL_TOTAL_AMOUNT] / emp_stats[COL_BOOKING_CODE]
-                    
+                if emp_cube is not None and COL_GROUP in emp_cube.columns:
+                    # Top nhân viên + 1 điểm "Khác"; size theo |Avg_Cost| (chiết khấu làm Avg_Cost âm)
+                    emp_stats = employee_scatter_frame(emp_cube)
+
                     fig_scatter = px.scatter(
                         emp_stats, 
                         x=COL_BOOKING_CODE, 
                         y=COL_TOTAL_AMOUNT,
-                        size='Avg_Cost', 
+                        size='Size', 
                         color=COL_GROUP,
                         hover_name=COL_EMPLOYEE_NAME,
+                        hover_data={'Size': False, 'Avg_Cost': ':,.0f', 'Employees': True},
                         title="Phân Tích Hành Vi Nhân Viên (Scatter)",
-                        labels={COL_BOOKING_CODE: "Số Chuyến", COL_TOTAL_AMOUNT: "Tổng Chi"},
+                        labels={COL_BOOKING_CODE: "Số Chuyến", COL_TOTAL_AMOUNT: "Tổng Chi", 'Avg_Cost': "TB/Chuyến", 'Employees': "Số NV"},
                         size_max=40
                     )
                     fig_scatter.update_layout(margin=dict(t=30, l=0, r=0, b=0), showlegend=False)
@@ -1826,16 +3572,13 @@ else:
 
             # 2. Daily & Hourly Trends (Separated Rows)
             st.markdown("##### 📅 Xu Hướng Theo Ngày (Chi Phí & Số Chuyến)")
-            if not df.empty:
-                daily_agg = df.groupby('Date_Only').agg({
-                    COL_TOTAL_AMOUNT: 'sum',
-                    COL_BOOKING_CODE: 'count'
-                }).reset_index()
+            if not cube.empty:
+                daily_agg = cube_rollup(cube, CUBE_DATE, [COL_TOTAL_AMOUNT, COL_BOOKING_CODE])
                 
                 fig_daily = go.Figure()
                 # Bar: Cost
                 fig_daily.add_trace(go.Bar(
-                    x=daily_agg['Date_Only'], 
+                    x=daily_agg[CUBE_DATE], 
                     y=daily_agg[COL_TOTAL_AMOUNT],
                     name='Chi Phí',
                     text=daily_agg[COL_TOTAL_AMOUNT],
@@ -1845,7 +3588,7 @@ else:
                 ))
                 # Line: Trips
                 fig_daily.add_trace(go.Scatter(
-                    x=daily_agg['Date_Only'],
+                    x=daily_agg[CUBE_DATE],
                     y=daily_agg[COL_BOOKING_CODE],
                     name='Số Chuyến',
                     yaxis='y2',
@@ -1865,16 +3608,13 @@ else:
                 st.plotly_chart(fig_daily, use_container_width=True)
 
             st.markdown("##### ⏰ Phân Bố Theo Khung Giờ (Chi Phí & Số Chuyến)")
-            if 'Hour' in df.columns:
-                hourly_agg = df.groupby('Hour').agg({
-                    COL_TOTAL_AMOUNT: 'sum',
-                    COL_BOOKING_CODE: 'count'
-                }).reset_index()
+            if not cube.empty:
+                hourly_agg = cube_rollup(cube, CUBE_HOUR, [COL_TOTAL_AMOUNT, COL_BOOKING_CODE])
                 
                 fig_hour = go.Figure()
                 # Bar: Cost
                 fig_hour.add_trace(go.Bar(
-                    x=hourly_agg['Hour'],
+                    x=hourly_agg[CUBE_HOUR],
                     y=hourly_agg[COL_TOTAL_AMOUNT],
                     name='Chi Phí',
                     text=hourly_agg[COL_TOTAL_AMOUNT],
@@ -1884,7 +3624,7 @@ else:
                 ))
                 # Line: Trips
                 fig_hour.add_trace(go.Scatter(
-                    x=hourly_agg['Hour'],
+                    x=hourly_agg[CUBE_HOUR],
                     y=hourly_agg[COL_BOOKING_CODE],
                     name='Số Chuyến',
                     yaxis='y2',
@@ -1907,8 +3647,8 @@ else:
             c1, c2 = st.columns(2)
             with c1:
                 st.markdown("##### 🏢 Chi Phí Theo Phòng Ban")
-                if COL_GROUP in df.columns:
-                    group_cost = df.groupby(COL_GROUP)[COL_TOTAL_AMOUNT].sum().reset_index().sort_values(COL_TOTAL_AMOUNT, ascending=False).head(10)
+                if COL_GROUP in cube.columns:
+                    group_cost = cube_rollup(cube, COL_GROUP, [COL_TOTAL_AMOUNT]).sort_values(COL_TOTAL_AMOUNT, ascending=False).head(10)
                     fig_group = px.bar(
                         group_cost, 
                         x=COL_TOTAL_AMOUNT, 
@@ -1922,8 +3662,8 @@ else:
                     st.plotly_chart(fig_group, use_container_width=True)
             with c2:
                 st.markdown("##### 🚕 Tỷ Trọng Dịch Vụ")
-                if COL_SERVICE in df.columns:
-                    service_cost = df.groupby(COL_SERVICE)[COL_TOTAL_AMOUNT].sum().reset_index()
+                if COL_SERVICE in cube.columns:
+                    service_cost = cube_rollup(cube, COL_SERVICE, [COL_TOTAL_AMOUNT])
                     fig_service = px.pie(
                         service_cost, 
                         values=COL_TOTAL_AMOUNT, 
@@ -1937,11 +3677,14 @@ else:
             # 4. Advanced Heatmap
             st.markdown("---")
             st.subheader("🔥 Bản Đồ Nhiệt: Tần Suất Đặt Xe (Thứ vs Giờ)")
-            if 'DayOfWeek' in df.columns and 'Hour' in df.columns:
-                heatmap_data = df.pivot_table(index='DayOfWeek', columns='Hour', values=COL_BOOKING_CODE, aggfunc='count')
+            if not cube.empty:
+                # Thứ trong tuần suy ra từ chiều ngày của cube (gộp theo ngày × giờ trước, ≤ 31×24 dòng)
+                heat_src = cube_rollup(cube, [CUBE_DATE, CUBE_HOUR], [COL_BOOKING_CODE])
+                heat_src['DayOfWeek'] = heat_src[CUBE_DATE].dt.day_name()
+                heatmap_data = heat_src.groupby(['DayOfWeek', CUBE_HOUR])[COL_BOOKING_CODE].sum().unstack(fill_value=0)
                 
-                # Ensure all hours 0-23 are present
-                heatmap_data = heatmap_data.reindex(columns=range(24), fill_value=0)
+                # Ensure all days and hours 0-23 are present
+                heatmap_data = heatmap_data.reindex(index=DAYS_ORDER, columns=range(24), fill_value=0)
 
                 fig_heat = px.imshow(
                     heatmap_data, 
@@ -1958,16 +3701,16 @@ else:
             st.markdown("---")
             st.subheader("👤 Dashboard Chi Tiết Nhân Viên")
             
-            all_emps = sorted(df[COL_EMPLOYEE_NAME].dropna().unique()) if COL_EMPLOYEE_NAME in df.columns else []
+            all_emps = sorted(emp_cube[COL_EMPLOYEE_NAME].dropna().unique()) if emp_cube is not None else []
             selected_emp = st.selectbox("Chọn Nhân Viên để phân tích:", all_emps)
             
             if selected_emp:
-                emp_df = df[df[COL_EMPLOYEE_NAME] == selected_emp]
+                emp_df = emp_cube[emp_cube[COL_EMPLOYEE_NAME] == selected_emp]
                 
                 # Emp Metrics
                 ec1, ec2, ec3 = st.columns(3)
                 e_gross = emp_df[COL_TOTAL_AMOUNT].sum()
-                e_trips = len(emp_df)
+                e_trips = int(emp_df[CUBE_ROWS].sum())
                 e_avg = e_gross / e_trips if e_trips > 0 else 0
                 
                 ec1.metric("Tổng Chi Tiêu", f"{e_gross:,.0f} đ")
@@ -1977,12 +3720,12 @@ else:
                 # Emp Charts
                 ec4, ec5 = st.columns(2)
                 with ec4:
-                    e_daily = emp_df.groupby('Date_Only')[COL_TOTAL_AMOUNT].sum().reset_index()
-                    fig_e_daily = px.bar(e_daily, x='Date_Only', y=COL_TOTAL_AMOUNT, title="Chi Tiêu Theo Ngày")
+                    e_daily = cube_rollup(emp_df, CUBE_DATE, [COL_TOTAL_AMOUNT])
+                    fig_e_daily = px.bar(e_daily, x=CUBE_DATE, y=COL_TOTAL_AMOUNT, title="Chi Tiêu Theo Ngày")
                     st.plotly_chart(fig_e_daily, use_container_width=True)
                 with ec5:
                     if COL_SERVICE in emp_df.columns:
-                        e_service = emp_df.groupby(COL_SERVICE)[COL_TOTAL_AMOUNT].sum().reset_index()
+                        e_service = cube_rollup(emp_df, COL_SERVICE, [COL_TOTAL_AMOUNT])
                         fig_e_service = px.pie(e_service, values=COL_TOTAL_AMOUNT, names=COL_SERVICE, title="Dịch Vụ Sử Dụng", hole=0.4)
                         st.plotly_chart(fig_e_service, use_container_width=True)
 
@@ -2014,8 +3757,8 @@ else:
                 'Unknown': {'lat': None, 'lon': None}
             }
             
-            if COL_CITY in df.columns:
-                map_df = df.groupby(COL_CITY).agg({COL_TOTAL_AMOUNT: 'sum', COL_BOOKING_CODE: 'count'}).reset_index()
+            if COL_CITY in cube.columns:
+                map_df = cube_rollup(cube, COL_CITY, [COL_TOTAL_AMOUNT, COL_BOOKING_CODE])
                 # Ensure CITY_COORDS keys match map_df values (handle case/strip)
                 map_df['City_Normalized'] = map_df[COL_CITY].astype(str).str.strip() # Normalize if needed
                 
@@ -2074,11 +3817,8 @@ else:
 
                 with cm2:
                     st.markdown("##### 📍 Thống Kê Theo Tỉnh/Thành")
-                    if COL_CITY in df.columns:
-                        pivot_city = df.groupby(COL_CITY).agg({
-                            COL_BOOKING_CODE: 'count',
-                            COL_TOTAL_AMOUNT: 'sum'
-                        }).rename(columns={
+                    if COL_CITY in cube.columns:
+                        pivot_city = cube_rollup(cube, COL_CITY, [COL_BOOKING_CODE, COL_TOTAL_AMOUNT]).set_index(COL_CITY).rename(columns={
                             COL_BOOKING_CODE: 'Số Chuyến', 
                             COL_TOTAL_AMOUNT: 'Tổng Chi'
                         }).sort_values('Số Chuyến', ascending=False)
@@ -2293,11 +4033,7 @@ else:
                                 st.warning(f"Bỏ qua tạo email cho nhóm {grp} do lỗi: {e}")
                         
                         if cnt > 0:
-                            zip_buf = io.BytesIO()
-                            with zipfile.ZipFile(zip_buf, 'w', zipfile.ZIP_DEFLATED) as zf:
-                                for r, d, f in os.walk(temp_email_dir):
-                                    for file in f:
-                                        zf.write(os.path.join(r, file), file)
+                            zip_buf = zip_directory(temp_email_dir, io.BytesIO(), flat=True)
                             zip_buf.seek(0)
                             st.session_state['email_zip'] = zip_buf
                             st.success(f"Đã tạo {cnt} file email HTML!")
@@ -2322,54 +4058,14 @@ else:
                 if COL_GROUP_FUNCTION not in df_proc.columns:
                     st.error(f"Không tìm thấy cột '{COL_GROUP_FUNCTION}' trong dữ liệu. Vui lòng kiểm tra cấu hình.")
                 else:
-                    all_funcs = sorted(df_proc[COL_GROUP_FUNCTION].dropna().unique())
-                    
                     pdf_src_dir = st.session_state.get('src_dir', "./000_master_data/PDF/")
                     
-                    pdf_files = []
-                    if os.path.exists(pdf_src_dir):
-                        try:
-                            pdf_files = [f for f in os.listdir(pdf_src_dir) if f.lower().endswith('.pdf')]
-                        except: pass
-                    
-                    summary_data = []
-                    
-                    for func in all_funcs:
-                        g_data = df_proc[df_proc[COL_GROUP_FUNCTION] == func]
-                        
-                        count_excel = 0
-                        inv_list = []
-                        if COL_BOOKING_CODE in g_data.columns:
-                            inv_list = g_data[COL_BOOKING_CODE].dropna().astype(str).str.strip().unique()
-                            inv_list = [i for i in inv_list if i != '']
-                            count_excel = len(inv_list)
-                        
-                        count_pdf = 0
-                        missing_pdf_list = []
-                        
-                        if pdf_files:
-                            match_col = COL_INVOICE_NUM if COL_INVOICE_NUM in g_data.columns else COL_BOOKING_CODE
-                            
-                            check_items = g_data[match_col].dropna().astype(str).str.strip().unique()
-                            check_items = [i for i in check_items if i != '']
-                            
-                            for item in check_items:
-                                if any(item in f for f in pdf_files):
-                                    count_pdf += 1
-                                else:
-                                    missing_pdf_list.append(item)
-                        
-                        status = "✅ Đủ" if count_pdf >= count_excel and count_excel > 0 else ("⚠️ Thiếu" if count_pdf > 0 else "❌ Không tìm thấy")
-                        if not pdf_files: status = "⚪ Chưa có PDF"
-                        
-                        summary_data.append({
-                            COL_GROUP_FUNCTION: func,
-                            "Số HĐ (Excel)": count_excel,
-                            "PDF Tìm Thấy": count_pdf if pdf_files else 0,
-                            "Trạng Thái": status
-                        })
-                    
-                    df_summary = pd.DataFrame(summary_data)
+                    # Cached by (data + report fingerprint, PDF folder mtime)
+                    df_rep_map = st.session_state.get('df_report_mapped')
+                    data_fp = dataframe_fingerprint(df_proc, [COL_GROUP_FUNCTION, COL_BOOKING_CODE, COL_INVOICE_NUM]) \
+                        + dataframe_fingerprint(df_rep_map, [COL_ADJUSTED_INVOICE_REPORT, 'Mẫu số', 'Ký hiệu'])
+                    df_summary, df_missing, pdf_count = cached_reconcile_invoices(data_fp, pdf_src_dir, get_dir_mtime(pdf_src_dir), df_proc, df_rep_map)
+                    pdf_files = pdf_count > 0
                     
                     c_sum1, c_sum2 = st.columns(2)
                     if not df_summary.empty:
@@ -2381,6 +4077,10 @@ else:
                         
                         st.dataframe(df_summary, use_container_width=True)
                         
+                        if not df_missing.empty:
+                            with st.expander(f"📄 Danh sách hóa đơn thiếu PDF ({len(df_missing):,})", expanded=False):
+                                st.dataframe(df_missing, use_container_width=True, height=300)
+                        
                         import plotly.express as px
                         df_melt = df_summary.melt(id_vars=[COL_GROUP_FUNCTION], value_vars=['Số HĐ (Excel)', 'PDF Tìm Thấy'], var_name='Loại', value_name='Số Lượng')
                         
@@ -2397,7 +4097,9 @@ else:
                         st.plotly_chart(fig, use_container_width=True)
                         
                         if not pdf_files:
-                            st.warning(f"Không tìm thấy file PDF nào trong thư mục: '{pdf_src_dir}'. Vui lòng kiểm tra lại đường dẫn ở Tab 'Phân Phối PDF'.")        
-
-
+                            st.warning(f"Không tìm thấy file PDF nào trong thư mục: '{pdf_src_dir}'. Vui lòng kiểm tra lại đường dẫn ở Tab 'Phân Phối PDF'.")
 
+# --- SIDEBAR: thống kê cache đọc file (sau khi mọi tab đã chạy) ---
+with parse_cache_slot.container():
+    _stats = get_parse_cache_stats()
+    st.caption(f"🗃️ Cache đọc file: {_stats['calls'] - _stats['miss']} hit / {_stats['miss']} miss")
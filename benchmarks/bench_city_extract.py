@@ -0,0 +1,85 @@
+"""
+Benchmark: suy ra thành phố từ địa chỉ đón — CityExtractor (chuẩn hóa không dấu +
+1 regex + memo theo địa chỉ khác nhau) so với cách cũ (.apply + quét từng từ khóa
+bằng 'in').
+
+Chạy từ thư mục gốc của repo:
+    python benchmarks/bench_city_extract.py [số_địa_chỉ] [số_địa_chỉ_khác_nhau]
+"""
+import os
+import sys
+import time
+import random
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402  (chạy Streamlit ở bare mode, chỉ dùng các hàm helper)
+
+
+def make_addresses(n_rows, n_distinct, seed=0):
+    """
+    Địa chỉ giả: phần lớn có từ khóa thành phố ở cuối, 1 phần không khớp từ khóa nào,
+    1 phần chứa 2 từ khóa (vd: 'Vinhomes ... Hà Nội') để kiểm tra thứ tự ưu tiên,
+    1 phần viết không dấu (vd: 'Bien Hoa', 'Hue') để kiểm tra so khớp trên địa chỉ đã chuẩn hóa.
+    """
+    rng = random.Random(seed)
+    cities = list(app.CITY_KEYWORDS) + [app.fold_text(k) for k in app.CITY_KEYWORDS][::3] + ["Không rõ"] * 10
+    streets = ["Nguyễn Huệ", "Lê Lợi", "Trần Hưng Đạo", "Điện Biên Phủ", "Võ Văn Kiệt", "Phạm Văn Đồng", "Vinhomes"]
+    pool = [f"{rng.randint(1, 999)} {rng.choice(streets)}, Phường {rng.randint(1, 20)}, Quận {rng.randint(1, 12)}, "
+            f"{rng.choice(cities).title()}"
+            f"{', gần ' + rng.choice(cities) if rng.random() < 0.2 else ''}, Việt Nam" for _ in range(n_distinct)]
+    return pd.Series([rng.choice(pool) for _ in range(n_rows)])
+
+
+def legacy_extract(address):
+    """Bản cũ: lower() rồi quét lần lượt từng từ khóa."""
+    if not isinstance(address, str): return "Unknown"
+    addr_lower = address.lower()
+    for key, val in app.CITY_KEYWORDS.items():
+        if key in addr_lower: return val
+    return None
+
+
+def expected_difference(address, city):
+    """
+    Khác biệt có chủ đích so với bản cũ: từ khóa nhiều chữ so khớp trên địa chỉ đã chuẩn hóa
+    ('Bien Hoa' khớp 'biên hòa', 'HA  NOI' khớp 'ha noi'), từ khóa 1 chữ ('huế', 'vinh', 'hcm')
+    vẫn so có dấu như cũ. city phải là từ khóa đầu tiên trong bảng khớp theo quy tắc đó.
+    """
+    folded, addr_lower = app.fold_text(address), address.lower()
+    for key, val in app.CITY_KEYWORDS.items():
+        key_folded = app.fold_text(key)
+        if (key_folded in folded) if ' ' in key_folded else (key in addr_lower): return city == val
+    return city is None
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    n_distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    addresses = make_addresses(n_rows, n_distinct)
+
+    start = time.perf_counter()
+    legacy = addresses.apply(legacy_extract)
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extractor = app.CityExtractor(app.CITY_KEYWORDS)
+    new = extractor.extract_series(addresses, app.normalize_address_column(addresses, memo={}))
+    t_new = time.perf_counter() - start
+
+    # Kiểm tra: khác bản cũ chỉ ở các khác biệt có chủ đích (expected_difference)
+    diff = legacy.fillna("Unknown") != new.fillna("Unknown")
+    changed = pd.DataFrame({'address': addresses[diff], 'new': new[diff]}).drop_duplicates('address')
+    assert all(expected_difference(a, c) for a, c in zip(changed['address'], changed['new']))
+    # Bản vector hóa khớp bản từng địa chỉ
+    sample = addresses.sample(min(len(addresses), 5_000), random_state=0)
+    assert sample.map(extractor.extract).fillna("Unknown").equals(new[sample.index].fillna("Unknown"))
+    print(f"{n_rows:,} địa chỉ ({n_distinct:,} khác nhau), {len(app.CITY_KEYWORDS)} từ khóa")
+    print(f"  khác bản cũ: {diff.sum():,} dòng / {len(changed):,} địa chỉ (đều là khớp không dấu của từ khóa nhiều chữ)")
+    print(f"  cũ (.apply + 'in')                  : {t_legacy:6.2f} s")
+    print(f"  CityExtractor (chuẩn hóa+regex+memo): {t_new:6.2f} s  (x{t_legacy / t_new:.1f})")
+
+
+if __name__ == '__main__':
+    main()
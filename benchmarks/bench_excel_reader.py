@@ -0,0 +1,90 @@
+"""
+Benchmark: thời gian parse + peak RSS khi đọc sheet "hóa đơn chi tiết" theo từng
+engine đọc Excel (stream / openpyxl / calamine nếu đã cài).
+
+Mỗi engine chạy trong 1 process riêng để peak RSS không bị lẫn giữa các lần đo.
+
+Chạy từ thư mục gốc của repo:
+    python benchmarks/bench_excel_reader.py [số_dòng] [số_cột_thừa]
+"""
+import os
+import sys
+import json
+import time
+import random
+import resource
+import tempfile
+import subprocess
+
+import xlsxwriter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_workbook(path, app, n_rows, n_extra_cols):
+    """Bảng Kê giả: các cột IN_COL_BK_* + cột output + n_extra_cols cột không dùng tới."""
+    rng = random.Random(0)
+    columns = [
+        (app.IN_COL_BK_BOOKING_ID, lambda i: f"A-{i:08d}"),
+        (app.IN_COL_BK_GROUP_NAME, lambda i: f"Group {i % 40}"),
+        (app.IN_COL_BK_VERTICAL, lambda i: rng.choice(["GrabCar", "GrabBike", "GrabExpress", "Discount"])),
+        (app.IN_COL_BK_COMPANY_NAME, lambda i: "Công ty TNHH Grab"),
+        (app.COL_PAYMENT_TYPE, lambda i: "Corporate"),
+        (app.IN_COL_BK_COST_TRANS, lambda i: rng.randint(10, 900) * 1000),
+        (app.IN_COL_BK_VAT_TRANS, lambda i: rng.randint(1, 70) * 1000),
+        (app.IN_COL_BK_COST_SERV, lambda i: 1000),
+        (app.IN_COL_BK_VAT_SERV, lambda i: 80),
+        (app.IN_COL_BK_TOTAL, lambda i: rng.randint(10, 990) * 1000),
+        (app.COL_LOOKUP_CODE, lambda i: f"LK{i:010d}"),
+        (app.COL_INVOICE_NUM, lambda i: 100000 + i // 3),
+        (app.COL_PAYMENT_METHOD_INVOICE, lambda i: rng.choice([app.VAL_PAYMENT_METHOD_TRANSFER, "TM/CK"])),
+    ]
+    columns += [(f"Cột phụ {k}", lambda i, k=k: f"extra {k} {i % 97}") for k in range(n_extra_cols)]
+
+    wb = xlsxwriter.Workbook(path, {'constant_memory': True})
+    wb.add_worksheet("tổng quan").write(0, 0, "Intro")
+    ws = wb.add_worksheet(app.BANG_KE_SHEET_NAME)
+    ws.write_row(app.SKIPROWS_BANG_KE, 0, [name for name, _ in columns])
+    for i in range(n_rows):
+        ws.write_row(app.SKIPROWS_BANG_KE + 1 + i, 0, [make(i) for _, make in columns])
+    wb.close()
+
+
+def measure(engine, path):
+    """Chạy trong process con: parse 1 lần, in JSON {seconds, peak_rss_mb, shape}."""
+    import app  # noqa: E402  (chạy Streamlit ở bare mode, chỉ dùng các hàm helper)
+    with open(path, 'rb') as f:
+        start = time.perf_counter()
+        df = app.read_excel_upload(f, engine, sheet_name=app.BANG_KE_SHEET_NAME, skiprows=app.SKIPROWS_BANG_KE,
+                                   columns=app.bang_ke_read_columns())
+        elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'seconds': elapsed, 'peak_rss_mb': peak_kb / 1024, 'shape': list(df.shape)}))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3])
+        return
+
+    import app  # noqa: E402
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_extra = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    engines = ['openpyxl', 'stream'] + (['calamine'] if app.calamine_available() else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bang_ke.xlsx")
+        make_workbook(path, app, n_rows, n_extra)
+        print(f"Workbook: {n_rows:,} dòng x {13 + n_extra} cột ({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+        for engine in engines:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', engine, path],
+                                 cwd=ROOT, capture_output=True, text=True, check=True)
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"  {engine:<9} {result['seconds']:8.2f} s  peak RSS {result['peak_rss_mb']:8.1f} MB  shape {tuple(result['shape'])}")
+        if 'calamine' not in engines:
+            print("  calamine  (chưa cài python-calamine, bỏ qua)")
+
+
+if __name__ == '__main__':
+    main()
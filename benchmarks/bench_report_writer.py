@@ -0,0 +1,98 @@
+"""
+Benchmark: write_report_sheet (write_row từ iter_frame_rows, format theo cột, workbook của open_excel_writer)
+so với cách cũ (đọc lại từng ô bằng iloc).
+
+Chạy từ thư mục gốc của repo:
+    python benchmarks/bench_report_writer.py [số_hóa_đơn]
+"""
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402  (chạy Streamlit ở bare mode, chỉ dùng các hàm helper)
+
+
+def make_report(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'STT': np.arange(1, n_rows + 1),
+        app.COL_GROUP_FUNCTION: rng.choice([f"FUNC {i}" for i in range(150)], n_rows),
+        'Mẫu số': 1,
+        'Ký hiệu': 'C24TAA',
+        app.COL_ADJUSTED_INVOICE_REPORT: np.arange(100000, 100000 + n_rows),
+        'Ngày hóa đơn': '01/03/2024',
+        'Tên người mua': 'CÔNG TY TNHH ABC',
+        'Ghi chú': np.where(rng.random(n_rows) < 0.7, None, 'Điều chỉnh'),
+    })
+    for col in app.MONEY_COL_REPORT:
+        df[col] = rng.integers(10_000, 2_000_000, n_rows).astype(float)
+    return df
+
+
+def legacy_write_report_sheet(df, sheet_name, title_prefix, writer_obj):
+    """Bản cũ: to_excel rồi ghi lại từng ô bằng df.iloc + pd.isna."""
+    if df.empty: return
+    df.to_excel(writer_obj, sheet_name=sheet_name, index=False, startrow=0)
+    worksheet = writer_obj.sheets[sheet_name]
+    workbook = writer_obj.book
+
+    header_wrap = workbook.add_format({'bold': True, 'border': 1, 'text_wrap': True, 'valign': 'vcenter', 'bg_color': '#D9E1F2'})
+    header_no_wrap = workbook.add_format({'bold': True, 'border': 1, 'text_wrap': False, 'valign': 'vcenter', 'bg_color': '#D9E1F2'})
+    data_fmt = workbook.add_format({'border': 1, 'valign': 'vcenter'})
+    money_fmt = workbook.add_format({'border': 1, 'num_format': '#,##0', 'valign': 'vcenter'})
+    total_fmt = workbook.add_format({'bold': True, 'border': 1, 'bg_color': '#FFF2CC'})
+    total_money_fmt = workbook.add_format({'bold': True, 'border': 1, 'bg_color': '#FFF2CC', 'num_format': '#,##0'})
+
+    for col_num, value in enumerate(df.columns.values):
+        fmt = header_no_wrap if value == app.COL_GROUP_FUNCTION else header_wrap
+        worksheet.write(0, col_num, value, fmt)
+        try:
+            col_len = max(df.iloc[:, col_num].astype(str).map(len).max(), len(str(value))) + 2
+            worksheet.set_column(col_num, col_num, min(col_len, 50))
+        except:
+            worksheet.set_column(col_num, col_num, 15)
+
+    for row in range(len(df)):
+        for col in range(len(df.columns)):
+            val = df.iloc[row, col]
+            fmt = money_fmt if df.columns[col] in app.MONEY_COL_REPORT else data_fmt
+            if pd.isna(val): worksheet.write(row + 1, col, "", fmt)
+            else: worksheet.write(row + 1, col, val, fmt)
+
+    last_row = len(df) + 1
+    worksheet.write(last_row, 0, "TỔNG CỘNG", total_fmt)
+    for col_num, col_name in enumerate(df.columns):
+        if col_name in app.MONEY_COL_REPORT:
+            col_char = app.xlsxwriter.utility.xl_col_to_name(col_num)
+            worksheet.write_formula(last_row, col_num, f"=SUM({col_char}2:{col_char}{last_row})", total_money_fmt)
+        elif col_num > 0:
+            worksheet.write(last_row, col_num, "", total_fmt)
+
+
+def run(writer_fn, df, path):
+    start = time.perf_counter()
+    with app.open_excel_writer(path) as writer:
+        writer_fn(df, 'DS Hoa don CK', 'BÁO CÁO HÓA ĐƠN (CK)', writer)
+    return time.perf_counter() - start
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    df = make_report(n_rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            'before (per-cell)': run(legacy_write_report_sheet, df, os.path.join(tmp, 'before.xlsx')),
+            'after (write_row)': run(app.write_report_sheet, df, os.path.join(tmp, 'after.xlsx')),
+        }
+    print(f"Report: {n_rows:,} invoices x {len(df.columns)} columns")
+    for name, secs in results.items():
+        print(f"  {name:<22} {secs:8.2f} s  {n_rows / secs:12,.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main()
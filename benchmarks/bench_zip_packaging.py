@@ -0,0 +1,67 @@
+"""
+Benchmark: thời gian đóng gói (Zip PDF theo nhóm + .eml + Zip tổng) với
+chính sách nén mới (PDF/Zip/Eml lưu nguyên) so với Deflate cho mọi file.
+
+Chạy từ thư mục gốc của repo:
+    python benchmarks/bench_zip_packaging.py [số_pdf] [kb_mỗi_pdf]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402  (chạy Streamlit ở bare mode, chỉ dùng các hàm helper)
+
+
+def make_fixture(root, n_pdfs, pdf_kb, n_groups=50):
+    """Cây thư mục giống output của distribute_all_files_logic (PDF ~ dữ liệu đã nén)."""
+    for g in range(n_groups):
+        group_dir = os.path.join(root, f"{g + 1:03d}_FUNC_{g}")
+        os.makedirs(os.path.join(group_dir, "HoaDon CK"), exist_ok=True)
+        with open(os.path.join(group_dir, f"{g + 1:03d}_BK_GRAB_FUNC_{g}_3_2024.xlsx"), 'wb') as f:
+            f.write(b"PK" + b"<row><c>Grab</c></row>" * 2000)
+        with open(os.path.join(group_dir, f"email_FUNC_{g}_user@example.com.html"), 'w', encoding='utf-8') as f:
+            f.write("<html><body>" + "<p>Kính gửi anh/chị</p>" * 200 + "</body></html>")
+    for i in range(n_pdfs):
+        group_dir = os.path.join(root, f"{i % n_groups + 1:03d}_FUNC_{i % n_groups}", "HoaDon CK")
+        with open(os.path.join(group_dir, f"1_C24TAA_{100000 + i}.pdf"), 'wb') as f:
+            f.write(b"%PDF-1.4\n" + os.urandom(pdf_kb * 1024))
+
+
+def package(fixture, work_root):
+    """Zip PDF theo nhóm, tạo .eml rồi nén toàn bộ kết quả (giống luồng Phân Phối)."""
+    out = os.path.join(work_root, "OUTPUT")
+    shutil.copytree(fixture, out)
+    start = time.perf_counter()
+    app.create_eml_draft(out)
+    zip_path = app.zip_directory(out, os.path.join(work_root, "final.zip"))
+    elapsed = time.perf_counter() - start
+    return elapsed, os.path.getsize(zip_path)
+
+
+def main():
+    n_pdfs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pdf_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, "fixture")
+        make_fixture(fixture, n_pdfs, pdf_kb)
+
+        results = {}
+        stored_ext = app.ZIP_STORED_EXTENSIONS
+        for name, extensions in (('before (deflate all)', ()), ('after (store pdf/zip/eml)', stored_ext)):
+            app.ZIP_STORED_EXTENSIONS = extensions
+            work = os.path.join(tmp, name.split()[0])
+            os.makedirs(work)
+            results[name] = package(fixture, work)
+            shutil.rmtree(work)
+        app.ZIP_STORED_EXTENSIONS = stored_ext
+
+    print(f"Fixture: {n_pdfs:,} PDF x {pdf_kb} KB, compression level {app.ZIP_COMPRESSION_LEVEL}")
+    for name, (secs, size) in results.items():
+        print(f"  {name:<27} {secs:8.2f} s  final zip {size / 1024 / 1024:8.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
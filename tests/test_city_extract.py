@@ -0,0 +1,30 @@
+import pandas as pd
+
+import app
+
+
+def test_fold_text_punctuation_is_a_delimiter():
+    assert app.fold_text("TP. Hà  Nội") == "tp|ha noi"
+    assert app.fold_text("Ha-Noi") == "ha noi"
+    assert app.fold_text("Vĩnh Long, An Giang") == "vinh long|an giang"
+    assert app.fold_text(" , Quận 1 ( TP.HCM ) ") == "quan 1|tp|hcm"
+    # Nhánh chậm (ký tự gốc không phải ASCII) cho cùng kết quả
+    assert app.fold_text("Vĩnh Long – An Giang") == "vinh long|an giang"
+    assert app.fold_text("Vĩnh Long, An Giang ✓") == "vinh long|an giang"
+
+
+def test_keywords_do_not_span_punctuation():
+    extractor = app.CityExtractor(app.CITY_KEYWORDS)
+    addresses = pd.Series(["Vĩnh Long, An Giang", "Bến Lức, Long An", "Ha-Noi", "Quận 1, TP. Hồ Chí Minh"])
+    expected = [None, "Long An", "Hanoi", "Ho Chi Minh"]
+    assert [extractor.extract(a) for a in addresses] == expected
+    folded = app.normalize_address_column(addresses, memo={})
+    assert extractor.extract_series(addresses, folded).tolist() == expected
+    assert app.folded_contains(folded, "long an").tolist() == [False, True, False, False]
+
+
+def test_session_memo_is_bounded(monkeypatch):
+    monkeypatch.setattr(app, 'ADDRESS_FOLD_MEMO_MAX', 3)
+    app.st.session_state.pop('_address_fold_memo', None)
+    app.normalize_address_column(pd.Series([f"Đường {i}" for i in range(5)]))
+    assert list(app.address_fold_memo()) == ["Đường 2", "Đường 3", "Đường 4"]
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def test_numeric_booking_ids_match_csv_strings():
+    # Bảng Kê từ Excel: Booking ID đọc thành số (int / float); CSV: string[pyarrow]
+    bang_ke = pd.DataFrame({app.IN_COL_BK_BOOKING_ID: [123456, 234567.0, np.nan, 999]})
+    combined = pd.DataFrame({
+        app.IN_COL_ET_BOOKING_ID: pd.array(["123456", "234567", None], dtype='string[pyarrow]'),
+        app.IN_COL_ET_EMP_NAME: ["An", "Bình", "Trống"],
+    }).set_index(app.IN_COL_ET_BOOKING_ID)
+    spec = [(app.IN_COL_ET_EMP_NAME, app.COL_EMPLOYEE_NAME)]
+
+    out, unmatched = app.enrich_with_trip_data(bang_ke, combined, spec)
+
+    assert out[app.COL_EMPLOYEE_NAME].iloc[:2].tolist() == ["An", "Bình"]
+    # Không có Booking ID thì không khớp với dòng CSV thiếu Booking ID
+    assert out[app.COL_EMPLOYEE_NAME].iloc[2:].isna().all()
+    assert unmatched[app.COL_BOOKING_CODE].tolist() == [999]
+
+
+def test_booking_id_key():
+    keys = app.booking_id_key(pd.Series([1.0, "2", " 3 ", None, pd.NA, np.nan], dtype=object))
+    assert keys.tolist() == ["1", "2", "3", "", "", ""]
@@ -0,0 +1,60 @@
+import pytest
+
+import app
+
+
+def legacy_match(files, inv_num, mau_so="", ky_hieu="", relaxed=True, short_relaxed=True):
+    """Logic cũ: quét lần lượt các mẫu trên từng tên file bằng phép 'in'."""
+    patterns = [f"{mau_so}_{ky_hieu}_{inv_num}"] if mau_so and ky_hieu else []
+    patterns += [f"_{inv_num}_", f"{inv_num}_"]
+    for p in patterns:
+        for f in files:
+            if p in f: return f
+    if relaxed:
+        for f in files:
+            if inv_num in f:
+                if len(inv_num) > 4: return f
+                if short_relaxed and f.endswith(f"_{inv_num}.pdf"): return f
+    return None
+
+
+FILES = [
+    "1_C24TAA_1234 (1).pdf",
+    "1_C24TAA_5678-signed.pdf",
+    "01_C24TAA_4321.pdf",
+    "2_C24TBB_00012_KY.pdf",
+    "HD_77_final.pdf",
+    "88_report.pdf",
+    "INV99_copy.pdf",
+    "scan_123456789.pdf",
+    "scan_55.pdf",
+    "x.pdf",
+]
+
+
+@pytest.mark.parametrize("inv_num, mau_so, ky_hieu, expected", [
+    ("1234", "1", "C24TAA", "1_C24TAA_1234 (1).pdf"),      # bản sao '(1)'
+    ("5678", "1", "C24TAA", "1_C24TAA_5678-signed.pdf"),   # hậu tố '-signed'
+    ("4321", "1", "C24TAA", "01_C24TAA_4321.pdf"),         # '01_' chứa '1_'
+    ("00012", "2", "C24TBB", "2_C24TBB_00012_KY.pdf"),
+])
+def test_strict_matches_substring(inv_num, mau_so, ky_hieu, expected):
+    index = app.PdfFilenameIndex(FILES)
+    matched, level, _ = index.lookup(inv_num, mau_so, ky_hieu, relaxed=False)
+    assert (matched, level) == (expected, 'strict')
+
+
+def test_levels_match_legacy_scan():
+    index = app.PdfFilenameIndex(FILES)
+    queries = [("1234", "1", "C24TAA"), ("77", "", ""), ("88", "", ""), ("99", "", ""), ("12345", "", ""),
+               ("55", "", ""), ("4321", "9", "ZZ"), ("404", "", ""), ("12", "", "")]
+    for relaxed, short_relaxed in [(True, True), (True, False), (False, True)]:
+        for inv_num, mau_so, ky_hieu in queries:
+            matched, _, _ = index.lookup(inv_num, mau_so, ky_hieu, relaxed=relaxed, short_relaxed=short_relaxed)
+            assert matched == legacy_match(FILES, inv_num, mau_so, ky_hieu, relaxed, short_relaxed), inv_num
+
+
+def test_discard_skips_file():
+    index = app.PdfFilenameIndex(FILES)
+    index.discard("1_C24TAA_1234 (1).pdf")
+    assert index.lookup("1234", "1", "C24TAA", relaxed=False)[0] is None
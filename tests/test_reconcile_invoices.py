@@ -0,0 +1,39 @@
+import warnings
+
+import pandas as pd
+
+import app
+
+
+def make_frames():
+    df_proc = pd.DataFrame({
+        app.COL_GROUP_FUNCTION: ["FA", "FA", "FB", "FB"],
+        app.COL_BOOKING_CODE: ["B1", "B2", "B3", "B4"],
+        app.COL_INVOICE_NUM: [1234.0, "5678", "777", "99999"],
+    })
+    df_report = pd.DataFrame({
+        app.COL_ADJUSTED_INVOICE_REPORT: ["1234", "5678", "777", "99999"],
+        'Mẫu số': [1.0, 1, 1, 1],
+        'Ký hiệu': ["C24TAA", "C24TAA", "C24TAA", None],
+    })
+    return df_proc, df_report
+
+
+def test_reconcile_agrees_with_distribution_lookup():
+    df_proc, df_report = make_frames()
+    pdf_files = ["1_C24TAA_1234 (1).pdf", "HD5678.pdf", "scan_777.pdf", "x_199999.pdf"]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        summary, missing = app.reconcile_invoices_with_pdfs(df_proc, pdf_files, df_report)
+
+    index = app.PdfFilenameIndex(pdf_files)
+    series = app.report_invoice_series(df_report)
+    expected_missing = sorted(inv for inv in ["1234", "5678", "777", "99999"] if index.lookup(inv, *series.get(inv, ("", "")))[0] is None)
+    assert sorted(missing['Hóa đơn thiếu PDF']) == expected_missing == ["5678"]
+    assert summary.set_index(app.COL_GROUP_FUNCTION)['PDF Tìm Thấy'].to_dict() == {"FA": 1, "FB": 2}
+
+
+def test_reconcile_without_pdfs():
+    df_proc, _ = make_frames()
+    summary, missing = app.reconcile_invoices_with_pdfs(df_proc, [])
+    assert (summary['Trạng Thái'] == "⚪ Chưa có PDF").all() and missing.empty
@@ -0,0 +1,30 @@
+import io
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('constant_memory', [True, False])
+def test_report_sheet_cells(constant_memory):
+    money = app.MONEY_COL_REPORT[0]
+    df = pd.DataFrame({
+        'STT': [1, 2, 3],
+        'Ghi chú': ['a', None, np.inf],
+        money: [1000.0, np.nan, -np.inf],
+    })
+    buf = io.BytesIO()
+    with app.open_excel_writer(buf, constant_memory) as writer:
+        app.write_report_sheet(df, 'DS', 'BÁO CÁO', writer)
+    ws = openpyxl.load_workbook(io.BytesIO(buf.getvalue()))['DS']
+
+    assert [c.value for c in ws[1]] == ['STT', 'Ghi chú', money]
+    assert [[c.value for c in row] for row in ws.iter_rows(min_row=2, max_row=4)] == [
+        [1, 'a', 1000], [2, None, None], [3, 'inf', '-inf']]
+    # Ô trống vẫn có viền; cột tiền dùng format #,##0
+    assert all(c.border.left.style for row in ws.iter_rows(min_row=2, max_row=4) for c in row)
+    assert ws.cell(2, 3).number_format == '#,##0'
+    assert ws.cell(5, 1).value == 'TỔNG CỘNG' and ws.cell(5, 3).value == '=SUM(C2:C4)'
@@ -0,0 +1,29 @@
+import io
+
+import app
+
+
+class FakeUpload(io.BytesIO):
+    """Giống UploadedFile: có file_id và size."""
+    def __init__(self, data, file_id):
+        super().__init__(data)
+        self.file_id, self.size = file_id, len(data)
+        self.reads = 0
+
+    def getvalue(self):
+        self.reads += 1
+        return super().getvalue()
+
+
+def test_digest_memoized_per_file_id():
+    app.st.session_state.pop('_upload_hash_memo', None)
+    up = FakeUpload(b"abc", "id-1")
+    first = app.file_content_hash(up)
+    assert app.file_content_hash(up) == first
+    assert up.reads == 1
+    # file_id mới (upload lại) -> băm lại
+    assert app.file_content_hash(FakeUpload(b"abd", "id-2")) != first
+
+
+def test_plain_file_like_is_hashed():
+    assert app.file_content_hash(io.BytesIO(b"abc")) == app.file_content_hash(io.BytesIO(b"abc"))